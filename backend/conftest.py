@@ -0,0 +1,15 @@
+import pytest
+
+from utils.settings import current_settings
+
+@pytest.fixture(autouse=True)
+def db_backend(request):
+    previous = current_settings.db_backend
+    current_settings.db_backend = getattr(request, "param", previous)
+    yield current_settings.db_backend
+    current_settings.db_backend = previous
+
+def pytest_generate_tests(metafunc):
+    # the db API tests run once per storage backend
+    if metafunc.module.__name__ == "test_db":
+        metafunc.parametrize("db_backend", ["json", "sqlite"], indirect=True)
@@ -1,20 +1,45 @@
-from typing import Annotated
+import asyncio
+from contextlib import asynccontextmanager
+import time
+from typing import Annotated, Union
 
-from fastapi import Depends, FastAPI, HTTPException, UploadFile, Form, status
-from fastapi.responses import FileResponse
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, UploadFile, Form, status
+from fastapi.responses import PlainTextResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 
 from datetime import timedelta
 import jwt
 
 from utils.settings import current_settings
-from utils.auth import authenticate_user, create_access_token, sign_compression_url, sign_image_url
-from utils.image import create_and_store_user_image_compression, delete_user_image_compression_fs, delete_user_image_fs, store_user_image
-from utils.types import Token, TokenData, User, UserImage, UserImageCompression
-from utils.db import create_user_image_compression_db, create_user_image_db, delete_user_image_compression_db, delete_user_image_db, get_db, get_user_db, get_user_image_compression_count_db, get_user_image_compressions_db, get_user_image_db, get_user_image_compression_db, get_user_image_count_db, get_user_image_db, get_user_images_db, init_db
-
-app = FastAPI()
+from utils.auth import authenticate_user_limited, create_access_token, forget_negotiated_downloads, forget_signed_downloads, get_signed_url_cache_stats, get_token_user, get_user_cache_stats, negotiate_compression_download, resolve_compression_download, resolve_image_download, resolve_image_preview_download, sign_compression_url, sign_compression_urls, sign_image_url, sign_image_urls, verify_signed_download
+from utils.image import OUTPUT_FORMATS, RESAMPLE_FILTERS, ByteBudgetUnreachable, ImageTooLarge, InvalidImageUpload, create_and_store_user_image_compression, delete_user_image_compression_fs, delete_user_images, find_cached_user_image_compression, delete_user_image_fs, resolve_resample, store_user_image_stream
+from utils.image_memory import ImageOverMemoryBudget
+from utils.metrics import CACHE_LOOKUPS, REQUEST_SECONDS, register_collector, render_metrics
+from utils.image_pool import ImageJobTimeout, ImagePoolBusy, get_image_pool_stats, run_image_job, shutdown_image_pool
+from utils.password_pool import LoginRateLimited, PasswordPoolBusy, shutdown_password_pool
+from utils.reaper import shutdown_file_reaper
+from utils.filestore_gc import run_filestore_gc_forever
+from utils.jobs import CompressionQuotaExceeded, backfill_previews, count_pending_jobs, submit_compression_jobs, submit_preview_job, wait_for_compression_job, with_expired_lease
+from utils.types import JOB_DONE, CompressionJob, CompressionJobRequest, DeleteImagesRequest, Token, User, UserImage, UserImageCompression
+from utils.downloads import cached_file_response
+from utils.store import INDEXED_FIELDS
+from utils.db import QuotaExceeded, compression_quota_exceeded_db, create_user_image_compression_db, create_user_image_db, delete_user_image_compression_db, get_user_image_compression_count_db, get_user_image_compressions_page_db, get_user_image_db, get_user_image_compression_db, get_user_counters_db, get_user_images_page_db, get_compression_jobs_db, get_db_cache_stats, get_db_size_bytes, open_db
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    gc_task = None
+    if current_settings.filestore_gc_interval_seconds is not None:
+        gc_task = asyncio.create_task(run_filestore_gc_forever(current_settings.filestore_gc_interval_seconds))
+    yield
+    if gc_task is not None:
+        gc_task.cancel()
+    shutdown_image_pool()
+    shutdown_password_pool()
+    shutdown_file_reaper()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:5173",
@@ -26,10 +51,80 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+class RequestMetricsMiddleware:
+    # latency per route template (e.g. /image/{image_id}), so ids don't become labels
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not current_settings.metrics_enabled:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(time.perf_counter() - started, scope["method"], route.path if route is not None else "unmatched", f"{status_code}")
+
+app.add_middleware(RequestMetricsMiddleware)
+
+def hit_ratio(hits: int, misses: int) -> float:
+    return hits / (hits + misses) if hits + misses > 0 else 0.0
+
+def collect_app_metrics() -> list:
+    caches = {
+        "db": get_db_cache_stats(current_settings.db_file_path),
+        "users": get_user_cache_stats(),
+        "compressions": { "hits": CACHE_LOOKUPS.value("hit"), "misses": CACHE_LOOKUPS.value("miss") },
+    }
+    for name, stats in get_signed_url_cache_stats().items():
+        caches[f"{name}_urls"] = stats
+
+    pool = get_image_pool_stats()
+    return [
+        ("db_size_bytes", "gauge", "Size of the db on disk, including its log or WAL", [({}, get_db_size_bytes(current_settings.db_file_path))]),
+        ("cache_hits_total", "counter", "Cache lookups that found an entry", [({ "cache": name }, stats["hits"]) for name, stats in caches.items()]),
+        ("cache_misses_total", "counter", "Cache lookups that missed", [({ "cache": name }, stats["misses"]) for name, stats in caches.items()]),
+        ("cache_hit_ratio", "gauge", "Hits over all lookups since the process started", [({ "cache": name }, hit_ratio(stats["hits"], stats["misses"])) for name, stats in caches.items()]),
+        ("image_pool_in_flight", "gauge", "Image jobs running or queued", [({}, pool["in_flight"])]),
+        ("image_pool_queue_depth", "gauge", "Image jobs waiting for a worker", [({}, pool["queue_depth"])]),
+        ("image_pool_jobs_total", "counter", "Image jobs by outcome", [({ "result": result }, pool[result]) for result in ("completed", "failed", "rejected", "timed_out")]),
+        ("image_pool_peak_rss_max_bytes", "gauge", "Highest peak RSS of an image job", [({}, pool["peak_rss_max_bytes"])]),
+    ]
+
+register_collector(collect_app_metrics)
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+async def run_image_job_or_503(fn, *args):
+    try:
+        return await run_image_job(fn, *args)
+    except ImagePoolBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The image processor is busy, try again shortly",
+            headers={"Retry-After": f"{current_settings.image_pool_retry_after_seconds}"},
+        )
+    except ImageJobTimeout:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Image processing timed out")
+    except ImageOverMemoryBudget:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="The image is too large to process at this size")
+    except ByteBudgetUnreachable:
+        raise HTTPException(status_code=400, detail="The image can't be compressed within max_bytes")
+
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -38,16 +133,10 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     )
 
     try:
-        payload = jwt.decode(token, current_settings.auth_secret_key, algorithms=[current_settings.algorithm])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
+        user = get_token_user(token)
     except jwt.InvalidTokenError:
         raise credentials_exception
 
-    dbJSON = get_db(current_settings.db_file_path)
-    user = get_user_db(dbJSON, username=token_data.username)
     if user is None:
         raise credentials_exception
     
@@ -55,9 +144,23 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
 
 @app.post("/token")
 async def login_for_access_token(
+    request: Request,
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
 ) -> Token:
-    user = authenticate_user(form_data.username, form_data.password)
+    try:
+        user = await authenticate_user_limited(form_data.username, form_data.password, request.client.host if request.client else None)
+    except LoginRateLimited as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts, try again later",
+            headers={"Retry-After": f"{e.retry_after}"},
+        )
+    except PasswordPoolBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many logins in progress, try again shortly",
+            headers={"Retry-After": f"{current_settings.password_pool_retry_after_seconds}"},
+        )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -71,6 +174,13 @@ async def login_for_access_token(
 
     return Token(access_token=access_token, token_type="bearer")
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    if not current_settings.metrics_enabled:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.get("/user/{user_id}")
 async def get_image(user_id: str, current_user: Annotated[User, Depends(get_current_user)]):
     if user_id == "me":
@@ -81,22 +191,64 @@ async def get_image(user_id: str, current_user: Annotated[User, Depends(get_curr
 
     return current_user
 
+def parse_listing_params(model, sort: str, order: str, fields: Union[str, None], limit: Union[int, None], sortable: tuple) -> tuple:
+    if sort not in sortable:
+        raise HTTPException(status_code=400, detail="Invalid sort field")        
+
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="Invalid sort order")        
+
+    if limit is not None and (limit <= 0 or limit > current_settings.max_page_size):
+        raise HTTPException(status_code=400, detail="Invalid page size")        
+
+    projection = None
+    if fields is not None:
+        projection = set(fields.split(",")) | {"id"}
+        if not projection <= set(model.model_fields):
+            raise HTTPException(status_code=400, detail="Invalid fields")        
+
+    return order == "desc", projection
+
+def page_or_400(get_page, *args):
+    try:
+        return get_page(*args)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")        
+
+# Listings are dicts keyed by id, in sort order. With `limit` set, the cursor for the
+# next page (if any) is returned in the X-Next-Cursor header.
 @app.get("/images")
-async def get_user_images(current_user: Annotated[User, Depends(get_current_user)]):
-    dbJSON = get_db(current_settings.db_file_path)
-    images = get_user_images_db(dbJSON, current_user.id)
-    for key in images:
-        image = UserImage(**images[key])
+async def get_user_images(current_user: Annotated[User, Depends(get_current_user)], response: Response, preview_size: Union[int, None] = None, sort: str = "uploaded_at", order: str = "asc", cursor: Union[str, None] = None, limit: Union[int, None] = None, fields: Union[str, None] = None):
+    if preview_size is not None and preview_size not in current_settings.preview_sizes:
+        raise HTTPException(status_code=400, detail="Invalid preview size")        
+
+    descending, projection = parse_listing_params(UserImage, sort, order, fields, limit, INDEXED_FIELDS["images"])
+
+    db = open_db(current_settings.db_file_path)
+    page, next_cursor = page_or_400(get_user_images_page_db, db, current_user.id, sort, descending, cursor, limit)
+    images = {}
+    for key, value in page:
+        image = UserImage(**value)
         
-        images[key]["num_compressions"] = get_user_image_compression_count_db(dbJSON, image.id)
-        images[key]["signed_url"] = sign_image_url(image)
+        if projection is None or "num_compressions" in projection:
+            image.num_compressions = get_user_image_compression_count_db(db, image.id)
+        images[key] = image
+
+    if projection is None or "signed_url" in projection or "preview_url" in projection:
+        sign_image_urls(list(images.values()), preview_size)
+    backfill_previews(list(images.values()))
+
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
 
-    return images
+    if projection is None:
+        return images
+    return { key: image.model_dump(include=projection) for key, image in images.items() }
 
 @app.get("/image/{image_id}")
 async def get_image(current_user: Annotated[User, Depends(get_current_user)], image_id: str):
-    dbJSON = get_db(current_settings.db_file_path)
-    image = get_user_image_db(dbJSON, current_user.id, image_id)
+    db = open_db(current_settings.db_file_path)
+    image = get_user_image_db(db, current_user.id, image_id)
     if image is None:
         raise HTTPException(status_code=404, detail="Image not found")        
 
@@ -105,18 +257,24 @@ async def get_image(current_user: Annotated[User, Depends(get_current_user)], im
     return image
  
 @app.get("/image")
-async def get_image(signature: str):
+async def get_image(request: Request, signature: str):
     try:
-        decoded = jwt.decode(signature, current_settings.signed_url_secret_key, algorithms=current_settings.algorithm)
-        user_id = decoded["user_id"]
-        image_id = decoded["image_id"]
+        download = verify_signed_download("/image", signature, resolve_image_download)
+        if download is None:
+            raise HTTPException(status_code=404, detail="Image not found")        
+
+        return cached_file_response(request, download.path, download.etag, download.expires_at)
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Image link expired")        
 
-        dbJSON = get_db(current_settings.db_file_path)
-        image = get_user_image_db(dbJSON, user_id, image_id)
-        if image is None:
+@app.get("/image-preview")
+async def get_image_preview(request: Request, signature: str):
+    try:
+        download = verify_signed_download("/image-preview", signature, resolve_image_preview_download)
+        if download is None:
             raise HTTPException(status_code=404, detail="Image not found")        
 
-        return FileResponse(image.path)
+        return cached_file_response(request, download.path, download.etag, download.expires_at)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Image link expired")        
 
@@ -125,7 +283,8 @@ async def upload_image(current_user: Annotated[User, Depends(get_current_user)],
     if len(file_name) < 3 or len(file_name) > 100:
         raise HTTPException(status_code=400, detail="Invalid file name")        
 
-    if file.size > current_settings.max_file_size:
+    # file.size comes from the client, the real limit is enforced while streaming
+    if file.size is not None and file.size > current_settings.max_file_size:
         raise HTTPException(status_code=400, detail="The uploaded image is too large")        
 
     split = file.content_type.split("/")
@@ -134,12 +293,27 @@ async def upload_image(current_user: Annotated[User, Depends(get_current_user)],
     if not (file_extension == 'jpeg' or file_extension == 'png' or file_extension == 'gif'):
         raise HTTPException(status_code=400, detail="Invalid image type")        
 
-    dbJSON = get_db(current_settings.db_file_path)
-    if get_user_image_count_db(dbJSON, current_user.id) > current_settings.max_user_images:
+    db = open_db(current_settings.db_file_path)
+    # counters make this a cheap early exit; create_user_image_db enforces the quotas
+    counters = get_user_counters_db(db, current_user.id)
+    if counters["images"] > current_settings.max_user_images:
         raise HTTPException(status_code=400, detail="User has uploaded the maximum number of images")        
+    if current_settings.max_user_bytes is not None and counters["bytes"] >= current_settings.max_user_bytes:
+        raise HTTPException(status_code=400, detail="User has used their storage quota")        
 
-    image = store_user_image(current_settings.filestore_file_path, current_user, file_name, file, file_extension)
-    create_user_image_db(current_settings.db_file_path, current_user.id, image)
+    try:
+        # no decoding happens here, so plain file I/O in a thread is enough
+        image = await run_in_threadpool(store_user_image_stream, current_settings.filestore_file_path, current_user, file_name, file.file, file_extension)
+    except ImageTooLarge:
+        raise HTTPException(status_code=400, detail="The uploaded image is too large")        
+    except InvalidImageUpload:
+        raise HTTPException(status_code=400, detail="Invalid image type")        
+    try:
+        create_user_image_db(current_settings.db_file_path, current_user.id, image, current_settings.max_user_images, current_settings.max_user_bytes)
+    except QuotaExceeded:
+        delete_user_image_fs(image)
+        raise HTTPException(status_code=400, detail="User has uploaded the maximum number of images or used their storage quota")        
+    submit_preview_job(image)
 
     if image == None:
         return { "success": False }
@@ -149,78 +323,189 @@ async def upload_image(current_user: Annotated[User, Depends(get_current_user)],
 
 @app.delete("/image/{image_id}")
 async def delete_image(current_user: Annotated[User, Depends(get_current_user)], image_id: str):
-    dbJSON = get_db(current_settings.db_file_path)
-    image = get_user_image_db(dbJSON, current_user.id, image_id)
+    db = open_db(current_settings.db_file_path)
+    image = get_user_image_db(db, current_user.id, image_id)
     if image is None:
         raise HTTPException(status_code=400, detail="Invalid image for deletion")        
     
-    delete_user_image_fs(image)
-    delete_user_image_db(current_settings.db_file_path, image.user_id, image.id)
+    await run_in_threadpool(delete_user_images, image.user_id, [image.id])
+    forget_signed_downloads(image.id)
 
     return { "success": True }
+
+@app.post("/images/delete")
+async def delete_images(current_user: Annotated[User, Depends(get_current_user)], delete_request: DeleteImagesRequest):
+    if len(delete_request.image_ids) == 0 or len(delete_request.image_ids) > current_settings.max_page_size:
+        raise HTTPException(status_code=400, detail="Invalid images for deletion")        
+
+    # ids that aren't the user's (or are already gone) are skipped
+    deleted = await run_in_threadpool(delete_user_images, current_user.id, delete_request.image_ids)
+    for image in deleted:
+        forget_signed_downloads(image.id)
+
+    return { "success": True, "deleted": [image.id for image in deleted] }
  
+@app.get("/image-output-formats")
+async def get_image_output_formats(current_user: Annotated[User, Depends(get_current_user)]):
+    return list(OUTPUT_FORMATS)
+
 @app.get("/image-compression")
-async def get_image_compression(signature: str):
+async def get_image_compression(request: Request, signature: str):
     try:
-        decoded = jwt.decode(signature, current_settings.signed_url_secret_key, algorithms=current_settings.algorithm)
-        image_id = decoded["image_id"]
-        compression_id = decoded["compression_id"]
-
-        dbJSON = get_db(current_settings.db_file_path)
-        image = get_user_image_compression_db(dbJSON, image_id, compression_id)
-        if image is None:
+        download = verify_signed_download("/image-compression", signature, resolve_compression_download)
+        if download is None:
             raise HTTPException(status_code=404, detail="Image not found")        
 
-        return FileResponse(image.path)
+        download = negotiate_compression_download(download, request.headers.get("accept"))
+        return cached_file_response(request, download.path, download.etag, download.expires_at, vary="Accept")
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Image link expired")        
 
 @app.get("/image/{image_id}/image-compressions")
-async def image_compressions(current_user: Annotated[User, Depends(get_current_user)], image_id: str):
-    dbJSON = get_db(current_settings.db_file_path)
-    compressions = get_user_image_compressions_db(dbJSON, image_id)
-    for key in compressions:
-        compression = UserImageCompression(**compressions[key])
-        
-        compressions[key]["signed_url"] = sign_compression_url(compression)
+async def image_compressions(current_user: Annotated[User, Depends(get_current_user)], image_id: str, response: Response, sort: str = "created_at", order: str = "asc", cursor: Union[str, None] = None, limit: Union[int, None] = None, fields: Union[str, None] = None):
+    descending, projection = parse_listing_params(UserImageCompression, sort, order, fields, limit, INDEXED_FIELDS["compressions"])
 
-    return compressions
+    db = open_db(current_settings.db_file_path)
+    page, next_cursor = page_or_400(get_user_image_compressions_page_db, db, image_id, sort, descending, cursor, limit)
+    compressions = {}
+    for key, value in page:
+        compressions[key] = UserImageCompression(**value)
 
-@app.put("/image/{image_id}/image-compression")
-async def image_compression(current_user: Annotated[User, Depends(get_current_user)], image_id: str, quality: Annotated[int, Form()], resize_width: Annotated[int, Form()]):
+    if projection is None or "signed_url" in projection:
+        sign_compression_urls(list(compressions.values()))
+
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    if projection is None:
+        return compressions
+    return { key: compression.model_dump(include=projection) for key, compression in compressions.items() }
+
+def validate_compression_params(quality: int, resize_width: Union[int, None], resample: Union[str, None] = None, output_format: Union[str, None] = None, target_ssim: Union[float, None] = None, target_psnr: Union[float, None] = None, max_bytes: Union[int, None] = None):
     if quality < 0 or quality > 100:
         raise HTTPException(status_code=400, detail="Invalid quality value")        
 
     if resize_width is not None and (resize_width <= 0 or resize_width > 3000):
         raise HTTPException(status_code=400, detail="Invalid quality value")        
 
-    dbJSON = get_db(current_settings.db_file_path)
-    image = get_user_image_db(dbJSON, current_user.id, image_id)
+    if resample is not None and resample not in RESAMPLE_FILTERS:
+        raise HTTPException(status_code=400, detail="Invalid resample filter")        
+
+    if output_format is not None and output_format not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid output format")        
+
+    if target_ssim is not None and (target_ssim <= 0 or target_ssim > 1):
+        raise HTTPException(status_code=400, detail="Invalid target SSIM")        
+
+    if target_psnr is not None and target_psnr <= 0:
+        raise HTTPException(status_code=400, detail="Invalid target PSNR")        
+
+    if max_bytes is not None and max_bytes <= 0:
+        raise HTTPException(status_code=400, detail="Invalid byte budget")        
+
+@app.put("/image/{image_id}/image-compression")
+async def image_compression(current_user: Annotated[User, Depends(get_current_user)], image_id: str, quality: Annotated[int, Form()], resize_width: Annotated[int, Form()], resample: Annotated[Union[str, None], Form()] = None, output_format: Annotated[Union[str, None], Form()] = None, target_ssim: Annotated[Union[float, None], Form()] = None, target_psnr: Annotated[Union[float, None], Form()] = None, max_bytes: Annotated[Union[int, None], Form()] = None):
+    validate_compression_params(quality, resize_width, resample, output_format, target_ssim, target_psnr, max_bytes)
+    resample = resolve_resample(resize_width, resample)
+
+    db = open_db(current_settings.db_file_path)
+    image = get_user_image_db(db, current_user.id, image_id)
     if image is None:
         raise HTTPException(status_code=404, detail="Image not found")        
 
-    if get_user_image_compression_count_db(dbJSON, image.id) > current_settings.max_compressions_per_image:
+    if compression_quota_exceeded_db(db, image.id, current_settings.max_compressions_per_image, count_pending_jobs(db, image.id) + 1):
         raise HTTPException(status_code=400, detail="User has created the maximum number of image compressions")        
+    if current_settings.max_user_bytes is not None and get_user_counters_db(db, current_user.id)["bytes"] >= current_settings.max_user_bytes:
+        raise HTTPException(status_code=400, detail="User has used their storage quota")        
 
-    compression = create_and_store_user_image_compression(current_settings.filestore_file_path, current_user, image, quality, resize_width)
-    create_user_image_compression_db(current_settings.db_file_path, compression)
+    compression = None
+    if target_ssim is None and target_psnr is None and max_bytes is None:
+        compression = find_cached_user_image_compression(current_settings.filestore_file_path, db, image, quality, resize_width, resample, output_format)
+    if compression is None:
+        # with a target or byte budget, quality is the highest one to try
+        compression = await run_image_job_or_503(create_and_store_user_image_compression, current_settings.filestore_file_path, current_user, image, quality, resize_width, resample, output_format, target_ssim, target_psnr, max_bytes)
+    try:
+        create_user_image_compression_db(current_settings.db_file_path, compression, current_settings.max_user_bytes)
+    except QuotaExceeded:
+        raise HTTPException(status_code=400, detail="User has used their storage quota")        
+    forget_negotiated_downloads(image.id)
 
     compression.signed_url = sign_compression_url(compression)
     return { "compression": compression }
 
 @app.delete("/image/{image_id}/image-compression/{compression_id}")
 async def delete_image_compression(current_user: Annotated[User, Depends(get_current_user)], image_id: str, compression_id: str):
-    dbJSON = get_db(current_settings.db_file_path)
-    image = get_user_image_db(dbJSON, current_user.id, image_id)
+    db = open_db(current_settings.db_file_path)
+    image = get_user_image_db(db, current_user.id, image_id)
     if image is None:
         raise HTTPException(status_code=400, detail="Parent image does not exist")        
     
-    compression = get_user_image_compression_db(dbJSON, image_id, compression_id)
+    compression = get_user_image_compression_db(db, image_id, compression_id)
     if compression is None:
         raise HTTPException(status_code=404, detail="Image compression not found")        
 
-    delete_user_image_compression_fs(compression)
     delete_user_image_compression_db(current_settings.db_file_path, compression.image_id, compression.id)
+    delete_user_image_compression_fs(compression)
+    forget_signed_downloads(compression.image_id, compression.id)
 
     return { "success": True }
 
+def with_job_compression(db, job: CompressionJob):
+    if job.status == JOB_DONE:
+        job.compression = get_user_image_compression_db(db, job.image_id, job.compression_id)
+        if job.compression is not None:
+            job.compression.signed_url = sign_compression_url(job.compression)
+
+    return job
+
+@app.post("/image/{image_id}/image-compression-jobs", status_code=status.HTTP_202_ACCEPTED)
+async def create_image_compression_jobs(current_user: Annotated[User, Depends(get_current_user)], image_id: str, job_request: CompressionJobRequest):
+    if len(job_request.variants) == 0 or len(job_request.variants) > current_settings.max_compressions_per_image:
+        raise HTTPException(status_code=400, detail="Invalid number of compression variants")        
+
+    for variant in job_request.variants:
+        validate_compression_params(variant.quality, variant.resize_width, variant.resample, variant.output_format, variant.target_ssim, variant.target_psnr, variant.max_bytes)
+
+    db = open_db(current_settings.db_file_path)
+    image = get_user_image_db(db, current_user.id, image_id)
+    if image is None:
+        raise HTTPException(status_code=404, detail="Image not found")        
+    if current_settings.max_user_bytes is not None and get_user_counters_db(db, current_user.id)["bytes"] >= current_settings.max_user_bytes:
+        raise HTTPException(status_code=400, detail="User has used their storage quota")        
+
+    try:
+        jobs = submit_compression_jobs(current_user, image, job_request.variants)
+    except CompressionQuotaExceeded:
+        raise HTTPException(status_code=400, detail="User has created the maximum number of image compressions")        
+    except ImagePoolBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="The image processor is busy, try again shortly",
+            headers={"Retry-After": f"{current_settings.image_pool_retry_after_seconds}"},
+        )
+
+    return { "jobs": [with_job_compression(db, job) for job in jobs] }
+
+@app.get("/image/{image_id}/image-compression-jobs")
+async def image_compression_jobs(current_user: Annotated[User, Depends(get_current_user)], image_id: str):
+    db = open_db(current_settings.db_file_path)
+    if get_user_image_db(db, current_user.id, image_id) is None:
+        raise HTTPException(status_code=404, detail="Image not found")        
+
+    jobs = {}
+    for key, value in get_compression_jobs_db(db, image_id).items():
+        jobs[key] = with_job_compression(db, with_expired_lease(CompressionJob(**value)))
+
+    return jobs
+
+@app.get("/image/{image_id}/image-compression-jobs/{job_id}")
+async def image_compression_job(current_user: Annotated[User, Depends(get_current_user)], image_id: str, job_id: str, wait: float = 0):
+    db = open_db(current_settings.db_file_path)
+    if get_user_image_db(db, current_user.id, image_id) is None:
+        raise HTTPException(status_code=404, detail="Image not found")        
+
+    job = await wait_for_compression_job(image_id, job_id, wait)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Compression job not found")        
+
+    return with_job_compression(open_db(current_settings.db_file_path), job)
@@ -0,0 +1,112 @@
+import asyncio
+import time
+import pytest
+import utils.auth
+from pathlib import Path
+from datetime import timedelta
+
+from utils.settings import current_settings
+from utils.auth import authenticate_user_limited, bcrypt_rounds, create_access_token, forget_negotiated_downloads, get_token_user, get_user_cache_stats, negotiate_compression_download, pwd_context, verify_password
+from utils.db import close_db, create_user_image_compression_db, get_user_db, init_db, open_db, set_user_db
+from utils.password_pool import LoginLimiter, LoginRateLimited
+from utils.types import SignedDownload, User, UserImageCompression
+
+test_db_path = f"{current_settings.base_path}/db-test.json"
+
+@pytest.fixture(scope='function')
+def auth_db_resource(request, monkeypatch):
+    monkeypatch.setattr(current_settings, "db_file_path", test_db_path)
+    init_db(test_db_path, True)
+
+    def db_teardown():
+        close_db(test_db_path)
+        for suffix in ("", ".log", ".lock"):
+            Path(f"{test_db_path}{suffix}").unlink(missing_ok=True)
+
+    request.addfinalizer(db_teardown)
+
+def test_get_token_user_cache(auth_db_resource):
+    set_user_db(test_db_path, User(id = "abc", username = "test-user", password = "hash"))
+    token = create_access_token({ "sub": "test-user" }, timedelta(minutes=5))
+
+    before = get_user_cache_stats()
+    user = get_token_user(token)
+    assert user.id == "abc"
+    assert user.password is None
+
+    assert get_token_user(token) is user
+    after = get_user_cache_stats()
+    assert after["hits"] == before["hits"] + 1
+
+    # writing the user record drops cached resolutions
+    set_user_db(test_db_path, User(id = "def", username = "test-user", password = "hash"))
+    assert get_token_user(token).id == "def"
+
+def test_get_token_user_unknown(auth_db_resource):
+    token = create_access_token({ "sub": "nobody" }, timedelta(minutes=5))
+
+    assert get_token_user(token) is None
+
+def test_login_limiter():
+    limiter = LoginLimiter(2, 60)
+    limiter.admit("test-user")
+    limiter.admit("test-user")
+    limiter.admit("other-user")
+
+    with pytest.raises(LoginRateLimited) as e:
+        limiter.admit("test-user")
+    assert 0 < e.value.retry_after <= 60
+
+    limiter.reset("test-user")
+    limiter.admit("test-user")
+
+def test_authenticate_user_rehash(auth_db_resource, monkeypatch):
+    monkeypatch.setattr(current_settings, "password_bcrypt_rounds", 5)
+    set_user_db(test_db_path, User(id = "abc", username = "test-user", password = pwd_context.handler("bcrypt").using(rounds=4).hash("secret")))
+
+    user = asyncio.run(authenticate_user_limited("test-user", "secret", "127.0.0.1"))
+    assert user.id == "abc"
+
+    # the stored hash now uses the configured cost and still verifies
+    stored = get_user_db(open_db(test_db_path), "test-user", True)
+    assert bcrypt_rounds(stored.password) == 5
+    assert verify_password("secret", stored.password)
+
+    assert not asyncio.run(authenticate_user_limited("test-user", "wrong", "127.0.0.1"))
+
+def test_negotiate_compression_download(auth_db_resource, tmp_path):
+    for compression_id, extension, size in (("c-png", "png", 300), ("c-webp", "webp", 200), ("c-avif", "avif", 100)):
+        (tmp_path / f"{compression_id}.{extension}").write_bytes(b"x")
+        create_user_image_compression_db(test_db_path, UserImageCompression(id = compression_id, image_id = "123", path = str(tmp_path / f"{compression_id}.{extension}"), quality = 80, resize_width = 100, output_format = extension, size = size, blob_key = compression_id, created_at = "123"))
+    # different settings are never swapped in
+    create_user_image_compression_db(test_db_path, UserImageCompression(id = "c-other", image_id = "123", path = str(tmp_path / "c-webp.webp"), quality = 50, resize_width = 100, output_format = "webp", size = 10, created_at = "123"))
+    download = SignedDownload(image_id = "123", compression_id = "c-png", path = str(tmp_path / "c-png.png"), expires_at = 0)
+
+    assert negotiate_compression_download(download, None).compression_id == "c-png"
+    assert negotiate_compression_download(download, "*/*").compression_id == "c-png"
+    assert negotiate_compression_download(download, "image/webp,image/*;q=0.8").compression_id == "c-webp"
+    assert negotiate_compression_download(download, "image/avif,image/webp,*/*;q=0.8").compression_id == "c-avif"
+    assert negotiate_compression_download(download, "text/html").compression_id == "c-png"
+
+def test_negotiate_compression_download_cached(auth_db_resource, tmp_path, monkeypatch):
+    for compression_id, extension, size in (("c-png", "png", 300), ("c-webp", "webp", 200)):
+        (tmp_path / f"{compression_id}.{extension}").write_bytes(b"x")
+        create_user_image_compression_db(test_db_path, UserImageCompression(id = compression_id, image_id = "123", path = str(tmp_path / f"{compression_id}.{extension}"), quality = 80, resize_width = 100, output_format = extension, size = size, blob_key = compression_id, created_at = "123"))
+
+    lookups = []
+    lookup = utils.auth.get_user_image_compressions_db
+    monkeypatch.setattr(utils.auth, "get_user_image_compressions_db", lambda *args: lookups.append(args) or lookup(*args))
+    download = SignedDownload(image_id = "123", compression_id = "c-png", path = str(tmp_path / "c-png.png"), expires_at = int(time.time()) + 60)
+
+    # the requested format is already the preferred one
+    assert negotiate_compression_download(download, "image/png,*/*;q=0.8").compression_id == "c-png"
+    assert len(lookups) == 0
+
+    # headers with the same format preference share one lookup
+    assert negotiate_compression_download(download, "image/webp,*/*;q=0.8").compression_id == "c-webp"
+    assert negotiate_compression_download(download, "text/html,image/webp,*/*;q=0.8").compression_id == "c-webp"
+    assert len(lookups) == 1
+
+    forget_negotiated_downloads("123")
+    assert negotiate_compression_download(download, "image/webp,*/*;q=0.8").compression_id == "c-webp"
+    assert len(lookups) == 2
@@ -1,20 +1,29 @@
 import pytest
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
 from pathlib import Path
 from datetime import datetime
 
 from utils.settings import current_settings
-from utils.db import create_user_image_compression_db, create_user_image_db, delete_user_image_compression_db, delete_user_image_db, get_db, get_user_image_compression_db, get_user_image_compressions_db, get_user_db, get_user_image_compression_count_db, get_user_image_db, get_user_image_count_db, get_user_images_db, init_db, set_db
-from utils.types import DATE_FORMAT, User, UserImage, UserImageCompression
+from utils.db import QuotaExceeded, close_db, compression_quota_exceeded_db, create_user_image_compression_db, create_user_image_db, delete_user_image_compression_db, delete_user_image_db, delete_user_images_db, get_db, get_compression_jobs_db, get_db_cache_stats, get_user_image_compression_db, get_user_image_compressions_db, get_user_image_compressions_page_db, get_user_counters_db, get_user_db, get_user_image_compression_count_db, get_user_image_db, get_user_image_count_db, get_user_images_db, get_user_images_page_db, init_db, open_db, set_compression_job_db, set_db, set_user_image_previews_db, store_compression_jobs_db
+from utils.types import DATE_FORMAT, JOB_PENDING, CompressionJob, User, UserImage, UserImageCompression
 
 test_db_path = f"{current_settings.base_path}/db-test.json"
+test_db_log_path = f"{test_db_path}.log"
+test_db_lock_path = f"{test_db_path}.lock"
 
 @pytest.fixture(scope='function')
 def db_resource(request):
     init_db(test_db_path, True)
 
     def db_teardown():
+        close_db(test_db_path)
         file = Path(test_db_path)
         file.unlink()
+        Path(test_db_log_path).unlink(missing_ok=True)
+        Path(test_db_lock_path).unlink(missing_ok=True)
 
     request.addfinalizer(db_teardown)
 
@@ -26,16 +35,25 @@ def test_init_db():
     init_db(test_db_path, True)
     dbJSON = get_db(test_db_path)
 
-    assert type(dbJSON) == dict
-    assert type(dbJSON["users"]) == dict
-    assert type(dbJSON["images"]) == dict
-    assert type(dbJSON["compressions"]) == dict
+    assert dbJSON["users"] == {}
+    assert dbJSON["images"] == {}
+    assert dbJSON["compressions"] == {}
 
     file = Path(test_db_path)
     file.unlink()
 
 def test_get_db(db_resource):
-    assert type(db_resource) == dict
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '123'))
+    dbJSON = get_db(test_db_path)
+
+    # shared between readers, so neither the document nor anything in it can be changed
+    with pytest.raises(TypeError):
+        dbJSON["users"] = {}
+    with pytest.raises(TypeError):
+        dbJSON["images"]["abc"]["123"]["name"] = "changed"
+    with pytest.raises(AttributeError):
+        dbJSON["images"]["abc"].pop("123")
+    assert get_user_image_db(dbJSON, 'abc', '123').name == make_test_image('abc', '123').name
 
 def test_set_db(db_resource):
     testKey = "test"
@@ -48,7 +66,6 @@ def test_set_db(db_resource):
     set_db(test_db_path, test_update)
 
     dbJSON = get_db(test_db_path)
-    assert type(dbJSON) == dict
     assert dbJSON[testKey] == testValue
 
 def test_get_user(db_resource):
@@ -214,6 +231,28 @@ def test_delete_user_image(db_resource):
     db_image = get_user_image_db(dbJSON, user_id, image_id)
     assert db_image is None
 
+def test_set_user_image_previews(db_resource):
+    user_id = 'abc'
+    image_id = '123'
+    image = UserImage(
+        user_id = user_id,
+        id = image_id,
+        path = "/",
+        name = "test image",
+        extension = 'png',
+        size = 10,
+        uploaded_at = "123",
+    )
+
+    create_user_image_db(test_db_path, user_id, image)
+    set_user_image_previews_db(test_db_path, user_id, image_id, { "128": "/128.webp" })
+    # previews finishing after their image was deleted must not recreate it
+    set_user_image_previews_db(test_db_path, user_id, "deleted", { "128": "/128.webp" })
+    dbJSON = get_db(test_db_path)
+
+    assert get_user_image_db(dbJSON, user_id, image_id).previews == { "128": "/128.webp" }
+    assert get_user_image_db(dbJSON, user_id, "deleted") is None
+
 def test_create_user_image_compression(db_resource):
     compression_id = 'abc'
     image_id = '123'
@@ -251,4 +290,219 @@ def test_delete_user_image_compression(db_resource):
     db_compression = get_user_image_compression_db(dbJSON, image_id, compression_id)
 
     assert db_compression is None
-  
\ No newline at end of file
+
+def make_test_image(user_id: str, image_id: str):
+    return UserImage(
+        user_id = user_id,
+        id = image_id,
+        path = "/",
+        name = "test image",
+        extension = 'png',
+        size = 10,
+        uploaded_at = "123",
+    )
+
+def test_db_read_cache(db_resource):
+    before = get_db_cache_stats(test_db_path)
+    first = get_db(test_db_path)
+    second = get_db(test_db_path)
+    after = get_db_cache_stats(test_db_path)
+
+    assert first is second
+    assert after["hits"] - before["hits"] == 2
+    assert after["misses"] == before["misses"]
+
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '123'))
+    third = get_db(test_db_path)
+
+    assert third is not second
+    assert get_user_image_db(third, 'abc', '123') is not None
+    assert get_user_image_db(second, 'abc', '123') is None
+
+def test_get_from_db_handle(db_resource):
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '123'))
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '456'))
+    compression = UserImageCompression(id = 'c1', image_id = '123', path = "/", quality = 10, created_at = "123")
+    create_user_image_compression_db(test_db_path, compression)
+    db = open_db(test_db_path)
+
+    assert get_user_image_db(db, 'abc', '123').id == '123'
+    assert get_user_image_db(db, 'abc', 'missing') is None
+    assert get_user_image_count_db(db, 'abc') == 2
+    assert set(get_user_images_db(db, 'abc')) == { '123', '456' }
+    assert get_user_image_compression_db(db, '123', 'c1').id == 'c1'
+    assert get_user_image_compression_count_db(db, '123') == 1
+    assert get_user_image_compression_count_db(db, '456') == 0
+
+def test_maintained_counters(db_resource):
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '123'))
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '456'))
+    # rewriting an existing record doesn't count it twice
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '456'))
+    compression = UserImageCompression(id = 'c1', image_id = '123', user_id = 'abc', path = "/", quality = 10, size = 5, created_at = "123")
+    create_user_image_compression_db(test_db_path, compression)
+    create_user_image_compression_db(test_db_path, compression)
+
+    db = open_db(test_db_path)
+    assert get_user_counters_db(db, 'abc') == { "images": 2, "bytes": 25 }
+    assert get_user_image_compression_count_db(db, '123') == 1
+
+    with pytest.raises(QuotaExceeded):
+        create_user_image_db(test_db_path, 'abc', make_test_image('abc', '789'), max_bytes=30)
+    with pytest.raises(QuotaExceeded):
+        create_user_image_db(test_db_path, 'abc', make_test_image('abc', '789'), max_images=1)
+    assert get_user_image_db(db, 'abc', '789') is None
+    with pytest.raises(QuotaExceeded):
+        create_user_image_compression_db(test_db_path, compression.model_copy(update={ "id": "c2" }), max_bytes=29)
+    # rewriting an existing compression isn't new bytes
+    create_user_image_compression_db(test_db_path, compression, max_bytes=25)
+    assert get_user_image_compression_db(db, '123', 'c2') is None
+
+    delete_user_image_compression_db(test_db_path, '123', 'c1')
+    delete_user_image_compression_db(test_db_path, '123', 'c1')
+    delete_user_image_db(test_db_path, 'abc', '456')
+    assert get_user_counters_db(db, 'abc') == { "images": 1, "bytes": 10 }
+    assert get_user_image_compression_count_db(db, '123') == 0
+
+    # collections written without counters are counted on first use
+    def test_update(dbJSON):
+        dbJSON["images"]["xyz"] = { '1': make_test_image('xyz', '1').model_dump(), '2': make_test_image('xyz', '2').model_dump() }
+        return dbJSON
+
+    set_db(test_db_path, test_update)
+    assert get_user_image_count_db(db, 'xyz') == 2
+    create_user_image_db(test_db_path, 'xyz', make_test_image('xyz', '3'))
+    assert get_user_counters_db(db, 'xyz') == { "images": 3, "bytes": 30 }
+
+def test_delete_user_images_cascade(db_resource):
+    for image_id in ('123', '456', '789'):
+        create_user_image_db(test_db_path, 'abc', make_test_image('abc', image_id))
+        compression = UserImageCompression(id = f"c-{image_id}", image_id = image_id, user_id = 'abc', path = "/", quality = 10, size = 5, blob_key = f"key-{image_id}", created_at = "123")
+        create_user_image_compression_db(test_db_path, compression)
+    job = CompressionJob(id = 'job', image_id = '123', user_id = 'abc', quality = 80, status = JOB_PENDING, created_at = "123")
+    set_compression_job_db(test_db_path, job)
+
+    deleted = delete_user_images_db(test_db_path, 'abc', ['123', '456', 'missing', '123'])
+
+    assert [(image.id, [compression.id for compression in compressions]) for image, compressions in deleted] == [('123', ['c-123']), ('456', ['c-456'])]
+    db = open_db(test_db_path)
+    assert set(get_user_images_db(db, 'abc')) == { '789' }
+    assert get_user_image_compressions_db(db, '123') == {}
+    assert get_compression_jobs_db(db, '123') == {}
+    assert get_user_image_compression_count_db(db, '123') == 0
+    assert get_user_counters_db(db, 'abc') == { "images": 1, "bytes": 15 }
+    assert get_db(test_db_path)["blobs"]["key-123"]["refs"] == {}
+
+    # work finishing after the delete doesn't resurrect the image's collections
+    create_user_image_compression_db(test_db_path, UserImageCompression(id = 'late', image_id = '123', user_id = 'abc', path = "/", quality = 10, created_at = "123"))
+    set_compression_job_db(test_db_path, job)
+    assert get_user_image_compressions_db(db, '123') == {}
+    assert get_compression_jobs_db(db, '123') == {}
+
+def test_store_compression_jobs_db(db_resource):
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '123'))
+    for i in range(3):
+        create_user_image_compression_db(test_db_path, UserImageCompression(id = f"c{i}", image_id = '123', user_id = 'abc', path = "/", quality = 10, created_at = "123"))
+    assert not compression_quota_exceeded_db(open_db(test_db_path), '123', 4)
+    assert compression_quota_exceeded_db(open_db(test_db_path), '123', 4, 2)
+
+    def build_jobs(reader):
+        # a lookup, then an insert if nothing matched; slow enough for the submissions to overlap
+        if len(get_compression_jobs_db(reader, '123')) > 0:
+            return []
+        time.sleep(0.05)
+        return [CompressionJob(id = f"{uuid.uuid4()}", image_id = '123', user_id = 'abc', quality = 80, status = JOB_PENDING, created_at = "123")]
+
+    with ThreadPoolExecutor(4) as pool:
+        for future in [pool.submit(store_compression_jobs_db, test_db_path, build_jobs) for _ in range(4)]:
+            future.result()
+
+    assert len(get_compression_jobs_db(open_db(test_db_path), '123')) == 1
+
+def run_stress_writes(backend: str, worker_id: str, count: int):
+    current_settings.db_backend = backend
+    current_settings.db_compact_threshold = 20
+
+    for i in range(count):
+        image_id = f"{worker_id}-{i}"
+        create_user_image_db(test_db_path, 'stress', make_test_image('stress', image_id))
+        compression = UserImageCompression(id = image_id, image_id = 'stress-image', path = "/", quality = 10, created_at = "123")
+        create_user_image_compression_db(test_db_path, compression)
+        if i % 2 == 0:
+            delete_user_image_db(test_db_path, 'stress', image_id)
+
+def run_stress_process(backend: str, worker_id: str, count: int):
+    run_stress_writes(backend, worker_id, count)
+    close_db(test_db_path)
+
+def test_concurrent_writes(db_resource, db_backend, monkeypatch):
+    monkeypatch.setattr(current_settings, "db_compact_threshold", 20)
+    workers = [f"p{i}" for i in range(4)]
+    threads = [f"t{i}" for i in range(4)]
+    count = 40
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(len(workers), mp_context=context) as processes, ThreadPoolExecutor(len(threads)) as pool:
+        futures = [processes.submit(run_stress_process, db_backend, worker, count) for worker in workers]
+        futures += [pool.submit(run_stress_writes, db_backend, thread, count) for thread in threads]
+        for future in futures:
+            future.result()
+
+    close_db(test_db_path)
+    db = open_db(test_db_path)
+    expected_images = { f"{worker}-{i}" for worker in workers + threads for i in range(count) if i % 2 == 1 }
+
+    assert set(get_user_images_db(db, 'stress')) == expected_images
+    assert get_user_image_compression_count_db(db, 'stress-image') == len(workers + threads) * count
+    # counters are updated in the same transaction as the records, so none are lost
+    assert get_user_counters_db(db, 'stress') == { "images": len(expected_images), "bytes": 10 * len(expected_images) }
+
+def test_get_user_images_page(db_resource):
+    for i, size in enumerate([30, 10, 50, 20, 40]):
+        image = make_test_image('abc', f"img{i}")
+        image.size = size
+        create_user_image_db(test_db_path, 'abc', image)
+    create_user_image_db(test_db_path, 'other', make_test_image('other', 'img9'))
+
+    def all_pages(sort, descending, limit):
+        db = open_db(test_db_path)
+        keys = []
+        page, cursor = get_user_images_page_db(db, 'abc', sort, descending, None, limit)
+        keys += [key for key, _ in page]
+        while cursor is not None:
+            page, cursor = get_user_images_page_db(db, 'abc', sort, descending, cursor, limit)
+            keys += [key for key, _ in page]
+        return keys
+
+    assert all_pages("size", False, 2) == ["img1", "img3", "img0", "img4", "img2"]
+    assert all_pages("size", True, 2) == ["img2", "img4", "img0", "img3", "img1"]
+
+    # the index follows later writes
+    image = make_test_image('abc', "img5")
+    image.size = 25
+    create_user_image_db(test_db_path, 'abc', image)
+    delete_user_image_db(test_db_path, 'abc', "img0")
+    assert all_pages("size", False, 4) == ["img1", "img3", "img5", "img4", "img2"]
+
+    with pytest.raises(ValueError):
+        _, cursor = get_user_images_page_db(open_db(test_db_path), 'abc', "size", False, None, 1)
+        get_user_images_page_db(open_db(test_db_path), 'abc', "name", False, cursor, 1)
+
+def test_get_compressions_page_missing_field(db_resource):
+    # records without the sort field sort last ascending (first descending) on both backends
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '123'))
+    for i, size in enumerate([30, None, 10, None, 20]):
+        create_user_image_compression_db(test_db_path, UserImageCompression(id = f"c{i}", image_id = '123', user_id = 'abc', path = "/", quality = 10, size = size, created_at = "123"))
+
+    def all_pages(descending, limit):
+        db = open_db(test_db_path)
+        page, cursor = get_user_image_compressions_page_db(db, '123', "size", descending, None, limit)
+        keys = [key for key, _ in page]
+        while cursor is not None:
+            page, cursor = get_user_image_compressions_page_db(db, '123', "size", descending, cursor, limit)
+            keys += [key for key, _ in page]
+        return keys
+
+    for limit in (1, 2, 10):
+        assert all_pages(False, limit) == ["c2", "c4", "c0", "c1", "c3"]
+        assert all_pages(True, limit) == ["c3", "c1", "c0", "c4", "c2"]
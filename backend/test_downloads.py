@@ -0,0 +1,99 @@
+import time
+import jwt
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from utils.auth import forget_signed_downloads, sign_image_url, sign_image_urls, signed_url_expiry, verify_signed_download
+from utils.downloads import accept_quality, cached_file_response, parse_byte_range
+from utils.settings import current_settings
+from utils.types import SignedDownload, UserImage
+
+test_file_path = "./test-image.png"
+
+app = FastAPI()
+
+@app.get("/file")
+async def get_file(request: Request):
+    return cached_file_response(request, test_file_path, "abc", time.time() + 60)
+
+client = TestClient(app)
+
+def test_parse_byte_range():
+    assert parse_byte_range("bytes=0-99", 1000) == (0, 99)
+    assert parse_byte_range("bytes=900-", 1000) == (900, 999)
+    assert parse_byte_range("bytes=-100", 1000) == (900, 999)
+    assert parse_byte_range("bytes=500-5000", 1000) == (500, 999)
+    # unsatisfiable, open-ended or not
+    assert parse_byte_range("bytes=1000-", 1000) == (1000, 1000)
+    assert parse_byte_range("bytes=1000-2000", 1000) == (1000, 2000)
+    assert parse_byte_range("bytes=0-1,5-6", 1000) is None
+    assert parse_byte_range("items=0-1", 1000) is None
+
+def test_accept_quality():
+    accept = "image/avif,image/webp,image/*;q=0.9,*/*;q=0.5"
+
+    assert accept_quality(accept, "image/avif") == 1.0
+    assert accept_quality(accept, "image/png") == 0.9
+    assert accept_quality(accept, "text/plain") == 0.5
+    assert accept_quality("image/webp;q=0,image/*", "image/webp") == 0.0
+    assert accept_quality("image/png", "image/webp") == 0.0
+    assert accept_quality(None, "image/webp") == 1.0
+
+def test_cached_file_response():
+    with open(test_file_path, "rb") as file:
+        content = file.read()
+
+    response = client.get("/file")
+    assert response.status_code == 200
+    assert response.content == content
+    assert response.headers["etag"] == '"abc"'
+    assert "immutable" in response.headers["cache-control"]
+
+    response = client.get("/file", headers={ "If-None-Match": '"abc"' })
+    assert response.status_code == 304
+    assert response.content == b""
+
+    response = client.get("/file", headers={ "Range": "bytes=10-19" })
+    assert response.status_code == 206
+    assert response.content == content[10:20]
+    assert response.headers["content-range"] == f"bytes 10-19/{len(content)}"
+
+    # a stale If-Range means the cached part is from other bytes, so send all of them
+    response = client.get("/file", headers={ "Range": "bytes=10-19", "If-Range": '"other"' })
+    assert response.status_code == 200
+    assert response.content == content
+
+    response = client.get("/file", headers={ "Range": f"bytes={len(content)}-" })
+    assert response.status_code == 416
+
+def test_signed_url_expiry_is_shared():
+    period = current_settings.signed_image_expiry_minutes * 60
+    expiry = signed_url_expiry()
+
+    assert expiry % period == 0
+    assert expiry - time.time() >= period
+
+def test_verify_signed_download_cache():
+    image = UserImage(id = "img", user_id = "abc", path = test_file_path, name = "test", extension = "png", size = 10, uploaded_at = "123")
+    images = sign_image_urls([image, image.model_copy()])
+
+    # one bucket, one signature per file
+    assert images[0].signed_url == images[1].signed_url == sign_image_url(image)
+
+    resolved = []
+    def resolve(decoded):
+        resolved.append(decoded)
+        return SignedDownload(user_id = decoded["user_id"], image_id = decoded["image_id"], path = test_file_path, expires_at = decoded["exp"])
+
+    signature = image.signed_url.split("signature=")[1]
+    assert verify_signed_download("/image", signature, resolve).path == test_file_path
+    assert verify_signed_download("/image", signature, resolve).path == test_file_path
+    assert len(resolved) == 1
+
+    forget_signed_downloads("img")
+    verify_signed_download("/image", signature, resolve)
+    assert len(resolved) == 2
+
+    with pytest.raises(jwt.InvalidSignatureError):
+        verify_signed_download("/image", signature[:-4] + "AAAA", resolve)
@@ -0,0 +1,118 @@
+import pytest
+import os
+import shutil
+from pathlib import Path
+
+from utils.db import close_db, create_user_image_compression_db, create_user_image_db, get_compression_blob_db, get_user_image_compression_db, get_user_image_compressions_db, get_user_image_db, get_user_images_db, init_db, open_db, set_user_image_previews_db
+from utils.filestore_gc import FilestoreScanner
+from utils.filestore_migrate import migrate_filestore
+from utils.reaper import shutdown_file_reaper
+from utils.settings import current_settings
+from utils.types import UserImage, UserImageCompression
+
+test_filestore_dir = f"{current_settings.base_path}/filestore-test"
+test_db_path = f"{current_settings.base_path}/db-test.json"
+test_checkpoint_path = f"{current_settings.base_path}/filestore-gc-test.json"
+
+@pytest.fixture(scope='function')
+def gc_resource(request, monkeypatch):
+    monkeypatch.setattr(current_settings, "db_file_path", test_db_path)
+    init_db(test_db_path, True)
+    os.makedirs(test_filestore_dir, exist_ok=True)
+
+    def teardown():
+        shutdown_file_reaper()
+        close_db(test_db_path)
+        for file_path in (test_db_path, f"{test_db_path}.log", f"{test_db_path}.lock", test_checkpoint_path):
+            Path(file_path).unlink(missing_ok=True)
+        for entry in os.listdir(test_filestore_dir):
+            shutil.rmtree(f"{test_filestore_dir}/{entry}")
+
+    request.addfinalizer(teardown)
+
+def write_file(file_path: str, age_seconds: float = 7200) -> str:
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "wb") as file:
+        file.write(b"x" * 10)
+    mtime = os.stat(file_path).st_mtime - age_seconds
+    os.utime(file_path, (mtime, mtime))
+    return file_path
+
+def add_image(user_id: str, image_id: str, image_path: str):
+    create_user_image_db(test_db_path, user_id, UserImage(id = image_id, user_id = user_id, path = image_path, name = "test image", extension = "png", size = 10, uploaded_at = "123"))
+
+def test_scan_reports_and_reclaims(gc_resource):
+    kept = write_file(f"{test_filestore_dir}/u1/kept.png")
+    add_image("u1", "kept", kept)
+    sharded = write_file(f"{test_filestore_dir}/images/ab/cd/abcd.png")
+    add_image("u1", "abcd", sharded)
+    sharded_orphan = write_file(f"{test_filestore_dir}/images/ab/cd/abcd-128.webp")
+    orphan = write_file(f"{test_filestore_dir}/u1/compressions/orphan.png")
+    recent = write_file(f"{test_filestore_dir}/u1/recent.png", age_seconds=0)
+    stale_blob = write_file(f"{test_filestore_dir}/blobs/ab/abcd.png")
+    add_image("u2", "gone", f"{test_filestore_dir}/u2/gone.png")
+    # stored paths aren't always normalized
+    create_user_image_compression_db(test_db_path, UserImageCompression(id = "c1", image_id = "kept", user_id = "u1", path = f"/{test_filestore_dir}/u1/compressions//missing.png", quality = 10, created_at = "123"))
+
+    report = FilestoreScanner(test_filestore_dir, test_db_path, test_checkpoint_path).run()
+
+    assert report["complete"]
+    assert sorted(report["orphaned_files"]) == sorted([os.path.realpath(orphan), os.path.realpath(stale_blob), os.path.realpath(sharded_orphan)])
+    assert report["dangling_images"] == [["u2", "gone"]]
+    assert report["dangling_compressions"] == [["kept", "c1"]]
+    # report only by default
+    assert os.path.exists(orphan)
+
+    FilestoreScanner(test_filestore_dir, test_db_path, test_checkpoint_path, reclaim=True).run()
+    shutdown_file_reaper()
+
+    db = open_db(test_db_path)
+    assert not any(os.path.exists(file_path) for file_path in (orphan, stale_blob, sharded_orphan))
+    assert os.path.exists(kept) and os.path.exists(recent) and os.path.exists(sharded)
+    assert get_user_images_db(db, "u2") == {}
+    assert get_user_image_compressions_db(db, "kept") == {}
+
+def test_scan_resumes_from_checkpoint(gc_resource):
+    for user in ("u1", "u2", "u3"):
+        write_file(f"{test_filestore_dir}/{user}/orphan.png")
+
+    scanner = FilestoreScanner(test_filestore_dir, test_db_path, test_checkpoint_path)
+    first = scanner.run(max_entries=1)
+    assert not first["complete"]
+    assert first["orphaned_files"] == [os.path.realpath(f"{test_filestore_dir}/u1/orphan.png")]
+
+    rest = FilestoreScanner(test_filestore_dir, test_db_path, test_checkpoint_path).run()
+    assert rest["complete"]
+    assert rest["orphaned_files"] == [os.path.realpath(f"{test_filestore_dir}/{user}/orphan.png") for user in ("u2", "u3")]
+
+    # the next run starts a new pass
+    assert len(FilestoreScanner(test_filestore_dir, test_db_path, test_checkpoint_path).run(max_entries=1)["orphaned_files"]) == 1
+
+def test_migrate_to_sharded_layout(gc_resource):
+    image_id = "abcd1234"
+    original = write_file(f"{test_filestore_dir}/u1/test-image-123.png")
+    add_image("u1", image_id, original)
+    preview = write_file(f"{test_filestore_dir}/u1/previews/{image_id}-128.webp")
+    set_user_image_previews_db(test_db_path, "u1", image_id, { "128": preview })
+    legacy = write_file(f"{test_filestore_dir}/u1/compressions/small.png")
+    create_user_image_compression_db(test_db_path, UserImageCompression(id = "ef567890", image_id = image_id, user_id = "u1", path = f"/{legacy}", quality = 10, created_at = "123"))
+    blob = write_file(f"{test_filestore_dir}/blobs/12/123456.png")
+    create_user_image_compression_db(test_db_path, UserImageCompression(id = "c2", image_id = image_id, user_id = "u1", path = blob, blob_key = "123456", quality = 10, created_at = "123"))
+
+    assert migrate_filestore(test_filestore_dir, test_db_path, dry_run=True)["files"] == 4
+
+    migrate_filestore(test_filestore_dir, test_db_path, batch_size=2)
+
+    db = open_db(test_db_path)
+    image = get_user_image_db(db, "u1", image_id)
+    assert image.path == f"{test_filestore_dir}/images/ab/cd/{image_id}.png"
+    assert image.previews == { "128": f"{test_filestore_dir}/images/ab/cd/{image_id}-128.webp" }
+    assert get_user_image_compression_db(db, image_id, "ef567890").path == f"{test_filestore_dir}/images/ef/56/ef567890.png"
+    assert get_user_image_compression_db(db, image_id, "c2").path == f"{test_filestore_dir}/blobs/12/34/123456.png"
+    assert get_compression_blob_db(db, "123456")["path"] == f"{test_filestore_dir}/blobs/12/34/123456.png"
+    for file_path in [image.path, *image.previews.values(), f"{test_filestore_dir}/images/ef/56/ef567890.png", f"{test_filestore_dir}/blobs/12/34/123456.png"]:
+        assert os.path.exists(file_path)
+    assert not any(os.path.exists(file_path) for file_path in (original, preview, legacy, blob))
+
+    # nothing left to do on a second run
+    assert migrate_filestore(test_filestore_dir, test_db_path)["records"] == 0
@@ -1,20 +1,47 @@
+import io
+import os
+import time
 import pytest
 from os import path, rmdir
 from pathlib import Path
 from fastapi import UploadFile
+from PIL import Image
 
-from utils.types import User
-from utils.image import create_and_store_user_image_compression, delete_user_image_compression_fs, delete_user_image_fs, store_user_image, validate_nested_subdirectory
+from utils.types import CompressionVariant, User, UserImage
+from utils.db import close_db, create_user_image_compression_db, delete_orphaned_compression_blob_db, get_compression_blobs_db, create_user_image_db, get_user_images_db, delete_user_image_compression_db, init_db, open_db
+from utils.image import ByteBudgetUnreachable, ImageTooLarge, InvalidImageUpload, create_and_store_user_image_compression, create_and_store_user_image_compressions, choose_quality, create_user_image_previews, delete_user_image_compression_fs, delete_user_image_fs, delete_user_images, OUTPUT_FORMATS, encode_image, evict_orphaned_compression_blobs, find_cached_user_image_compression, resize_image, store_user_image, store_user_image_stream, validate_nested_subdirectory
+from utils.reaper import shutdown_file_reaper
 from utils.settings import current_settings
 
 test_filestore_dir = f"{current_settings.base_path}/filestore-test"
+test_db_path = f"{current_settings.base_path}/db-test.json"
 test_user_id = "123"
 
+@pytest.fixture(scope='function')
+def image_db_resource(request, monkeypatch):
+    monkeypatch.setattr(current_settings, "db_file_path", test_db_path)
+    monkeypatch.setattr(current_settings, "compression_cache_grace_seconds", current_settings.compression_cache_grace_seconds)
+    init_db(test_db_path, True)
+
+    def db_teardown():
+        close_db(test_db_path)
+        for suffix in ("", ".log", ".lock"):
+            Path(f"{test_db_path}{suffix}").unlink(missing_ok=True)
+
+    request.addfinalizer(db_teardown)
+
+def remove_empty_dirs(root: str):
+    # shards are created on demand, so tests clean up the (now empty) ones they made
+    for dir_path, _, _ in sorted(os.walk(root), key=lambda entry: len(entry[0]), reverse=True):
+        if dir_path != root:
+            Path(dir_path).rmdir()
+
 @pytest.fixture(scope='function')
 def fs_resource(request):
     validate_nested_subdirectory(test_filestore_dir)
 
     def fs_teardown():
+        remove_empty_dirs(test_filestore_dir)
         file = Path(test_filestore_dir)
         file.rmdir()
 
@@ -50,11 +77,42 @@ def test_store_user_image(fs_resource):
 
         assert path.exists(image.path)
 
+        # stored byte for byte, with the size counted while streaming
+        assert image.size == path.getsize('./test-image.png')
+        file.seek(0)
+        with open(image.path, 'rb') as stored:
+            assert stored.read() == file.read()
+        assert image.width is not None and image.height is not None
+
         file = Path(image.path)
         file.unlink()
-        user_dir = Path(f"{test_filestore_dir}/{test_user.id}")
-        user_dir.rmdir()
+        remove_empty_dirs(test_filestore_dir)
+
+def test_store_user_image_stream_rejects(fs_resource, monkeypatch):
+    test_user = User(
+       id = test_user_id,
+       username = "test-user" 
+    )
 
+    with open('./test-image.png', 'rb') as file:
+        with pytest.raises(InvalidImageUpload):
+            store_user_image_stream(test_filestore_dir, test_user, 'test-image', file, 'jpeg')
+
+        file.seek(0)
+        with pytest.raises(ImageTooLarge):
+            store_user_image_stream(test_filestore_dir, test_user, 'test-image', file, 'png', max_size=100)
+
+    with pytest.raises(InvalidImageUpload):
+        store_user_image_stream(test_filestore_dir, test_user, 'test-image', io.BytesIO(b"\x89PNG\r\n\x1a\n" + b"\x00" * 64), 'png')
+
+    # too many pixels is refused from the header, however small the file
+    monkeypatch.setattr(current_settings, "max_image_pixels", 100)
+    with open('./test-image.png', 'rb') as file:
+        with pytest.raises(ImageTooLarge):
+            store_user_image_stream(test_filestore_dir, test_user, 'test-image', file, 'png')
+
+    # nothing is left behind by rejected uploads
+    assert [files for _, _, files in os.walk(test_filestore_dir) if len(files) > 0] == []
 
 
 
@@ -75,10 +133,13 @@ def test_delete_user_image_from_fs():
 
         assert not path.exists(image.path)
 
-        user_dir = Path(f"{test_filestore_dir}/{test_user.id}")
-        user_dir.rmdir()
+        remove_empty_dirs(test_filestore_dir)
 
 
+def remove_compression_blob(image_compression):
+    Path(image_compression.path).unlink(missing_ok=True)
+    remove_empty_dirs(test_filestore_dir)
+
 def test_store_user_image_compression():
     test_user = User(
        id = test_user_id,
@@ -95,17 +156,13 @@ def test_store_user_image_compression():
         image_compression = create_and_store_user_image_compression(test_filestore_dir, test_user, image, quality=85, resize_width = 20)
 
         assert path.exists(image_compression.path)
+        assert image_compression.blob_key is not None
 
         image_file = Path(image.path, missing_ok=True)
         image_file.unlink()
-        file = Path(image_compression.path, missing_ok=True)
-        file.unlink()
-        compression_dir = Path(f"{test_filestore_dir}/{test_user.id}/compressions", missing_ok=True)
-        compression_dir.rmdir()
-        user_dir = Path(f"{test_filestore_dir}/{test_user.id}", missing_ok=True)
-        user_dir.rmdir()
+        remove_compression_blob(image_compression)
 
-def test_delete_user_image_compression_from_fs():
+def test_delete_user_image_compression_from_fs(image_db_resource):
     test_user = User(
        id = test_user_id,
        username = "test-user" 
@@ -119,13 +176,216 @@ def test_delete_user_image_compression_from_fs():
 
         image = store_user_image(test_filestore_dir, test_user, file_name, upload_file, file_extension)
         image_compression = create_and_store_user_image_compression(test_filestore_dir, test_user, image, quality=85, resize_width = 20)
+        create_user_image_compression_db(test_db_path, image_compression)
+
+        # the same source and parameters share the blob instead of re-encoding
+        cached = find_cached_user_image_compression(test_filestore_dir, open_db(test_db_path), image, quality=85, resize_width = 20)
+        assert cached.path == image_compression.path
+        assert cached.id != image_compression.id
+
+        delete_user_image_compression_db(test_db_path, image.id, image_compression.id)
         delete_user_image_compression_fs(image_compression)
 
-        assert not path.exists(f"{test_filestore_dir}/{image_compression.path}")
+        # unreferenced blobs are kept as cache until they exceed the budget
+        shutdown_file_reaper()
+        assert path.exists(image_compression.path)
+
+        current_settings.compression_cache_grace_seconds = 0
+        # used after the cutoff (e.g. since the orphans were listed), the blob stays
+        assert delete_orphaned_compression_blob_db(test_db_path, image_compression.blob_key, time.time() - 60) is False
+        assert evict_orphaned_compression_blobs(test_db_path, max_bytes=0) == [image_compression.blob_key]
+        assert not path.exists(image_compression.path)
+        assert find_cached_user_image_compression(test_filestore_dir, open_db(test_db_path), image, quality=85, resize_width = 20) is None
 
         image_file = Path(image.path, missing_ok=True)
         image_file.unlink()
-        compression_dir = Path(f"{test_filestore_dir}/{test_user.id}/compressions", missing_ok=True)
-        compression_dir.rmdir()
-        user_dir = Path(f"{test_filestore_dir}/{test_user.id}", missing_ok=True)
-        user_dir.rmdir()
+        remove_compression_blob(image_compression)
+
+def test_resize_image_draft_jpeg():
+    source = io.BytesIO()
+    Image.new("RGB", (2400, 1600), "red").save(source, format="JPEG")
+    source.seek(0)
+
+    with Image.open(source) as img:
+        resized = resize_image(img, 300, "lanczos")
+
+        # decoded at reduced scale, but still resized to exactly the requested width
+        assert img.size == (300, 200)
+        assert resized.size == (300, 200)
+
+def test_create_user_image_previews(fs_resource):
+    test_user = User(
+       id = test_user_id,
+       username = "test-user" 
+    )
+
+    with open('./test-image.png', 'rb') as file:
+        image = store_user_image(test_filestore_dir, test_user, 'test-image', UploadFile(file), 'png')
+
+    previews = create_user_image_previews(test_filestore_dir, image, [16, 64])
+    image.previews = previews
+
+    assert set(previews.keys()) == {"16", "64"}
+    for size, preview in previews.items():
+        with Image.open(preview) as img:
+            assert img.format == "WEBP"
+            assert max(img.size) <= int(size)
+
+    delete_user_image_fs(image)
+    assert not any(path.exists(preview) for preview in previews.values())
+
+def test_delete_user_images(image_db_resource):
+    test_user = User(
+       id = test_user_id,
+       username = "test-user" 
+    )
+
+    with open('./test-image.png', 'rb') as file:
+        image = store_user_image(test_filestore_dir, test_user, 'test-image', UploadFile(file), 'png')
+    create_user_image_db(test_db_path, test_user.id, image)
+    image_compression = create_and_store_user_image_compression(test_filestore_dir, test_user, image, quality=85, resize_width = 20)
+    create_user_image_compression_db(test_db_path, image_compression)
+
+    deleted = delete_user_images(test_user.id, [image.id])
+    assert [deleted_image.id for deleted_image in deleted] == [image.id]
+    assert get_user_images_db(open_db(test_db_path), test_user.id) == {}
+
+    # shutting the reaper down drains its queue. The blob was used within the grace
+    # period so it is kept, until eviction runs past it
+    shutdown_file_reaper()
+    assert not path.exists(image.path)
+    assert path.exists(image_compression.path)
+    current_settings.compression_cache_grace_seconds = 0
+    assert evict_orphaned_compression_blobs(test_db_path, max_bytes=0) == [image_compression.blob_key]
+
+    # past the grace period, the blob goes with the image that last referenced it
+    with open('./test-image.png', 'rb') as file:
+        image = store_user_image(test_filestore_dir, test_user, 'test-image', UploadFile(file), 'png')
+    create_user_image_db(test_db_path, test_user.id, image)
+    image_compression = create_and_store_user_image_compression(test_filestore_dir, test_user, image, quality=85, resize_width = 20)
+    create_user_image_compression_db(test_db_path, image_compression)
+    time.sleep(0.01)
+    delete_user_images(test_user.id, [image.id])
+    shutdown_file_reaper()
+    assert not path.exists(image_compression.path)
+    assert get_compression_blobs_db(open_db(test_db_path)) == {}
+
+    remove_empty_dirs(test_filestore_dir)
+
+def test_encode_image_output_formats(tmp_path):
+    # some texture, a flat gradient compresses better losslessly than lossy
+    noise = Image.effect_noise((64, 64), 40).resize((256, 256), Image.Resampling.BICUBIC)
+    gradient = Image.linear_gradient("L").resize((256, 256))
+    img = Image.merge("RGBA", (noise, gradient, noise.rotate(90), Image.new("L", (256, 256), 200)))
+
+    sizes = {}
+    for output_format, pil_format in OUTPUT_FORMATS.items():
+        for quality in (30, 100):
+            save_path = tmp_path / f"{quality}.{output_format}"
+            encode_image(img, output_format, quality, str(save_path))
+            with Image.open(save_path) as encoded:
+                assert encoded.format == pil_format
+                assert encoded.size == img.size
+            sizes[(output_format, quality)] = save_path.stat().st_size
+
+    # quality matters for every format, including PNG's palette
+    for output_format in OUTPUT_FORMATS:
+        assert sizes[(output_format, 30)] < sizes[(output_format, 100)]
+    with Image.open(tmp_path / "30.png") as encoded:
+        assert encoded.mode == "P"
+    with Image.open(tmp_path / "100.jpeg") as encoded:
+        assert encoded.info.get("progressive") == 1
+
+    # modes PNG can't store are converted, e.g. from a CMYK JPEG
+    for output_format in OUTPUT_FORMATS:
+        for quality in (30, 100):
+            save_path = tmp_path / f"cmyk-{quality}.{output_format}"
+            encode_image(Image.new("CMYK", (32, 32), (0, 255, 255, 0)), output_format, quality, str(save_path))
+            with Image.open(save_path) as encoded:
+                assert encoded.convert("RGB").getpixel((0, 0))[0] > 200
+
+def test_create_and_store_user_image_compressions(tmp_path, monkeypatch):
+    source_path = tmp_path / "source.jpeg"
+    Image.effect_noise((1200, 800), 40).convert("RGB").save(source_path, format="JPEG")
+    test_user = User(id = test_user_id, username = "test-user")
+    image = UserImage(id = "abcd1234", user_id = test_user.id, path = str(source_path), name = "source", extension = "jpeg", size = source_path.stat().st_size, uploaded_at = "", hash = "source-hash")
+    variants = [
+        CompressionVariant(quality = 70, resize_width = 300),
+        CompressionVariant(quality = 80, resize_width = 600, output_format = "webp"),
+        CompressionVariant(quality = 70, resize_width = 300),
+        CompressionVariant(quality = 50, resize_width = 150, output_format = "png"),
+        CompressionVariant(quality = 60),
+    ]
+
+    opened = []
+    open_image = Image.open
+    monkeypatch.setattr(Image, "open", lambda *args, **kwargs: opened.append(args[0]) or open_image(*args, **kwargs))
+
+    compressions = create_and_store_user_image_compressions(str(tmp_path), test_user, image, variants)
+    # one decode for every variant, and the duplicate shares its blob
+    assert opened == [image.path]
+    assert compressions[0].path == compressions[2].path
+    assert len(set(compression.path for compression in compressions)) == 4
+
+    monkeypatch.setattr(Image, "open", open_image)
+    for variant, compression in zip(variants, compressions):
+        with Image.open(compression.path) as img:
+            assert img.size[0] == (variant.resize_width or 1200)
+            assert img.format == (variant.output_format or "jpeg").upper()
+        assert compression.size == path.getsize(compression.path)
+
+    # existing blobs are reused without opening the source again
+    opened.clear()
+    monkeypatch.setattr(Image, "open", lambda *args, **kwargs: opened.append(args[0]) or open_image(*args, **kwargs))
+    assert [compression.path for compression in create_and_store_user_image_compressions(str(tmp_path), test_user, image, variants)] == [compression.path for compression in compressions]
+    assert opened == []
+
+def test_auto_quality(tmp_path, monkeypatch):
+    noise = Image.effect_noise((160, 120), 60).resize((640, 480), Image.Resampling.BICUBIC)
+    img = Image.merge("RGB", (noise, Image.linear_gradient("L").resize((640, 480)), noise.rotate(180)))
+
+    # a stricter target needs a higher quality
+    loose = choose_quality(img, "jpeg", CompressionVariant(quality = 95, target_ssim = 0.9))
+    strict = choose_quality(img, "jpeg", CompressionVariant(quality = 95, target_ssim = 0.98))
+    assert strict.ssim >= 0.98 and loose.ssim >= 0.9
+    assert loose.quality <= strict.quality
+
+    # a byte budget alone takes the highest quality that fits, and wins over a target
+    budget = len(strict.data) - 1
+    fitted = choose_quality(img, "webp", CompressionVariant(quality = 95, max_bytes = budget))
+    assert len(fitted.data) <= budget
+    assert len(choose_quality(img, "jpeg", CompressionVariant(quality = 95, target_ssim = 0.98, max_bytes = budget)).data) <= budget
+    # a budget not even the lowest quality fits is an error, not an oversized result
+    with pytest.raises(ByteBudgetUnreachable):
+        choose_quality(img, "jpeg", CompressionVariant(quality = 95, max_bytes = 100))
+
+    # only the chosen encode is written, to the blob of the quality it settled on
+    source_path = tmp_path / "source.jpeg"
+    img.save(source_path, format="JPEG", quality=95)
+    test_user = User(id = test_user_id, username = "test-user")
+    image = UserImage(id = "abcd1234", user_id = test_user.id, path = str(source_path), name = "source", extension = "jpeg", size = source_path.stat().st_size, uploaded_at = "", hash = "source-hash")
+    compression = create_and_store_user_image_compression(str(tmp_path), test_user, image, quality = 95, target_ssim = 0.98)
+    assert compression.ssim >= 0.98 and compression.quality <= 95
+    assert create_and_store_user_image_compression(str(tmp_path), test_user, image, quality = compression.quality).path == compression.path
+    assert [file.name for file in tmp_path.rglob("*.jpeg") if file != source_path] == [path.basename(compression.path)]
+
+def test_animated_compressions(tmp_path):
+    frames = [Image.linear_gradient("L").rotate(angle).resize((320, 240)).convert("RGB") for angle in (0, 90, 90, 180)]
+    source_path = tmp_path / "source.gif"
+    frames[0].save(source_path, save_all=True, append_images=frames[1:], duration=100, loop=0)
+    test_user = User(id = test_user_id, username = "test-user")
+    image = UserImage(id = "abcd1234", user_id = test_user.id, path = str(source_path), name = "source", extension = "gif", size = source_path.stat().st_size, uploaded_at = "", hash = "source-hash")
+    variants = [
+        CompressionVariant(quality = 50, resize_width = 160),
+        CompressionVariant(quality = 70, resize_width = 160, output_format = "webp"),
+        CompressionVariant(quality = 70, output_format = "jpeg"),
+        CompressionVariant(quality = 90, target_ssim = 0.9, output_format = "webp"),
+    ]
+
+    compressions = create_and_store_user_image_compressions(str(tmp_path), test_user, image, variants)
+    # GIF and WebP keep the animation, minus the repeated frame
+    for compression, n_frames in zip(compressions, (3, 3, 1, 3)):
+        with Image.open(compression.path) as img:
+            assert getattr(img, "n_frames", 1) == n_frames
+            assert img.size[0] == (compression.resize_width or 320)
+    assert compressions[3].ssim >= 0.9
@@ -0,0 +1,103 @@
+import io
+
+from PIL import Image, ImageDraw, ImageSequence
+
+from utils.image_animation import has_alpha, is_animated, write_gif_animation, write_webp_animation
+
+def make_animation(alpha=False, size=(120, 90)) -> list:
+    # a square moving across a gradient, the third frame repeating the second
+    frames = []
+    for step in (0, 1, 1, 2):
+        frame = Image.linear_gradient("L").resize(size).convert("RGBA" if alpha else "RGB")
+        if alpha:
+            frame.putalpha(Image.new("L", size, 255))
+            ImageDraw.Draw(frame).rectangle((0, 0, 20, 20), fill=(0, 0, 0, 0))
+        ImageDraw.Draw(frame).rectangle((30 + step * 20, 30, 50 + step * 20, 50), fill=(255, 0, 0, 255))
+        frames.append(frame)
+    return frames
+
+def save_gif(frames: list) -> Image.Image:
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format="GIF", save_all=True, append_images=frames[1:], duration=[100, 200, 300, 400], loop=0, optimize=False)
+    buffer.seek(0)
+    return Image.open(buffer)
+
+def frame_durations(img: Image.Image) -> list:
+    durations = []
+    for frame in ImageSequence.Iterator(img):
+        # WebP only reads a frame's timestamp when it's decoded
+        frame.load()
+        durations.append(frame.info.get("duration"))
+    return durations
+
+def test_write_gif_animation_merges_duplicates():
+    source = save_gif(make_animation())
+    assert is_animated(source) and not has_alpha(source)
+
+    output = io.BytesIO()
+    assert write_gif_animation(source, lambda frame: frame.resize((60, 45)), 64, output) == 3
+
+    with Image.open(output) as img:
+        assert img.size == (60, 45)
+        assert img.info["loop"] == 0
+        assert frame_durations(img) == [100, 500, 400]
+        # later frames only carry the region that changed
+        img.seek(2)
+        assert img.dispose_extent != (0, 0, 60, 45)
+        assert img.convert("RGB").getpixel((40, 20))[0] > 200
+
+def test_write_gif_animation_keeps_transparency():
+    source = save_gif(make_animation(alpha=True))
+    assert has_alpha(source)
+
+    output = io.BytesIO()
+    write_gif_animation(source, lambda frame: frame, 32, output)
+    with Image.open(output) as img:
+        for frame in ImageSequence.Iterator(img):
+            rgba = frame.convert("RGBA")
+            assert rgba.getpixel((5, 5))[3] == 0
+            assert rgba.getpixel((100, 80))[3] == 255
+
+def test_write_webp_animation():
+    source = save_gif(make_animation())
+    output = io.BytesIO()
+    assert write_webp_animation(source, lambda frame: frame.resize((60, 45)), output, 70, 4) == 3
+
+    with Image.open(output) as img:
+        assert img.format == "WEBP" and img.size == (60, 45)
+        assert img.n_frames == 3
+        assert frame_durations(img) == [100, 500, 400]
+
+def test_write_webp_animation_keeps_transparency():
+    source = save_gif(make_animation(alpha=True))
+    output = io.BytesIO()
+    assert write_webp_animation(source, lambda frame: frame, output, 70, 4) == 3
+
+    with Image.open(output) as img:
+        assert img.n_frames == 3
+        for frame in ImageSequence.Iterator(img):
+            rgba = frame.convert("RGBA")
+            assert rgba.getpixel((5, 5))[3] == 0
+            assert rgba.getpixel((100, 80))[3] == 255
+        # the last frame only carries the square that moved, on the previous canvas
+        img.seek(2)
+        red, green, _ = img.convert("RGB").getpixel((75, 40))
+        assert red > 200 and green < 60
+        red, green, _ = img.convert("RGB").getpixel((45, 40))
+        assert abs(red - green) < 30
+
+def test_write_gif_animation_samples_palette():
+    # the first frames are gray, the last one blue, which a first-frame palette lacks
+    frames = [Image.linear_gradient("L").resize((64, 64)).convert("RGB") for _ in range(5)]
+    frames.append(Image.new("RGB", (64, 64), (0, 0, 255)))
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format="GIF", save_all=True, append_images=frames[1:], duration=100, loop=0)
+    buffer.seek(0)
+
+    output = io.BytesIO()
+    with Image.open(buffer) as source:
+        assert write_gif_animation(source, lambda frame: frame, 16, output) == 2
+
+    with Image.open(output) as img:
+        img.seek(1)
+        assert img.convert("RGB").getpixel((32, 32)) == (0, 0, 255)
@@ -0,0 +1,60 @@
+import pytest
+from PIL import Image, ImageChops
+
+from utils.image_memory import ImageOverMemoryBudget, decoded_bytes, estimate_decoded_bytes, iter_png_strips, load_within_budget
+
+def make_texture(size=(300, 200)) -> Image.Image:
+    noise = Image.effect_noise((size[0] // 4, size[1] // 4), 50).resize(size, Image.Resampling.BICUBIC)
+    return Image.merge("RGB", (noise, Image.linear_gradient("L").resize(size), noise.rotate(180)))
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L", "LA", "P"])
+def test_iter_png_strips_matches_full_decode(tmp_path, mode):
+    source = make_texture()
+    source = source.convert("P", palette=Image.Palette.ADAPTIVE) if mode == "P" else source.convert(mode)
+    source.save(tmp_path / "source.png")
+
+    with Image.open(tmp_path / "source.png") as full:
+        full.load()
+        strips = list(iter_png_strips(str(tmp_path / "source.png"), 7))
+        assert sum(strip.size[1] for strip in strips) == full.size[1]
+
+        top = 0
+        for strip in strips:
+            expected = full.crop((0, top, full.size[0], top + strip.size[1]))
+            assert ImageChops.difference(strip.convert("RGBA"), expected.convert("RGBA")).getbbox() is None
+            top += strip.size[1]
+
+def test_estimate_decoded_bytes_uses_header(tmp_path):
+    make_texture((1600, 1200)).save(tmp_path / "source.jpeg")
+    with Image.open(tmp_path / "source.jpeg") as img:
+        assert estimate_decoded_bytes(img) == 1600 * 1200 * 4
+        # drafted at 1/4 for a 400px wide target
+        assert estimate_decoded_bytes(img, 400) == 400 * 300 * 4
+        assert img.tile != []
+
+def test_load_within_budget(tmp_path):
+    source = make_texture((1200, 800))
+    source.save(tmp_path / "source.png")
+    source.save(tmp_path / "source.jpeg")
+    budget = decoded_bytes("RGBA", (1200, 800)) // 5
+
+    with Image.open(tmp_path / "source.png") as img:
+        assert load_within_budget(img, 300, None) is img
+
+        # reduced in strips to fit the budget, the same pixels as a full decode and reduce
+        reduced = load_within_budget(img, 300, budget)
+        assert reduced.size == (400, 267)
+        assert decoded_bytes(reduced.mode, reduced.size) <= budget
+        assert ImageChops.difference(reduced, source.reduce(3)).getbbox() is None
+
+        # a full-size output, or one that can't be reached by reducing, needs the whole raster
+        with pytest.raises(ImageOverMemoryBudget):
+            load_within_budget(img, None, budget)
+        with pytest.raises(ImageOverMemoryBudget):
+            load_within_budget(img, 1000, budget)
+
+    with Image.open(tmp_path / "source.jpeg") as img:
+        # a JPEG only fits when drafting for the target brings it within the budget
+        assert load_within_budget(img, 300, budget) is img
+        with pytest.raises(ImageOverMemoryBudget):
+            load_within_budget(img, 1000, budget)
@@ -0,0 +1,54 @@
+import asyncio
+import time
+import pytest
+
+from utils.image_pool import ImageJobTimeout, ImagePool, ImagePoolBusy
+
+@pytest.fixture(scope='function')
+def pool_resource(request):
+    pool = ImagePool(workers=1, queue_size=1, timeout_seconds=5)
+
+    def pool_teardown():
+        pool.shutdown()
+
+    request.addfinalizer(pool_teardown)
+
+    return pool
+
+def test_image_pool_run(pool_resource):
+    result = asyncio.run(pool_resource.run(pow, 2, 10))
+
+    assert result == 1024
+    stats = pool_resource.stats()
+    assert stats["completed"] == 1
+    assert stats["in_flight"] == 0
+    assert 0 < stats["peak_rss_last_bytes"] <= stats["peak_rss_max_bytes"]
+
+def test_image_pool_backpressure(pool_resource):
+    running = pool_resource.submit(time.sleep, 1)
+    queued = pool_resource.submit(time.sleep, 0)
+
+    with pytest.raises(ImagePoolBusy):
+        pool_resource.submit(time.sleep, 0)
+
+    assert pool_resource.stats()["queue_depth"] == 1
+    assert pool_resource.stats()["rejected"] == 1
+
+    running.result()
+    queued.result()
+    assert pool_resource.stats()["in_flight"] == 0
+
+def test_image_pool_timeout(pool_resource):
+    pool_resource.timeout_seconds = 0.1
+
+    with pytest.raises(ImageJobTimeout):
+        asyncio.run(pool_resource.run(time.sleep, 1))
+
+    assert pool_resource.stats()["timed_out"] == 1
+
+def test_image_pool_wait_timeout(pool_resource):
+    pool_resource.timeout_seconds = 0.1
+
+    # a batch passes a longer timeout than a single job gets
+    assert asyncio.run(pool_resource.wait(pool_resource.submit(time.sleep, 0.5), 5)) is None
+    assert pool_resource.stats()["timed_out"] == 0
@@ -0,0 +1,24 @@
+import numpy as np
+from PIL import Image, ImageFilter
+
+from utils.image_quality import PSNR_MAX, luma_array, psnr, ssim
+
+def make_texture(size=(320, 240)) -> Image.Image:
+    noise = Image.effect_noise((size[0] // 4, size[1] // 4), 50).resize(size, Image.Resampling.BICUBIC)
+    return Image.merge("RGB", (noise, Image.linear_gradient("L").resize(size), noise))
+
+def test_luma_array_downsamples():
+    array = luma_array(make_texture((2000, 1000)), 512)
+    assert array.shape == (334, 667)
+    assert array.dtype == np.float64
+
+def test_scores_identical_and_degraded():
+    texture = make_texture()
+    reference = luma_array(texture, 512)
+    assert ssim(reference, reference) == 1.0
+    assert psnr(reference, reference) == PSNR_MAX
+
+    slightly = luma_array(texture.filter(ImageFilter.GaussianBlur(0.5)), 512)
+    heavily = luma_array(texture.filter(ImageFilter.GaussianBlur(3)), 512)
+    assert 0 < ssim(reference, heavily) < ssim(reference, slightly) < 1
+    assert psnr(reference, heavily) < psnr(reference, slightly) < PSNR_MAX
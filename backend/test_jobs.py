@@ -0,0 +1,148 @@
+import asyncio
+import time
+import pytest
+from pathlib import Path
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from utils.settings import current_settings
+from utils import jobs
+from utils.auth import create_access_token
+from utils.db import close_db, create_user_image_compression_db, create_user_image_db, get_compression_job_db, get_compression_jobs_db, init_db, open_db, set_compression_job_db, set_user_db
+from utils.jobs import ABANDONED_JOB_ERROR, QUOTA_JOB_ERROR, complete_job, count_pending_jobs, find_matching_job, wait_for_compression_job
+from utils.types import JOB_DONE, JOB_FAILED, JOB_PENDING, CompressionJob, User, UserImage, UserImageCompression
+
+test_db_path = f"{current_settings.base_path}/db-test.json"
+
+@pytest.fixture(scope='function')
+def jobs_db_resource(request, monkeypatch):
+    monkeypatch.setattr(current_settings, "db_file_path", test_db_path)
+    init_db(test_db_path, True)
+
+    def db_teardown():
+        close_db(test_db_path)
+        for suffix in ("", ".log", ".lock"):
+            Path(f"{test_db_path}{suffix}").unlink(missing_ok=True)
+
+    request.addfinalizer(db_teardown)
+
+def create_test_image():
+    create_user_image_db(test_db_path, "abc", UserImage(id = "123", user_id = "abc", path = "/", name = "test image", extension = "png", size = 10, uploaded_at = "123"))
+
+def test_find_matching_pending_job(jobs_db_resource):
+    create_test_image()
+    job = CompressionJob(id = "job", image_id = "123", user_id = "abc", quality = 80, resize_width = 100, status = JOB_PENDING, created_at = "123", lease_expires_at = time.time() + 60)
+    set_compression_job_db(test_db_path, job)
+    db = open_db(test_db_path)
+
+    assert find_matching_job(db, "abc", "123", 80, 100).id == "job"
+    assert find_matching_job(db, "abc", "123", 80, 200) is None
+    assert count_pending_jobs(db, "123") == 1
+
+def test_abandoned_pending_job(jobs_db_resource):
+    create_test_image()
+    # accepted by a worker that went away before finishing it
+    job = CompressionJob(id = "job", image_id = "123", user_id = "abc", quality = 80, resize_width = 100, status = JOB_PENDING, created_at = "123", lease_expires_at = time.time() - 1)
+    set_compression_job_db(test_db_path, job)
+    db = open_db(test_db_path)
+
+    assert find_matching_job(db, "abc", "123", 80, 100) is None
+    assert count_pending_jobs(db, "123") == 0
+    polled = asyncio.run(wait_for_compression_job("123", "job", 0))
+    assert polled.status == JOB_FAILED and polled.error == ABANDONED_JOB_ERROR
+
+def test_find_matching_existing_compression(jobs_db_resource):
+    create_test_image()
+    compression = UserImageCompression(id = "c1", image_id = "123", path = "/", quality = 80, resize_width = 100, created_at = "123")
+    create_user_image_compression_db(test_db_path, compression)
+    db = open_db(test_db_path)
+
+    job = find_matching_job(db, "abc", "123", 80, 100)
+
+    assert job.status == JOB_DONE
+    assert job.compression_id == "c1"
+    # a lookup only, submit_compression_jobs stores the job
+    assert get_compression_job_db(db, "123", job.id) is None
+    assert count_pending_jobs(db, "123") == 0
+
+def test_compression_jobs_endpoint(jobs_db_resource, monkeypatch, tmp_path):
+    from main import app
+    monkeypatch.setattr(current_settings, "filestore_file_path", str(tmp_path))
+    source_path = tmp_path / "source.png"
+    Image.linear_gradient("L").resize((400, 300)).convert("RGB").save(source_path)
+    set_user_db(test_db_path, User(id = "abc", username = "test-user", password = "hash"))
+    create_user_image_db(test_db_path, "abc", UserImage(id = "123", user_id = "abc", path = str(source_path), name = "test image", extension = "png", size = source_path.stat().st_size, uploaded_at = "123", hash = "source-hash"))
+    headers = { "Authorization": f"Bearer {create_access_token({ 'sub': 'test-user' })}" }
+    variants = { "variants": [{ "quality": 80, "resize_width": 200 }, { "quality": 80, "resize_width": 100, "output_format": "webp" }] }
+
+    with TestClient(app) as client:
+        response = client.post("/image/123/image-compression-jobs", json = variants, headers = headers)
+        assert response.status_code == 202
+        jobs = response.json()["jobs"]
+        assert [job["status"] for job in jobs] == [JOB_PENDING, JOB_PENDING]
+        # both variants are one pool job, with a timeout (and lease) per variant
+        assert all(job["lease_expires_at"] > time.time() + current_settings.image_job_timeout_seconds + current_settings.compression_job_lease_grace_seconds for job in jobs)
+
+        for job in jobs:
+            polled = client.get(f"/image/123/image-compression-jobs/{job['id']}?wait=10", headers = headers).json()
+            assert polled["status"] == JOB_DONE
+            assert polled["compression"]["resize_width"] == job["resize_width"]
+            assert polled["compression"]["signed_url"] is not None
+
+        # the same variants again are answered by the finished jobs, nothing is queued
+        again = client.post("/image/123/image-compression-jobs", json = variants, headers = headers).json()["jobs"]
+        assert [job["id"] for job in again] == [job["id"] for job in jobs]
+        assert all(job["status"] == JOB_DONE for job in again)
+
+def test_compression_job_over_byte_quota(jobs_db_resource, monkeypatch, tmp_path):
+    create_test_image()
+    monkeypatch.setattr(current_settings, "max_user_bytes", 15)
+    job = CompressionJob(id = "job", image_id = "123", user_id = "abc", quality = 80, status = JOB_PENDING, created_at = "123", lease_expires_at = time.time() + 60)
+    set_compression_job_db(test_db_path, job)
+
+    # the image already uses 10 bytes, a 10 byte compression would go over
+    complete_job(job, UserImageCompression(id = "c1", image_id = "123", user_id = "abc", path = "/", quality = 80, size = 10, created_at = "123"))
+    stored = get_compression_job_db(open_db(test_db_path), "123", "job")
+    assert stored.status == JOB_FAILED and stored.error == QUOTA_JOB_ERROR
+    assert count_pending_jobs(open_db(test_db_path), "123") == 0
+
+def test_backfill_previews(jobs_db_resource, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(jobs, "submit_preview_job", lambda image: submitted.append(image.id) or image.id != "busy")
+    monkeypatch.setattr(jobs, "_preview_jobs", { "running" })
+    monkeypatch.setattr(jobs, "_preview_retry_at", { "failed": time.time() + 60 })
+    images = [UserImage(id = image_id, user_id = "abc", path = "/", name = "test image", extension = "png", size = 10, uploaded_at = "123", previews = previews) for image_id, previews in (("done", { "128": "/p.webp" }), ("running", None), ("failed", None), ("missing", None), ("busy", None), ("after-busy", None))]
+
+    # only images without previews, nothing in flight or waiting to retry, and none once the pool is busy
+    jobs.backfill_previews(images)
+    assert submitted == ["missing", "busy"]
+
+def test_image_output_formats_endpoint(jobs_db_resource):
+    from main import app
+    from utils.image import OUTPUT_FORMATS
+    set_user_db(test_db_path, User(id = "abc", username = "test-user", password = "hash"))
+    headers = { "Authorization": f"Bearer {create_access_token({ 'sub': 'test-user' })}" }
+
+    with TestClient(app) as client:
+        formats = client.get("/image-output-formats", headers = headers).json()
+        assert formats == list(OUTPUT_FORMATS)
+        # avif is only offered by a Pillow that can write it
+        Image.init()
+        assert ("avif" in formats) == ("AVIF" in Image.SAVE)
+
+def test_compression_quota_matches_sync_route(jobs_db_resource, monkeypatch):
+    from main import app
+    monkeypatch.setattr(current_settings, "max_compressions_per_image", 2)
+    set_user_db(test_db_path, User(id = "abc", username = "test-user", password = "hash"))
+    create_test_image()
+    for compression_id in ("c1", "c2"):
+        create_user_image_compression_db(test_db_path, UserImageCompression(id = compression_id, image_id = "123", user_id = "abc", path = "/", quality = 10, created_at = "123"))
+    headers = { "Authorization": f"Bearer {create_access_token({ 'sub': 'test-user' })}" }
+
+    # at the limit, neither route makes another compression
+    with TestClient(app) as client:
+        response = client.put("/image/123/image-compression", data = { "quality": 50, "resize_width": 100 }, headers = headers)
+        assert response.status_code == 400
+        response = client.post("/image/123/image-compression-jobs", json = { "variants": [{ "quality": 50, "resize_width": 100 }] }, headers = headers)
+        assert response.status_code == 400
+    assert get_compression_jobs_db(open_db(test_db_path), "123") == {}
@@ -0,0 +1,98 @@
+import time
+import pytest
+from pathlib import Path
+from fastapi.testclient import TestClient
+
+from utils.db import close_db, get_db, init_db
+from utils.image_pool import run_measured, shutdown_image_pool
+from utils.metrics import DB_SECONDS, STAGE_SECONDS, Histogram, render_metrics, reset_metrics, time_stage
+from utils.settings import current_settings
+from utils.store import open_store, put_op, write_json_atomic
+
+test_db_path = f"{current_settings.base_path}/db-metrics-test.json"
+
+@pytest.fixture(scope='function')
+def metrics_resource(request, monkeypatch):
+    monkeypatch.setattr(current_settings, "metrics_enabled", True)
+    monkeypatch.setattr(current_settings, "db_file_path", test_db_path)
+    init_db(test_db_path, True)
+    reset_metrics()
+
+    def metrics_teardown():
+        reset_metrics()
+        shutdown_image_pool()
+        close_db(test_db_path)
+        for suffix in ("", ".log", ".lock"):
+            Path(f"{test_db_path}{suffix}").unlink(missing_ok=True)
+
+    request.addfinalizer(metrics_teardown)
+
+def test_histogram_render():
+    histogram = Histogram("test_seconds", "Test latency", ("route",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(5, "/a")
+
+    assert histogram.render() == [
+        "# HELP test_seconds Test latency",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1"} 2',
+        'test_seconds_bucket{route="/a",le="+Inf"} 3',
+        'test_seconds_sum{route="/a"} 5.55',
+        'test_seconds_count{route="/a"} 3',
+    ]
+
+def test_disabled_metrics_record_nothing(monkeypatch):
+    monkeypatch.setattr(current_settings, "metrics_enabled", False)
+    reset_metrics()
+    with time_stage("compression", "decode"):
+        pass
+    with DB_SECONDS.time("get_db"):
+        pass
+
+    assert STAGE_SECONDS.count("compression", "decode") == 0
+    assert DB_SECONDS.count("get_db") == 0
+
+def timed_job(seconds: float) -> str:
+    with time_stage("compression", "encode"):
+        time.sleep(seconds)
+    return "done"
+
+def test_pool_job_stages(metrics_resource):
+    # recorded in the job and returned with its result, not in the process's own histogram
+    result, _, stages = run_measured(timed_job, (0.01,), {}, True)
+    assert result == "done"
+    assert [(operation, stage) for operation, stage, _ in stages] == [("compression", "encode")]
+    assert stages[0][2] >= 0.01
+    assert STAGE_SECONDS.count("compression", "encode") == 0
+
+    assert run_measured(timed_job, (0,), {}, False)[2] == []
+
+def test_metrics_endpoint(metrics_resource, monkeypatch):
+    from main import app
+    client = TestClient(app)
+
+    get_db(test_db_path)
+    client.get("/metrics")
+    text = client.get("/metrics").text
+
+    assert 'http_request_duration_seconds_count{method="GET",route="/metrics",status="200"} 1' in text
+    assert 'db_operation_duration_seconds_count{operation="get_db"} 1' in text
+    assert 'cache_hits_total{cache="db"}' in text
+    assert f"db_size_bytes {Path(test_db_path).stat().st_size}" in text
+    assert render_metrics().startswith("# HELP")
+
+    monkeypatch.setattr(current_settings, "metrics_enabled", False)
+    assert client.get("/metrics").status_code == 404
+
+def test_snapshot_timing(metrics_resource, tmp_path):
+    # only the db's own snapshot writes are timed, not other users of write_json_atomic
+    write_json_atomic(str(tmp_path / "checkpoint.json"), { "next_unit": 1 })
+    assert DB_SECONDS.count("snapshot") == 0
+
+    store = open_store(test_db_path)
+    store.commit([put_op(["users", "abc"], { "id": "abc" })])
+    store.compact()
+    store.replace(lambda document: document)
+    assert DB_SECONDS.count("snapshot") == 2
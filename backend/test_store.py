@@ -0,0 +1,120 @@
+import pytest
+from pathlib import Path
+
+from utils.settings import current_settings
+from utils.db import create_user_image_db, delete_user_image_db, get_db, get_db_cache_stats, get_user_image_count_db, get_user_image_db
+from utils.store import JSONStore, close_store, fresh_db, open_store, put_op, reset_store
+from utils.sqlite_store import close_sqlite_store, migrate_json_to_sqlite, open_sqlite_store
+from utils.types import UserImage
+
+test_db_path = f"{current_settings.base_path}/db-test.json"
+test_db_log_path = f"{test_db_path}.log"
+test_db_lock_path = f"{test_db_path}.lock"
+
+@pytest.fixture(scope='function')
+def store_resource(request):
+    reset_store(test_db_path, fresh_db())
+
+    def store_teardown():
+        close_store(test_db_path)
+        Path(test_db_path).unlink()
+        Path(test_db_log_path).unlink(missing_ok=True)
+        Path(test_db_lock_path).unlink(missing_ok=True)
+
+    request.addfinalizer(store_teardown)
+
+def make_test_image(user_id: str, image_id: str):
+    return UserImage(
+        user_id = user_id,
+        id = image_id,
+        path = "/",
+        name = "test image",
+        extension = 'png',
+        size = 10,
+        uploaded_at = "123",
+    )
+
+def test_db_log_replay(store_resource):
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '123'))
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '456'))
+    delete_user_image_db(test_db_path, 'abc', '123')
+
+    # the snapshot is untouched, writes only go to the log
+    with open(test_db_path) as snapshot:
+        assert '456' not in snapshot.read()
+
+    close_store(test_db_path)
+    dbJSON = get_db(test_db_path)
+
+    assert get_user_image_db(dbJSON, 'abc', '123') is None
+    assert get_user_image_db(dbJSON, 'abc', '456') is not None
+
+def test_db_log_torn_tail(store_resource):
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '123'))
+    close_store(test_db_path)
+
+    with open(test_db_log_path, "a") as log_file:
+        log_file.write('[{"op": "del", "path": ["images", "abc"')
+
+    dbJSON = get_db(test_db_path)
+
+    assert get_user_image_db(dbJSON, 'abc', '123') is not None
+    with open(test_db_log_path) as log_file:
+        assert log_file.read().endswith("\n")
+
+def test_db_compaction(store_resource):
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '123'))
+    open_store(test_db_path).compact()
+
+    assert Path(test_db_log_path).stat().st_size == 0
+    with open(test_db_path) as snapshot:
+        assert '123' in snapshot.read()
+
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '456'))
+    close_store(test_db_path)
+    dbJSON = get_db(test_db_path)
+
+    assert get_user_image_count_db(dbJSON, 'abc') == 2
+
+def test_db_read_cache_external_write(store_resource):
+    get_db(test_db_path)
+    misses = get_db_cache_stats(test_db_path)["misses"]
+
+    # a second store on the same files stands in for another worker process
+    other = JSONStore(test_db_path)
+    other.commit([put_op(["images", "abc", "123"], vars(make_test_image('abc', '123')))])
+    other.close()
+
+    dbJSON = get_db(test_db_path)
+
+    assert get_user_image_db(dbJSON, 'abc', '123') is not None
+    assert get_db_cache_stats(test_db_path)["misses"] == misses + 1
+
+def test_sorted_index_external_write(store_resource):
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '123'))
+    store = open_store(test_db_path)
+    assert [key for key, _ in store.reader().get_page("images", "abc", "size")] == ['123']
+
+    # the index is kept up to date from log lines written by another worker
+    other = JSONStore(test_db_path)
+    image = make_test_image('abc', '456')
+    image.size = 5
+    other.commit([put_op(["images", "abc", "456"], vars(image))])
+    other.close()
+
+    assert [key for key, _ in store.reader().get_page("images", "abc", "size")] == ['456', '123']
+    assert [key for key, _ in store.reader().get_page("images", "abc", "size", descending=True, limit=1)] == ['123']
+
+def test_migrate_json_to_sqlite(store_resource):
+    sqlite_path = f"{current_settings.base_path}/db-test.sqlite3"
+    create_user_image_db(test_db_path, 'abc', make_test_image('abc', '123'))
+
+    migrate_json_to_sqlite(test_db_path, sqlite_path)
+    store = open_sqlite_store(sqlite_path)
+
+    try:
+        assert store.get_record("images", "abc", "123")["id"] == "123"
+        assert store.count_records("images", "abc") == 1
+    finally:
+        close_sqlite_store(sqlite_path)
+        Path(sqlite_path).unlink()
@@ -1,11 +1,18 @@
 from datetime import datetime, timedelta, timezone
-from typing import Union
+import mimetypes
+from os import path
+import time
+from typing import Callable, Union
 import jwt
 from passlib.context import CryptContext
 
 from utils.settings import current_settings
-from utils.types import UserImage, UserImageCompression
-from utils.db import get_db, get_user_db
+from utils.cache import LRUCache
+from utils.password_pool import get_login_limiters, get_password_pool
+from utils.types import SignedDownload, User, UserImage, UserImageCompression
+from utils.downloads import accept_quality
+from utils.image import OUTPUT_FORMATS
+from utils.db import get_user_db, get_user_image_compression_db, get_user_image_compressions_db, get_user_image_db, get_users_version, open_db, set_user_db
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -15,16 +22,73 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def bcrypt_rounds(hashed_password: str) -> Union[int, None]:
+    # $2b$12$<salt+hash>
+    try:
+        return int(hashed_password.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
 def authenticate_user(username: str, password: str):
-    dbJSON = get_db(current_settings.db_file_path)
-    user = get_user_db(dbJSON, username, True)
+    db = open_db(current_settings.db_file_path)
+    user = get_user_db(db, username, True)
     if not user:
         return False
     if not verify_password(password, user.password):
         return False
 
+    # the plain password is only available here, so this is where the stored hash
+    # moves to a newly configured cost
+    target_rounds = current_settings.password_bcrypt_rounds
+    if target_rounds is not None and bcrypt_rounds(user.password) != target_rounds:
+        user.password = pwd_context.handler("bcrypt").using(rounds=target_rounds).hash(password)
+        set_user_db(current_settings.db_file_path, user)
+
+    return user
+
+async def authenticate_user_limited(username: str, password: str, client: Union[str, None]):
+    # raises LoginRateLimited or PasswordPoolBusy before any hashing is done
+    limiters = get_login_limiters()
+    limiters["username"].admit(username)
+    if client is not None:
+        limiters["client"].admit(client)
+
+    user = await get_password_pool().run(authenticate_user, username, password)
+    if user:
+        limiters["username"].reset(username)
+
+    return user
+
+# Resolved users are cached per bearer token until the token expires, at most
+# USER_CACHE_TTL_SECONDS (which bounds how long another worker's change to the user
+# goes unseen), or until this process writes a user record.
+_token_users = LRUCache(current_settings.user_cache_size)
+
+def get_token_user(token: str) -> Union[User, None]:
+    # raises jwt.InvalidTokenError for a bad or expired token
+    cached = _token_users.get(token)
+    if cached is not None:
+        user, expires_at, users_version = cached
+        if expires_at > time.time() and users_version == get_users_version():
+            return user
+        _token_users.pop(token)
+
+    users_version = get_users_version()
+    payload = jwt.decode(token, current_settings.auth_secret_key, algorithms=[current_settings.algorithm])
+    username = payload.get("sub")
+    if username is None:
+        return None
+
+    user = get_user_db(open_db(current_settings.db_file_path), username)
+    if user is not None:
+        expires_at = min(payload.get("exp", 0), time.time() + current_settings.user_cache_ttl_seconds)
+        _token_users.put(token, (user, expires_at, users_version))
+
     return user
 
+def get_user_cache_stats() -> dict:
+    return _token_users.stats()
+
 def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -35,17 +99,150 @@ def create_access_token(data: dict, expires_delta: Union[timedelta, None] = None
     encoded_jwt = jwt.encode(to_encode, current_settings.auth_secret_key, algorithm=current_settings.algorithm)
     return encoded_jwt
 
-def sign_image_url(image: UserImage):
-   to_encode = { "user_id": image.user_id, "image_id": image.id }
-   expire = datetime.now(timezone.utc) + timedelta(minutes=current_settings.signed_image_expiry_minutes)
-   to_encode.update({"exp": expire})
-   signature = jwt.encode(to_encode, current_settings.signed_url_secret_key, current_settings.algorithm)
-   return f"/image?signature={signature}" 
+def signed_url_expiry() -> int:
+   # expiries are rounded up to the next bucket, so every signature for the same file
+   # within a bucket is the same url and the browser cache keeps working across
+   # re-signing. A url is valid for between one and two expiry periods.
+   period = current_settings.signed_image_expiry_minutes * 60
+   now = int(datetime.now(timezone.utc).timestamp())
+   return (now // period + 2) * period
+
+# Signing and verification are memoized. Claims signed within one expiry bucket
+# always give the same url, and a verified signature maps straight to the file it
+# grants, so hot downloads skip both the JWT check and the db until they expire.
+# Deletes in this process drop their entries. Other workers notice a deleted
+# original because its file is gone, and otherwise serve it until expiry at most.
+_signed_urls = LRUCache(current_settings.signed_url_cache_size)
+_verified_downloads = LRUCache(current_settings.signed_url_cache_size)
+# Negotiated siblings are keyed by compression and the Accept header's preference
+# between the output formats, and kept no longer than the download that asked.
+# New and deleted compressions in this process drop their image's entries.
+_negotiated_downloads = LRUCache(current_settings.signed_url_cache_size)
+
+def _sign(route: str, claims: tuple, expiry: int) -> str:
+   key = (route, claims, expiry)
+   url = _signed_urls.get(key)
+   if url is None:
+      to_encode = dict(claims)
+      to_encode.update({"exp": expiry})
+      signature = jwt.encode(to_encode, current_settings.signed_url_secret_key, algorithm=current_settings.algorithm)
+      url = f"{route}?signature={signature}"
+      _signed_urls.put(key, url)
+
+   return url
+
+def sign_image_url(image: UserImage, expiry: Union[int, None] = None):
+   return _sign("/image", (("user_id", image.user_id), ("image_id", image.id)), expiry or signed_url_expiry())
+
+def sign_image_preview_url(image: UserImage, size: int, expiry: Union[int, None] = None):
+   return _sign("/image-preview", (("user_id", image.user_id), ("image_id", image.id), ("size", size)), expiry or signed_url_expiry())
+
+def sign_compression_url(compression: UserImageCompression, expiry: Union[int, None] = None):
+   return _sign("/image-compression", (("image_id", compression.image_id), ("compression_id", compression.id)), expiry or signed_url_expiry())
+
+def sign_image_urls(images: list[UserImage], preview_size: Union[int, None] = None) -> list[UserImage]:
+   # a listing shares one expiry, so all of its urls come from the same bucket
+   expiry = signed_url_expiry()
+   for image in images:
+      image.signed_url = sign_image_url(image, expiry)
+      if preview_size is not None and str(preview_size) in (image.previews or {}):
+         image.preview_url = sign_image_preview_url(image, preview_size, expiry)
+
+   return images
+
+def sign_compression_urls(compressions: list[UserImageCompression]) -> list[UserImageCompression]:
+   expiry = signed_url_expiry()
+   for compression in compressions:
+      compression.signed_url = sign_compression_url(compression, expiry)
+
+   return compressions
+
+def verify_signed_download(route: str, signature: str, resolve: Callable[[dict], Union[SignedDownload, None]]) -> Union[SignedDownload, None]:
+   # raises jwt.ExpiredSignatureError (or another jwt error) for a bad signature
+   download = _verified_downloads.get((route, signature))
+   if download is not None and download.expires_at > time.time() and path.exists(download.path):
+      return download
+
+   decoded = jwt.decode(signature, current_settings.signed_url_secret_key, algorithms=current_settings.algorithm)
+   download = resolve(decoded)
+   if download is not None:
+      _verified_downloads.put((route, signature), download)
+
+   return download
+
+def resolve_image_download(decoded: dict) -> Union[SignedDownload, None]:
+   image = get_user_image_db(open_db(current_settings.db_file_path), decoded["user_id"], decoded["image_id"])
+   if image is not None:
+      return SignedDownload(user_id = image.user_id, image_id = image.id, path = image.path, etag = image.hash, expires_at = decoded["exp"])
+
+def resolve_image_preview_download(decoded: dict) -> Union[SignedDownload, None]:
+   image = get_user_image_db(open_db(current_settings.db_file_path), decoded["user_id"], decoded["image_id"])
+   size = str(decoded["size"])
+   if image is not None and size in (image.previews or {}):
+      etag = None if image.hash is None else f"{image.hash}-{size}"
+      return SignedDownload(user_id = image.user_id, image_id = image.id, path = image.previews[size], etag = etag, expires_at = decoded["exp"])
+
+def resolve_compression_download(decoded: dict) -> Union[SignedDownload, None]:
+   compression = get_user_image_compression_db(open_db(current_settings.db_file_path), decoded["image_id"], decoded["compression_id"])
+   if compression is not None:
+      # blobs are content addressed, so the blob key is the content hash
+      return SignedDownload(image_id = compression.image_id, compression_id = compression.id, path = compression.path, etag = compression.blob_key, expires_at = decoded["exp"])
+
+def accept_preference(accept: str) -> tuple:
+   # the q value Accept gives each output format: headers that only differ
+   # elsewhere always negotiate the same sibling
+   return tuple(accept_quality(accept, mimetypes.guess_type(f"_.{extension}")[0]) for extension in OUTPUT_FORMATS)
+
+def negotiate_compression_download(download: SignedDownload, accept: Union[str, None]) -> SignedDownload:
+   # a signed compression url stands for its size and quality settings: a sibling
+   # compression with the same settings in a format the client prefers (by Accept q
+   # value, then the one asked for, then the smallest) is served in its place
+   if accept is None:
+      return download
+
+   preference = accept_preference(accept)
+   if accept_quality(accept, mimetypes.guess_type(download.path)[0]) >= max(preference, default=0.0):
+      # no sibling can outrank the requested format
+      return download
+
+   key = (download.compression_id, preference)
+   cached = _negotiated_downloads.get(key)
+   if cached is not None and cached[1] > time.time():
+      negotiated = cached[0]
+      if negotiated.compression_id == download.compression_id:
+         return download
+      if path.exists(negotiated.path):
+         return negotiated.model_copy(update={ "expires_at": download.expires_at })
+
+   negotiated = _negotiate_sibling(download, accept)
+   _negotiated_downloads.put(key, (negotiated, download.expires_at))
+   return negotiated
+
+def _negotiate_sibling(download: SignedDownload, accept: str) -> SignedDownload:
+   records = get_user_image_compressions_db(open_db(current_settings.db_file_path), download.image_id)
+   requested = records.get(download.compression_id)
+   if requested is None:
+      return download
+
+   settings = (requested["quality"], requested.get("resize_width"), requested.get("resample"))
+   siblings = [UserImageCompression(**record) for record in records.values() if (record["quality"], record.get("resize_width"), record.get("resample")) == settings]
+
+   def rank(compression: UserImageCompression) -> tuple:
+      return (accept_quality(accept, mimetypes.guess_type(compression.path)[0]), compression.id == download.compression_id, -(compression.size or 0))
+
+   best = max(siblings, key=rank)
+   if best.id == download.compression_id or rank(best)[0] <= 0 or not path.exists(best.path):
+      return download
+
+   return SignedDownload(image_id = best.image_id, compression_id = best.id, path = best.path, etag = best.blob_key, expires_at = download.expires_at)
+
+def forget_signed_downloads(image_id: str, compression_id: Union[str, None] = None):
+   _verified_downloads.discard_where(lambda key, download: download.image_id == image_id and (compression_id is None or download.compression_id == compression_id))
+   forget_negotiated_downloads(image_id)
 
-def sign_compression_url(compression: UserImageCompression):
-   to_encode = { "image_id": compression.image_id, "compression_id": compression.id }
-   expire = datetime.now(timezone.utc) + timedelta(minutes=current_settings.signed_image_expiry_minutes)
-   to_encode.update({"exp": expire})
-   signature = jwt.encode(to_encode, current_settings.signed_url_secret_key, algorithm=current_settings.algorithm)
-   return f"/image-compression?signature={signature}" 
+def forget_negotiated_downloads(image_id: str):
+   # any new or deleted compression of the image can change which sibling wins
+   _negotiated_downloads.discard_where(lambda key, entry: entry[0].image_id == image_id)
 
+def get_signed_url_cache_stats() -> dict:
+   return { "signed": _signed_urls.stats(), "verified": _verified_downloads.stats(), "negotiated": _negotiated_downloads.stats() }
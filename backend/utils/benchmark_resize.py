@@ -0,0 +1,121 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from utils.image import create_and_store_user_image_compression, create_and_store_user_image_compressions, resize_image
+from utils.types import CompressionVariant, User, UserImage
+
+# Compares the original compression path (full decode, single-step default resize)
+# with resize_image (JPEG draft decoding + reducing_gap). Every measurement runs in
+# a fresh process so peak RSS belongs to that run alone, e.g.
+#   python -m utils.benchmark_resize --megapixels 12 24 50 --width 800
+# With --variant-widths it instead compares one compression call per width against
+# a single multi-variant call (one decode, chained resizes):
+#   python -m utils.benchmark_resize --megapixels 24 --variant-widths 1600 1200 800 400 200
+
+def make_source_jpeg(dir_name: str, megapixels: int) -> str:
+	width = int(math.sqrt(megapixels * 1000 * 1000 * 3 / 2))
+	height = int(width * 2 / 3)
+	file_path = f"{dir_name}/source-{megapixels}mp.jpeg"
+
+	# noise keeps the encoder (and so the decoder) honest, a flat image decodes too fast
+	noise = Image.effect_noise((width // 8, height // 8), 64).resize((width, height))
+	gradient = Image.linear_gradient("L").resize((width, height))
+	Image.merge("RGB", (noise, gradient, noise)).save(file_path, format="JPEG", quality=90)
+	return file_path
+
+def peak_rss_bytes() -> int:
+	# ru_maxrss is in kilobytes on linux and bytes on macOS
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == "darwin" else peak * 1024
+
+def run_original(source_path: str, output_path: str, width: int, quality: int, resample: str):
+	started = time.perf_counter()
+	with Image.open(source_path) as img:
+		w_percent = (width / float(img.size[0]))
+		h_size = int((float(img.size[1]) * float(w_percent)))
+		img.resize((width, h_size)).save(output_path, format="JPEG", quality=quality, optimize=True)
+
+	return time.perf_counter() - started, peak_rss_bytes()
+
+def run_fast(source_path: str, output_path: str, width: int, quality: int, resample: str):
+	started = time.perf_counter()
+	with Image.open(source_path) as img:
+		resize_image(img, width, resample).save(output_path, format="JPEG", quality=quality, optimize=True)
+
+	return time.perf_counter() - started, peak_rss_bytes()
+
+def _variant_source(source_path: str, run_id: str) -> tuple:
+	# a unique hash per run, so no variant is served from a blob of an earlier run
+	user = User(id = "benchmark", username = "benchmark")
+	image = UserImage(id = run_id, user_id = user.id, path = source_path, name = "source", extension = "jpeg", size = os.path.getsize(source_path), uploaded_at = "", hash = run_id)
+	return user, image
+
+def run_separate_variants(source_path: str, filestore_dir: str, widths: list, quality: int, resample: str):
+	user, image = _variant_source(source_path, f"separate-{time.time_ns()}")
+	started = time.process_time()
+	for width in widths:
+		create_and_store_user_image_compression(filestore_dir, user, image, quality, width, resample)
+
+	return time.process_time() - started, peak_rss_bytes()
+
+def run_pipeline_variants(source_path: str, filestore_dir: str, widths: list, quality: int, resample: str):
+	user, image = _variant_source(source_path, f"pipeline-{time.time_ns()}")
+	started = time.process_time()
+	create_and_store_user_image_compressions(filestore_dir, user, image, [CompressionVariant(quality = quality, resize_width = width, resample = resample) for width in widths])
+
+	return time.process_time() - started, peak_rss_bytes()
+
+def in_fresh_process(fn, *args):
+	# a child starts from its parent's RSS high-water mark, so the parent must stay
+	# small too, which is why even the sources are generated out of process
+	with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+		return executor.submit(fn, *args).result()
+
+def run(megapixels: list, width: int, quality: int, resample: str, repeat: int):
+	with tempfile.TemporaryDirectory() as dir_name:
+		output_path = f"{dir_name}/output.jpeg"
+		print(f"{'source':>8} {'path':>9} {'latency (s)':>12} {'peak rss (MB)':>14}")
+		for mp in megapixels:
+			source_path = in_fresh_process(make_source_jpeg, dir_name, mp)
+			for name, fn in (("original", run_original), ("fast", run_fast)):
+				results = [in_fresh_process(fn, source_path, output_path, width, quality, resample) for _ in range(repeat)]
+				latency = min(result[0] for result in results)
+				peak = max(result[1] for result in results)
+				print(f"{mp:>6}MP {name:>9} {latency:>12.3f} {peak / 1000 / 1000:>14.1f}")
+			os.unlink(source_path)
+
+def run_variants(megapixels: list, widths: list, quality: int, resample: str, repeat: int):
+	with tempfile.TemporaryDirectory() as dir_name:
+		print(f"{'source':>8} {'path':>9} {'cpu (s)':>12} {'peak rss (MB)':>14}")
+		for mp in megapixels:
+			source_path = in_fresh_process(make_source_jpeg, dir_name, mp)
+			for name, fn in (("separate", run_separate_variants), ("pipeline", run_pipeline_variants)):
+				results = [in_fresh_process(fn, source_path, f"{dir_name}/filestore", widths, quality, resample) for _ in range(repeat)]
+				cpu = min(result[0] for result in results)
+				peak = max(result[1] for result in results)
+				print(f"{mp:>6}MP {name:>9} {cpu:>12.3f} {peak / 1000 / 1000:>14.1f}")
+			os.unlink(source_path)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark compression resize latency and peak RSS on large JPEG inputs")
+	parser.add_argument("--megapixels", type=int, nargs="+", default=[12, 24, 50])
+	parser.add_argument("--width", type=int, default=800)
+	parser.add_argument("--quality", type=int, default=85)
+	parser.add_argument("--resample", default="bicubic")
+	parser.add_argument("--repeat", type=int, default=3)
+	parser.add_argument("--variant-widths", type=int, nargs="+", default=None)
+	args = parser.parse_args()
+
+	if args.variant_widths is not None:
+		run_variants(args.megapixels, args.variant_widths, args.quality, args.resample, args.repeat)
+	else:
+		run(args.megapixels, args.width, args.quality, args.resample, args.repeat)
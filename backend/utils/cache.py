@@ -0,0 +1,55 @@
+from collections import OrderedDict
+import threading
+from typing import Callable, Hashable
+
+# A small thread-safe LRU shared by the in-process caches (signed urls, tokens).
+# Values that carry their own expiry are checked by the caller.
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key: Hashable, value):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def discard_where(self, predicate: Callable[[Hashable, object], bool]) -> int:
+        with self._lock:
+            keys = [key for key, value in self._entries.items() if predicate(key, value)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return { "size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses }
@@ -1,122 +1,388 @@
+import base64
+import binascii
 import json
 import os
-from typing import Union
+import time
+from collections.abc import Mapping
+from typing import Callable, Union
 
-from utils.types import User, UserImage, UserImageCompression
+from utils.settings import current_settings
+from utils.types import CompressionJob, User, UserImage, UserImageCompression
 from utils.log_config import api_logger
+from utils.metrics import DB_SECONDS
+from utils.store import DocumentReader, FrozenDocument, JSONStore, close_store, del_op, fresh_db, open_store, put_op, reset_store
+from utils.sqlite_store import SQLiteStore, close_sqlite_store, open_sqlite_store, reset_sqlite_store
+
+def open_db(file_path: str) -> Union[JSONStore, SQLiteStore]:
+    if current_settings.db_backend == "sqlite":
+        return open_sqlite_store(file_path)
+
+    return open_store(file_path)
+
+def close_db(file_path: str):
+    if current_settings.db_backend == "sqlite":
+        close_sqlite_store(file_path)
+    else:
+        close_store(file_path)
+    _views.pop(file_path, None)
 
 def init_db(file_path: str, overwrite = True):
     if not os.path.exists(file_path) or overwrite:
-        writeFile = open(file_path, "w+")
-        freshDBJSON = { "users": {}, "images": {}, "compressions": {} }
-        writeFile.write(json.dumps(freshDBJSON))
-        writeFile.close()
+        if current_settings.db_backend == "sqlite":
+            reset_sqlite_store(file_path, fresh_db())
+        else:
+            reset_store(file_path, fresh_db())
 
-def get_db(file_path: str):
-   readFile = open(file_path, "r")
+# The returned document is shared between every reader of the current db generation,
+# so it's a read-only view (assigning to it raises TypeError); writes go through set_db
+# or the *_db helpers below. Request handlers should prefer passing open_db(file_path)
+# to the get_*_db helpers, which the SQLite backend answers with indexed queries
+# instead of a full document.
+_views: dict = {}
 
-   dbText = readFile.read()
-   dbJSON = {}
-   if len(dbText) != 0:
-        dbJSON = json.loads(dbText)
+def get_db(file_path: str) -> FrozenDocument:
+   with DB_SECONDS.time("get_db"):
+        document = open_db(file_path).refresh()
+        view = _views.get(file_path)
+        if view is None or view[0] is not document:
+            view = _views[file_path] = (document, FrozenDocument(document))
+        return view[1]
 
-   readFile.close() 
+def get_db_cache_stats(file_path: str) -> dict:
+   store = open_db(file_path)
+   return { "hits": store.hits, "misses": store.misses, "generation": store.generation }
 
-   return dbJSON
+def get_db_size_bytes(file_path: str) -> int:
+   # the snapshot plus the JSON store's log, or the SQLite file plus its WAL
+   size = 0
+   for suffix in ("", ".log", "-wal"):
+        try:
+            size += os.path.getsize(f"{file_path}{suffix}")
+        except OSError:
+            pass
+   return size
+
+def _reader(dbJSON: Union[Mapping, JSONStore, SQLiteStore]):
+   if isinstance(dbJSON, Mapping):
+        return DocumentReader(dbJSON)
+
+   return dbJSON.reader()
 
 def get_user_db(dbJSON: dict, username: str, with_password = False) -> Union[User, None]:
-   if username in dbJSON["users"]:
+   record = _reader(dbJSON).get_user(username)
+   if record is not None:
+        user = User(**record)
         if not with_password:
-            del dbJSON["users"][username]["password"]
+            user.password = None
 
-        return User(**dbJSON["users"][username])
+        return user
     
 def get_user_images_db(dbJSON: dict, user_id: str):
-   if user_id in dbJSON["images"]:
-        return dbJSON["images"][user_id]
-
-   return {} 
+   return _reader(dbJSON).get_records("images", user_id)
 
 def get_user_image_count_db(dbJSON: dict, user_id: str):
-   return len(get_user_images_db(dbJSON, user_id))
+   return get_user_counters_db(dbJSON, user_id)["images"]
 
 def get_user_image_db(dbJSON: dict, user_id: str, image_id: str):
-   if user_id in dbJSON["images"]:
-        if image_id in dbJSON["images"][user_id]:
-            return UserImage(**dbJSON["images"][user_id][image_id])
+   record = _reader(dbJSON).get_record("images", user_id, image_id)
+   if record is not None:
+        return UserImage(**record)
 
-def get_user_image_compressions_db(dbJSON: dict, image_id: str):
-   if image_id in dbJSON["compressions"]:
-        return dbJSON["compressions"][image_id]
+# Cursors are opaque to clients: the sort they belong to plus the sort value and key
+# of the last item of the previous page.
+def encode_cursor(field: str, descending: bool, record: dict, key: str) -> str:
+   data = json.dumps({ "s": field, "d": descending, "v": record.get(field), "k": key })
+   return base64.urlsafe_b64encode(data.encode()).decode()
 
-   return {}
+def decode_cursor(cursor: str, field: str, descending: bool) -> tuple:
+   # raises ValueError for a malformed cursor or one from another sort
+   try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if data["s"] != field or data["d"] != descending:
+            raise ValueError("Cursor belongs to another sort order")
+        return (data["v"], data["k"])
+   except (KeyError, TypeError, binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+def _get_page_db(dbJSON, section: str, parent_key: str, sort: str, descending: bool, cursor: Union[str, None], limit: Union[int, None]) -> tuple:
+   after = None if cursor is None else decode_cursor(cursor, sort, descending)
+   # one extra row tells whether there is a next page
+   page = _reader(dbJSON).get_page(section, parent_key, sort, descending, after, None if limit is None else limit + 1)
+   next_cursor = None
+   if limit is not None and len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(sort, descending, page[-1][1], page[-1][0])
+
+   return page, next_cursor
+
+def get_user_images_page_db(dbJSON: dict, user_id: str, sort: str = "uploaded_at", descending: bool = False, cursor: Union[str, None] = None, limit: Union[int, None] = None) -> tuple:
+   return _get_page_db(dbJSON, "images", user_id, sort, descending, cursor, limit)
+
+def get_user_image_compressions_page_db(dbJSON: dict, image_id: str, sort: str = "created_at", descending: bool = False, cursor: Union[str, None] = None, limit: Union[int, None] = None) -> tuple:
+   return _get_page_db(dbJSON, "compressions", image_id, sort, descending, cursor, limit)
+
+def get_user_image_compressions_db(dbJSON: dict, image_id: str):
+   return _reader(dbJSON).get_records("compressions", image_id)
 
 def get_user_image_compression_count_db(dbJSON: dict, image_id: str):
-    return len(get_user_image_compressions_db(dbJSON, image_id))
+    return get_image_counters_db(dbJSON, image_id)["compressions"]
 
 def get_user_image_compression_db(dbJSON: dict, image_id: str, compression_id: str):
-   if image_id in dbJSON["compressions"]:
-        if compression_id in dbJSON["compressions"][image_id]:
-            return UserImageCompression(**dbJSON["compressions"][image_id][compression_id])
+   record = _reader(dbJSON).get_record("compressions", image_id, compression_id)
+   if record is not None:
+        return UserImageCompression(**record)
 
-def set_db(file_path: str, updateFunction):
-   dbJSON = get_db(file_path)
-   db_copy = get_db(file_path)
-   # "w" 
-   write_file = open(file_path, "w")
+def get_compression_jobs_db(dbJSON: dict, image_id: str):
+   return _reader(dbJSON).get_records("jobs", image_id)
 
-   try:
+def get_compression_job_db(dbJSON: dict, image_id: str, job_id: str):
+   record = _reader(dbJSON).get_record("jobs", image_id, job_id)
+   if record is not None:
+        return CompressionJob(**record)
+
+def get_compression_blob_db(dbJSON: dict, key: str):
+   return _reader(dbJSON).get_record("blobs", None, key)
+
+def get_compression_blobs_db(dbJSON: dict):
+   return _reader(dbJSON).get_section("blobs")
+
+# Bumped whenever this process writes user records, so caches of resolved users can
+# tell they are stale without reading the db. set_db may rewrite anything, users
+# included.
+_users_version = 0
+
+def get_users_version() -> int:
+   return _users_version
+
+def _users_changed():
+   global _users_version
+   _users_version += 1
+
+def set_db(file_path: str, updateFunction):
+   def update(dbJSON):
         result = updateFunction(dbJSON)
-        write_file.write(json.dumps(result))
+        if result is not None:
+            # the update may have rewritten any collection; counters are rebuilt lazily
+            result["user_counters"] = {}
+            result["image_counters"] = {}
         return result
+
+   try:
+        with DB_SECONDS.time("set_db"):
+            return open_db(file_path).replace(update)
    except Exception as e:
-        api_logger.info(f"Error writing to db json. Resetting db.")
-        write_file.write(json.dumps(db_copy))
+        api_logger.info(f"Error writing to db json. Db left unchanged.")
         raise e
    finally:
-        write_file.close() 
+        _users_changed()
 
-def create_user_image_db(file_path: str, user_id: str, image: UserImage):
-   def dbUpdate(dbJSON):
-        if user_id in dbJSON["images"]:
-            dbJSON["images"][user_id][image.id] = vars(image)
-        else:
-            user_dict = {}
-            user_dict[image.id] = vars(image)
-            dbJSON["images"][user_id] = user_dict
-        return dbJSON
+def set_user_db(file_path: str, user: User):
+   open_db(file_path).commit([put_op(["users", user.username], dict(vars(user)))])
+   _users_changed()
+
+def delete_user_db(file_path: str, username: str):
+   open_db(file_path).commit([del_op(["users", username])])
+   _users_changed()
+
+class QuotaExceeded(Exception):
+   pass
+
+# Counters are denormalized next to the records they count and written in the same
+# transaction, as absolute values so the log stays idempotent:
+#   user_counters[userId] = { "images", "bytes" }, image_counters[imageId] = { "compressions" }
+# Bytes cover a user's originals and the compressions they own (user_id). Collections from before the
+# counters existed are counted once, on their first write or read.
+def _record_size(record) -> int:
+   return (record.get("size") or 0) if isinstance(record, Mapping) else 0
+
+def _user_counters(reader, user_id: str) -> dict:
+   counters = reader.get_record("user_counters", None, user_id)
+   if counters is not None:
+        return counters
+
+   images = reader.get_records("images", user_id)
+   size = sum(_record_size(image) for image in images.values())
+   for image_id in images:
+        size += sum(_record_size(compression) for compression in reader.get_records("compressions", image_id).values() if isinstance(compression, Mapping) and compression.get("user_id") == user_id)
+   return { "images": len(images), "bytes": size }
 
-   return set_db(file_path, dbUpdate)
+def _image_counters(reader, image_id: str) -> dict:
+   counters = reader.get_record("image_counters", None, image_id)
+   if counters is not None:
+        return counters
+
+   return { "compressions": reader.count_records("compressions", image_id) }
+
+def _counter_op(section: str, key: str, counters: dict, **deltas) -> dict:
+   updated = dict(counters)
+   for name, delta in deltas.items():
+        updated[name] = max(0, updated.get(name, 0) + delta)
+   return put_op([section, key], updated)
+
+def get_user_counters_db(dbJSON: dict, user_id: str) -> dict:
+   return _user_counters(_reader(dbJSON), user_id)
+
+def get_image_counters_db(dbJSON: dict, image_id: str) -> dict:
+   return _image_counters(_reader(dbJSON), image_id)
+
+def compression_quota_exceeded_db(dbJSON: dict, image_id: str, max_compressions: int, adding: int = 1) -> bool:
+   # the per-image limit for both compression routes; `adding` is the compressions about
+   # to be made plus any still being encoded for the image
+   return get_user_image_compression_count_db(dbJSON, image_id) + adding > max_compressions
+
+def create_user_image_db(file_path: str, user_id: str, image: UserImage, max_images: Union[int, None] = None, max_bytes: Union[int, None] = None):
+   # raises QuotaExceeded (and writes nothing) if the image would go over a quota
+   def build_ops(reader):
+        counters = _user_counters(reader, user_id)
+        if reader.get_record("images", user_id, image.id) is not None:
+            return [put_op(["images", user_id, image.id], dict(vars(image)))]
+
+        if max_images is not None and counters["images"] > max_images:
+            raise QuotaExceeded()
+        if max_bytes is not None and counters["bytes"] + image.size > max_bytes:
+            raise QuotaExceeded()
+
+        return [
+            put_op(["images", user_id, image.id], dict(vars(image))),
+            _counter_op("user_counters", user_id, counters, images=1, bytes=image.size),
+        ]
+
+   open_db(file_path).transact(build_ops)
  
+def set_user_image_previews_db(file_path: str, user_id: str, image_id: str, previews: dict):
+   # the image may have been deleted while its previews were rendered
+   open_db(file_path).commit([put_op(["images", user_id, image_id, "previews"], previews, create=False)])
+
+def delete_user_images_db(file_path: str, user_id: str, image_ids: list) -> list:
+   # one transaction removes the images with their compressions, jobs and counters;
+   # returns [(UserImage, [UserImageCompression])] so the caller can remove the files
+   deleted = []
+
+   def build_ops(reader):
+        deleted.clear()
+        ops = []
+        images = 0
+        size = 0
+        for image_id in dict.fromkeys(image_ids):
+            record = reader.get_record("images", user_id, image_id)
+            if record is None:
+                continue
+
+            compressions = [UserImageCompression(**compression) for compression in reader.get_records("compressions", image_id).values()]
+            deleted.append((UserImage(**record), compressions))
+            images += 1
+            size += _record_size(record) + sum(compression.size or 0 for compression in compressions if compression.user_id == user_id)
+
+            ops += [
+                del_op(["images", user_id, image_id]),
+                del_op(["compressions", image_id]),
+                del_op(["jobs", image_id]),
+                del_op(["image_counters", image_id]),
+            ]
+            ops += [del_op(["blobs", compression.blob_key, "refs", compression.id]) for compression in compressions if compression.blob_key is not None]
+
+        if images > 0:
+            ops.append(_counter_op("user_counters", user_id, _user_counters(reader, user_id), images=-images, bytes=-size))
+        return ops
+
+   open_db(file_path).transact(build_ops)
+   return deleted
+
 def delete_user_image_db(file_path: str, user_id: str, image_id: str):
-   def dbUpdate(dbJSON):
-        if user_id in dbJSON["images"]:
-            if image_id in dbJSON["images"][user_id]:
-                del dbJSON["images"][user_id][image_id]
-                return dbJSON
-
-   return set_db(file_path, dbUpdate)
-
-def create_user_image_compression_db(file_path: str, compression: UserImageCompression):
-   def dbUpdate(dbJSON):
-        image_id = compression.image_id
-        if image_id in dbJSON["compressions"]:
-            dbJSON["compressions"][image_id][compression.id] = vars(compression) 
-        else:
-            image_dict = {}
-            image_dict[compression.id] = vars(compression)
-            dbJSON["compressions"][image_id] = image_dict
+   return delete_user_images_db(file_path, user_id, [image_id])
+
+def _compression_ops(reader, compression: UserImageCompression, max_bytes: Union[int, None] = None) -> list:
+   # raises QuotaExceeded if a new compression would take its user over max_bytes
+   ops = []
+   if compression.blob_key is not None:
+        # fields are written one by one so concurrent references don't overwrite each other
+        key = compression.blob_key
+        ops += [
+            put_op(["blobs", key, "key"], key),
+            put_op(["blobs", key, "path"], compression.path),
+            put_op(["blobs", key, "size"], compression.size),
+            put_op(["blobs", key, "last_used"], time.time()),
+        ]
+
+   if compression.user_id is not None and reader.get_record("images", compression.user_id, compression.image_id) is None:
+        # the image was deleted while this was encoding; the unreferenced blob is left to eviction
+        return ops
+
+   ops.append(put_op(["compressions", compression.image_id, compression.id], dict(vars(compression))))
+   if compression.blob_key is not None:
+        ops.append(put_op(["blobs", compression.blob_key, "refs", compression.id], True))
 
-        return dbJSON
+   if reader.get_record("compressions", compression.image_id, compression.id) is None:
+        ops.append(_counter_op("image_counters", compression.image_id, _image_counters(reader, compression.image_id), compressions=1))
+        if compression.user_id is not None:
+            counters = _user_counters(reader, compression.user_id)
+            if max_bytes is not None and counters["bytes"] + (compression.size or 0) > max_bytes:
+                raise QuotaExceeded()
+            ops.append(_counter_op("user_counters", compression.user_id, counters, bytes=compression.size or 0))
 
-   return set_db(file_path, dbUpdate)
+   return ops
+
+def create_user_image_compression_db(file_path: str, compression: UserImageCompression, max_bytes: Union[int, None] = None):
+   # raises QuotaExceeded (and writes nothing) if the user would go over max_bytes
+   open_db(file_path).transact(lambda reader: _compression_ops(reader, compression, max_bytes))
  
 def delete_user_image_compression_db(file_path: str, image_id: str, compression_id: str):
-   def dbUpdate(dbJSON):
-        if image_id in dbJSON["compressions"]:
-            if compression_id in dbJSON["compressions"][image_id]:
-                del dbJSON["compressions"][image_id][compression_id]
-                return dbJSON
-
-   return set_db(file_path, dbUpdate)
- 
\ No newline at end of file
+   def build_ops(reader):
+        record = reader.get_record("compressions", image_id, compression_id)
+        if record is None:
+            return []
+
+        compression = UserImageCompression(**record)
+        ops = [
+            del_op(["compressions", image_id, compression_id]),
+            _counter_op("image_counters", image_id, _image_counters(reader, image_id), compressions=-1),
+        ]
+        if compression.user_id is not None:
+            ops.append(_counter_op("user_counters", compression.user_id, _user_counters(reader, compression.user_id), bytes=-(compression.size or 0)))
+        if compression.blob_key is not None:
+            ops.append(del_op(["blobs", compression.blob_key, "refs", compression_id]))
+        return ops
+
+   open_db(file_path).transact(build_ops)
+
+def delete_compression_blob_db(file_path: str, key: str):
+   open_db(file_path).commit([del_op(["blobs", key])])
+
+def delete_orphaned_compression_blob_db(file_path: str, key: str, used_before: float) -> bool:
+   # re-checked under the write lock: a compression may have started referencing (or
+   # reusing) the blob since the caller decided it was an orphan. True if it was deleted
+   deleted = False
+
+   def build_ops(reader):
+        nonlocal deleted
+        blob = reader.get_record("blobs", None, key)
+        if blob is None or len(blob.get("refs", {})) > 0 or blob.get("last_used", 0) > used_before:
+            return []
+        deleted = True
+        return [del_op(["blobs", key])]
+
+   open_db(file_path).transact(build_ops)
+   return deleted
+
+def _job_ops(reader, job: CompressionJob) -> list:
+   # a job finishing after its image was deleted must not bring the collection back
+   if reader.get_record("images", job.user_id, job.image_id) is None:
+        return []
+   return [put_op(["jobs", job.image_id, job.id], job.model_dump(exclude={"compression"}))]
+
+def set_compression_job_db(file_path: str, job: CompressionJob):
+   open_db(file_path).transact(lambda reader: _job_ops(reader, job))
+
+def store_compression_jobs_db(file_path: str, build_jobs: Callable[[DocumentReader], list]):
+   # build_jobs(reader) looks up the jobs and returns the ones to store, reading in the
+   # transaction that writes them, so two submissions of one variant can't both add a
+   # job. Whatever it raises leaves the db unchanged
+   open_db(file_path).transact(lambda reader: [op for job in build_jobs(reader) for op in _job_ops(reader, job)])
+
+def delete_compression_jobs_db(file_path: str, image_id: str, job_ids: list):
+   open_db(file_path).commit([del_op(["jobs", image_id, job_id]) for job_id in job_ids])
+
+def complete_compression_job_db(file_path: str, job: CompressionJob, compression: UserImageCompression, max_bytes: Union[int, None] = None):
+   # the compression record and the job status land in one transaction, or neither
+   # does when the compression would go over max_bytes (QuotaExceeded)
+   open_db(file_path).transact(lambda reader: _compression_ops(reader, compression, max_bytes) + _job_ops(reader, job))
@@ -0,0 +1,135 @@
+import mimetypes
+import os
+import time
+from typing import Union
+
+import anyio
+from fastapi import Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+
+# Everything served through a signed url is immutable: an image, preview or
+# compression id always points at the same bytes. Responses are therefore cacheable
+# until the signature expires, validated with a content-based ETag, and can be
+# fetched in parts with a single byte Range.
+
+CHUNK_SIZE = 64 * 1024
+
+# not known to every python version's mimetypes table
+mimetypes.add_type("image/avif", ".avif")
+mimetypes.add_type("image/webp", ".webp")
+
+def accept_quality(accept: Union[str, None], media_type: Union[str, None]) -> float:
+	# the q value of the most specific Accept range matching media_type
+	if accept is None:
+		return 1.0
+	if media_type is None:
+		return 0.0
+
+	main_type = media_type.split("/")[0]
+	best = (-1, 0.0)
+	for accepted in accept.split(","):
+		accepted_type, *params = [part.strip() for part in accepted.split(";")]
+		if accepted_type == media_type:
+			specificity = 2
+		elif accepted_type == f"{main_type}/*":
+			specificity = 1
+		elif accepted_type == "*/*":
+			specificity = 0
+		else:
+			continue
+
+		quality = 1.0
+		for param in params:
+			name, _, value = param.partition("=")
+			if name.strip() == "q":
+				try:
+					quality = float(value)
+				except ValueError:
+					quality = 0.0
+		if specificity > best[0]:
+			best = (specificity, quality)
+
+	return best[1]
+
+def etag_matches(if_none_match: Union[str, None], etag: str) -> bool:
+	if if_none_match is None:
+		return False
+	if if_none_match.strip() == "*":
+		return True
+
+	# weak comparison, a W/ prefix doesn't matter for GET
+	candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+	return etag in candidates
+
+def parse_byte_range(range_header: str, file_size: int) -> Union[tuple, None]:
+	# only a single range is supported; None means "ignore the header, send everything".
+	# A range starting past the end is returned as is, the caller answers 416
+	units, _, ranges = range_header.partition("=")
+	if units.strip() != "bytes" or "," in ranges:
+		return None
+
+	start, _, end = ranges.strip().partition("-")
+	try:
+		if start == "":
+			suffix = int(end)
+			if suffix <= 0:
+				raise ValueError()
+			return (max(0, file_size - suffix), file_size - 1)
+
+		start = int(start)
+		end = int(end) if end != "" else file_size - 1
+	except ValueError:
+		return None
+
+	if start >= file_size:
+		return (start, max(start, end))
+	if start > end:
+		return None
+
+	return (start, min(end, file_size - 1))
+
+async def _read_range(file_path: str, start: int, end: int):
+	async with await anyio.open_file(file_path, "rb") as file:
+		await file.seek(start)
+		remaining = end - start + 1
+		while remaining > 0:
+			chunk = await file.read(min(CHUNK_SIZE, remaining))
+			if not chunk:
+				break
+			remaining -= len(chunk)
+			yield chunk
+
+def cached_file_response(request: Request, file_path: str, etag: Union[str, None], expires_at: Union[int, None] = None, vary: Union[str, None] = None) -> Response:
+	if etag is None:
+		# records from before content hashes were stored fall back to the file itself
+		stat = os.stat(file_path)
+		etag = f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+	max_age = 0 if expires_at is None else max(0, int(expires_at - time.time()))
+	headers = {
+		"ETag": f'"{etag}"',
+		"Cache-Control": f"private, max-age={max_age}, immutable",
+		"Accept-Ranges": "bytes",
+	}
+	if vary is not None:
+		headers["Vary"] = vary
+
+	if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+		return Response(status_code=304, headers=headers)
+
+	range_header = request.headers.get("range")
+	if_range = request.headers.get("if-range")
+	if range_header is not None and (if_range is None or if_range.strip() == headers["ETag"]):
+		file_size = os.path.getsize(file_path)
+		byte_range = parse_byte_range(range_header, file_size)
+		if byte_range is not None:
+			start, end = byte_range
+			if start >= file_size:
+				return Response(status_code=416, headers={ **headers, "Content-Range": f"bytes */{file_size}" })
+
+			headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+			headers["Content-Length"] = f"{end - start + 1}"
+			media_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+			return StreamingResponse(_read_range(file_path, start, end), status_code=206, headers=headers, media_type=media_type)
+
+	return FileResponse(file_path, headers=headers)
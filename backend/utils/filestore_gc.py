@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Union
+
+from utils.db import delete_compression_blob_db, delete_user_image_compression_db, delete_user_images_db, open_db
+from utils.log_config import api_logger
+from utils.reaper import get_file_reaper, shutdown_file_reaper
+from utils.settings import current_settings
+from utils.store import write_json_atomic
+
+# Reconciles the filestore with the db in both directions:
+#   - orphaned files: anything under filestore/images or filestore/blobs (originals,
+#     previews, compressions, leftover .tmp- files), or under a pre-sharding
+#     filestore/{userId} directory, that no record points at
+#   - dangling records: images, compressions and blobs whose file is gone
+# The tree is walked in units (a user's records and legacy directory, or one
+# first-level shard of images or blobs) in sorted
+# order, with os.scandir and at most `rate` entries per second. A run that uses up
+# its entry budget checkpoints the next unit, so the following run picks up where
+# it stopped and a full pass over a large tree is spread over many runs.
+# Files younger than the grace period are skipped, they may belong to an upload
+# or encode that hasn't been recorded yet. Nothing is deleted unless reclaim=True.
+#   python -m utils.filestore_gc --max-entries 10000 --rate 500 [--reclaim]
+
+BLOBS_DIR = "blobs"
+IMAGES_DIR = "images"
+
+def _real(file_path: str) -> str:
+	# stored paths aren't normalized, e.g. legacy compressions start with "//"
+	return os.path.realpath(file_path)
+
+def load_checkpoint(checkpoint_path: str) -> dict:
+	try:
+		with open(checkpoint_path, "r") as checkpoint_file:
+			return json.load(checkpoint_file)
+	except (FileNotFoundError, ValueError):
+		return {}
+
+class Throttle:
+	def __init__(self, rate: Union[float, None]):
+		self.rate = rate
+		self.started = time.monotonic()
+		self.count = 0
+
+	def tick(self):
+		self.count += 1
+		if self.rate is None or self.rate <= 0:
+			return
+		ahead = self.count / self.rate - (time.monotonic() - self.started)
+		if ahead > 0:
+			time.sleep(ahead)
+
+class FilestoreScanner:
+	def __init__(self, filestore_dir: str, db_file_path: str, checkpoint_path: str, reclaim: bool = False, grace_seconds: float = 3600, rate: Union[float, None] = None):
+		self.filestore_dir = _real(filestore_dir)
+		self.db_file_path = db_file_path
+		self.checkpoint_path = checkpoint_path
+		self.reclaim = reclaim
+		self.grace_seconds = grace_seconds
+		self.throttle = Throttle(rate)
+		self._image_paths = None
+		self.report = { "units": 0, "entries": 0, "orphaned_files": [], "orphaned_bytes": 0, "dangling_images": [], "dangling_compressions": [], "dangling_blobs": [], "complete": False }
+
+	def _units(self, db) -> list:
+		# every user in the db or with a legacy directory, then the shards
+		users = set(user_id for user_id, _, _ in db.iter_nested_records("images"))
+		shards = []
+		with os.scandir(self.filestore_dir) as entries:
+			for entry in entries:
+				if not entry.is_dir(follow_symlinks=False):
+					continue
+				if entry.name in (BLOBS_DIR, IMAGES_DIR):
+					with os.scandir(entry.path) as shard_entries:
+						shards += [f"{entry.name}/{shard.name}" for shard in shard_entries if shard.is_dir(follow_symlinks=False)]
+				else:
+					users.add(entry.name)
+		return sorted([f"users/{user}" for user in users] + shards)
+
+	def _known_image_paths(self, db) -> set:
+		# image shards aren't grouped by user, so their files are checked against every
+		# stored original, preview and unshared compression, collected once per run
+		if self._image_paths is None:
+			paths = set()
+			for _, _, image in db.iter_nested_records("images"):
+				paths.add(_real(image["path"]))
+				paths.update(_real(preview) for preview in (image.get("previews") or {}).values())
+			for _, _, compression in db.iter_nested_records("compressions"):
+				if compression.get("blob_key") is None:
+					paths.add(_real(compression["path"]))
+			self._image_paths = paths
+		return self._image_paths
+
+	def _is_recent(self, entry: os.DirEntry) -> bool:
+		return entry.stat(follow_symlinks=False).st_mtime > time.time() - self.grace_seconds
+
+	def _orphan(self, entry: os.DirEntry):
+		size = entry.stat(follow_symlinks=False).st_size
+		self.report["orphaned_files"].append(entry.path)
+		self.report["orphaned_bytes"] += size
+		if self.reclaim:
+			get_file_reaper().queue_unlinks([entry.path])
+
+	def _walk_files(self, dir_path: str, known: set, budget: list):
+		try:
+			entries = list(os.scandir(dir_path))
+		except FileNotFoundError:
+			return
+
+		for entry in entries:
+			self.throttle.tick()
+			self.report["entries"] += 1
+			budget[0] -= 1
+			if entry.is_dir(follow_symlinks=False):
+				self._walk_files(entry.path, known, budget)
+				continue
+			if entry.path in known or self._is_recent(entry):
+				continue
+			self._orphan(entry)
+
+	def _scan_user(self, db, user_id: str, budget: list):
+		known = set()
+		dangling_images = []
+		for image_id, image in db.get_records("images", user_id).items():
+			known.add(_real(image["path"]))
+			known.update(_real(preview) for preview in (image.get("previews") or {}).values())
+			image_exists = os.path.exists(image["path"])
+			if not image_exists:
+				dangling_images.append(image_id)
+
+			for compression_id, compression in db.get_records("compressions", image_id).items():
+				known.add(_real(compression["path"]))
+				if image_exists and not os.path.exists(compression["path"]):
+					self.report["dangling_compressions"].append([image_id, compression_id])
+					if self.reclaim:
+						delete_user_image_compression_db(self.db_file_path, image_id, compression_id)
+
+		self.report["dangling_images"] += [[user_id, image_id] for image_id in dangling_images]
+		if self.reclaim and len(dangling_images) > 0:
+			# the original is gone, so the image and everything derived from it goes too
+			deleted = delete_user_images_db(self.db_file_path, user_id, dangling_images)
+			paths = []
+			for image, compressions in deleted:
+				paths += (image.previews or {}).values()
+				paths += [compression.path for compression in compressions if compression.blob_key is None]
+			get_file_reaper().queue_unlinks(paths)
+
+		self._walk_files(os.path.join(self.filestore_dir, user_id), known, budget)
+
+	def _scan_blob_shard(self, db, shard_path: str, budget: list):
+		try:
+			entries = list(os.scandir(shard_path))
+		except FileNotFoundError:
+			return
+
+		for entry in entries:
+			self.throttle.tick()
+			self.report["entries"] += 1
+			budget[0] -= 1
+			if entry.is_dir(follow_symlinks=False):
+				self._scan_blob_shard(db, entry.path, budget)
+				continue
+			key = entry.name.split(".")[0]
+			blob = db.get_record("blobs", None, key) if not entry.name.startswith(".tmp-") else None
+			if blob is not None and _real(blob["path"]) == entry.path:
+				continue
+			if self._is_recent(entry):
+				continue
+			self._orphan(entry)
+
+	def _scan_blob_records(self, db):
+		# blob records whose file is gone; referenced ones are reported through their
+		# compressions, unreferenced ones are just a stale cache entry
+		for key, blob in db.get_section("blobs").items():
+			if os.path.exists(blob.get("path", "")):
+				continue
+			self.report["dangling_blobs"].append(key)
+			if self.reclaim and len(blob.get("refs", {})) == 0:
+				delete_compression_blob_db(self.db_file_path, key)
+
+	def run(self, max_entries: Union[int, None] = None) -> dict:
+		db = open_db(self.db_file_path).reader()
+		checkpoint = load_checkpoint(self.checkpoint_path)
+		next_unit = checkpoint.get("next_unit")
+		budget = [max_entries if max_entries is not None else float("inf")]
+
+		units = self._units(db)
+		if next_unit is None:
+			self._scan_blob_records(db)
+
+		for unit in units:
+			if next_unit is not None and unit < next_unit:
+				continue
+			if budget[0] <= 0:
+				write_json_atomic(self.checkpoint_path, { "next_unit": unit, "started_at": checkpoint.get("started_at", time.time()) })
+				return self.report
+
+			kind, _, name = unit.partition("/")
+			if kind == "users":
+				self._scan_user(db, name, budget)
+			elif kind == IMAGES_DIR:
+				self._walk_files(os.path.join(self.filestore_dir, unit), self._known_image_paths(db), budget)
+			else:
+				self._scan_blob_shard(db, os.path.join(self.filestore_dir, unit), budget)
+			self.report["units"] += 1
+
+		write_json_atomic(self.checkpoint_path, { "next_unit": None, "completed_at": time.time() })
+		self.report["complete"] = True
+		return self.report
+
+def scan_filestore(max_entries: Union[int, None] = None, reclaim: Union[bool, None] = None, rate: Union[float, None] = None) -> dict:
+	scanner = FilestoreScanner(
+		current_settings.filestore_file_path,
+		current_settings.db_file_path,
+		current_settings.filestore_gc_checkpoint_path,
+		reclaim=current_settings.filestore_gc_reclaim if reclaim is None else reclaim,
+		grace_seconds=current_settings.filestore_gc_grace_seconds,
+		rate=current_settings.filestore_gc_rate if rate is None else rate,
+	)
+	report = scanner.run(current_settings.filestore_gc_max_entries if max_entries is None else max_entries)
+	api_logger.info(f"Filestore scan: {report['entries']} entries, {len(report['orphaned_files'])} orphaned files ({report['orphaned_bytes']} bytes), {len(report['dangling_images'])} dangling images, {len(report['dangling_compressions'])} dangling compressions, complete={report['complete']}")
+	return report
+
+async def run_filestore_gc_forever(interval_seconds: float):
+	# optional background task, each round scans up to filestore_gc_max_entries
+	while True:
+		await asyncio.sleep(interval_seconds)
+		try:
+			await asyncio.to_thread(scan_filestore)
+		except Exception as e:
+			api_logger.info(f"Error scanning filestore: {e!r}")
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Find (and optionally reclaim) orphaned filestore files and dangling db records")
+	parser.add_argument("--max-entries", type=int, default=None, help="stop after about this many entries and resume from the checkpoint next run")
+	parser.add_argument("--rate", type=float, default=None, help="max entries scanned per second")
+	parser.add_argument("--reclaim", action="store_true", help="delete orphaned files and dangling records instead of only reporting them")
+	parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and scan from the beginning")
+	args = parser.parse_args()
+
+	if args.restart and os.path.exists(current_settings.filestore_gc_checkpoint_path):
+		os.unlink(current_settings.filestore_gc_checkpoint_path)
+
+	report = scan_filestore(args.max_entries, args.reclaim, args.rate)
+	shutdown_file_reaper()
+	print(json.dumps(report, indent=2))
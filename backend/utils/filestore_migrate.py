@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import shutil
+
+from utils.db import open_db
+from utils.image import compression_blob_path, ensure_directory, preview_path, sharded_path
+from utils.log_config import api_logger
+from utils.settings import current_settings
+from utils.store import put_op
+from utils.types import UserImage
+
+# One-shot move of files stored before sharding (filestore/{userId}/...,
+# filestore/{userId}/compressions/..., filestore/blobs/{key[:2]}/...) into the
+# sharded layout, rewriting UserImage.path, previews, UserImageCompression.path and
+# blob paths to match. Each batch hard-links its files to the new paths and commits
+# the new paths in one transaction; the old files are only unlinked once every
+# batch is in, so a crash at any point leaves every record pointing at a file and
+# a re-run finishes the job. Files that are already gone are left to filestore_gc.
+#   python -m utils.filestore_migrate [--dry-run] [--batch-size 500]
+
+def _extension(file_path: str) -> str:
+	return os.path.splitext(file_path)[1][1:]
+
+def _link(source: str, target: str):
+	ensure_directory(os.path.dirname(target))
+	try:
+		os.link(source, target)
+	except FileExistsError:
+		pass
+	except OSError:
+		# a different filesystem, or one without hard links
+		shutil.copy2(source, target)
+
+def _record_moves(reader, filestore_dir: str):
+	# yields ([(old_path, new_path)], [op]) per record that needs updating
+	for key, blob in reader.get_section("blobs").items():
+		target = compression_blob_path(filestore_dir, key, _extension(blob["path"]))
+		if blob["path"] != target and os.path.exists(blob["path"]):
+			yield [(blob["path"], target)], [put_op(["blobs", key, "path"], target, create=False)]
+
+	for image_id, compression_id, compression in reader.iter_nested_records("compressions"):
+		if compression.get("blob_key") is not None:
+			# usually moved with its blob already, linking again is a no-op
+			target = compression_blob_path(filestore_dir, compression["blob_key"], _extension(compression["path"]))
+		else:
+			target = sharded_path(filestore_dir, "images", compression_id, _extension(compression["path"]))
+		if compression["path"] != target and os.path.exists(compression["path"]):
+			yield [(compression["path"], target)], [put_op(["compressions", image_id, compression_id, "path"], target, create=False)]
+
+	for user_id, image_id, record in reader.iter_nested_records("images"):
+		image = UserImage(**record)
+		moves = []
+		ops = []
+		target = sharded_path(filestore_dir, "images", image.id, image.extension)
+		if image.path != target and os.path.exists(image.path):
+			moves.append((image.path, target))
+			ops.append(put_op(["images", user_id, image_id, "path"], target, create=False))
+
+		previews = { size: preview_path(filestore_dir, image, int(size)) for size in (image.previews or {}) }
+		if previews != (image.previews or {}) and all(os.path.exists(preview) for preview in image.previews.values()):
+			moves += [(preview, previews[size]) for size, preview in image.previews.items() if preview != previews[size]]
+			ops.append(put_op(["images", user_id, image_id, "previews"], previews, create=False))
+
+		if len(ops) > 0:
+			yield moves, ops
+
+def migrate_filestore(filestore_dir: str, db_file_path: str, batch_size: int = 500, dry_run: bool = False) -> dict:
+	store = open_db(db_file_path)
+	# collected up front, the records are rewritten while this runs
+	planned = list(_record_moves(store.reader(), filestore_dir))
+	report = { "records": len(planned), "files": len({ old_path for moves, _ in planned for old_path, _ in moves }), "unlinked": 0, "dry_run": dry_run }
+	if dry_run:
+		return report
+
+	old_paths = []
+	for start in range(0, len(planned), batch_size):
+		batch = planned[start:start + batch_size]
+		ops = []
+		for moves, record_ops in batch:
+			for old_path, new_path in moves:
+				_link(old_path, new_path)
+				old_paths.append(old_path)
+			ops += record_ops
+		store.commit(ops)
+
+	for old_path in dict.fromkeys(old_paths):
+		try:
+			os.unlink(old_path)
+			report["unlinked"] += 1
+		except FileNotFoundError:
+			pass
+
+	api_logger.info(f"Moved {report['files']} files of {report['records']} records into the sharded filestore layout")
+	return report
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Move filestore files into the sharded layout and rewrite their stored paths")
+	parser.add_argument("--batch-size", type=int, default=500)
+	parser.add_argument("--dry-run", action="store_true")
+	args = parser.parse_args()
+
+	print(json.dumps(migrate_filestore(current_settings.filestore_file_path, current_settings.db_file_path, args.batch_size, args.dry_run), indent=2))
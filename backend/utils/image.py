@@ -1,44 +1,260 @@
 from datetime import datetime
-from os import mkdir, path
+import hashlib
+import io
+import math
+from os import path
 import os
 from pathlib import Path
-from typing import Union
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Iterable, Union
 import uuid
 from fastapi import UploadFile
-from PIL import Image
+from PIL import Image, features
 
 from utils.settings import current_settings
-from utils.db import create_user_image_compression_db, create_user_image_db, delete_user_image_compression_db, delete_user_image_db
-from utils.types import DATE_FORMAT, User, UserImage, UserImageCompression
+from utils.db import delete_orphaned_compression_blob_db, delete_user_images_db, get_compression_blob_db, get_compression_blobs_db, open_db
+from utils.image_animation import has_alpha, is_animated, write_gif_animation, write_webp_animation
+from utils.image_memory import ImageOverMemoryBudget, decoded_bytes, load_within_budget, target_size
+from utils.image_quality import luma_array, psnr, ssim
+from utils.metrics import CACHE_LOOKUPS, time_stage
+from utils.types import DATE_FORMAT, CompressionJob, CompressionVariant, User, UserImage, UserImageCompression
 from utils.log_config import api_logger
+from utils.reaper import get_file_reaper
+
+# Files are sharded two levels deep by a random id (image and legacy compression
+# files) or by content hash (blobs), e.g. filestore/images/ab/cd/abcd1234-....png,
+# so no directory grows past a few thousand entries whatever the number of users.
+# Directories are created with a single makedirs and then remembered, so storing a
+# file in an existing shard costs no extra syscalls.
+_known_dirs: set = set()
+_known_dirs_lock = threading.Lock()
+
+def sharded_path(filestore_dir: str, section: str, name: str, extension: str) -> str:
+	return f"{filestore_dir}/{section}/{name[:2]}/{name[2:4]}/{name}.{extension}"
+
+def ensure_directory(dir_path: str) -> str:
+	if dir_path in _known_dirs:
+		return dir_path
+
+	os.makedirs(dir_path, exist_ok=True)
+	with _known_dirs_lock:
+		_known_dirs.add(dir_path)
+	return dir_path
+
+def forget_directory(dir_path: str):
+	with _known_dirs_lock:
+		_known_dirs.discard(dir_path)
 
 def validate_nested_subdirectory(full_path: str):
-	dirs = full_path.split("/")
-	current_path = "/"
-	for dir in dirs:
-		if len(dir):
-			current_path = path.join(current_path, dir)
-			if not path.isdir(current_path):
-				mkdir(current_path)
+	return ensure_directory(full_path)
+
+def mkstemp_in(dir_path: str, suffix: str = "") -> tuple:
+	ensure_directory(dir_path)
+	try:
+		return tempfile.mkstemp(dir=dir_path, prefix=".tmp-", suffix=suffix)
+	except FileNotFoundError:
+		# removed since it was cached, e.g. by a cleanup of empty directories
+		forget_directory(dir_path)
+		ensure_directory(dir_path)
+		return tempfile.mkstemp(dir=dir_path, prefix=".tmp-", suffix=suffix)
+
+# applies in every process that imports this module, image pool workers included
+Image.MAX_IMAGE_PIXELS = current_settings.max_image_pixels
+
+class InvalidImageUpload(Exception):
+	pass
+
+class ImageTooLarge(Exception):
+	pass
+
+# magic numbers for the upload types we accept, keyed by extension
+IMAGE_SIGNATURES = {
+	"jpeg": (b"\xff\xd8\xff",),
+	"png": (b"\x89PNG\r\n\x1a\n",),
+	"gif": (b"GIF87a", b"GIF89a"),
+}
+
+PIL_FORMATS = { "jpeg": "JPEG", "png": "PNG", "gif": "GIF" }
 
-	return current_path
+def sniff_image_format(header: bytes) -> Union[str, None]:
+	for extension, signatures in IMAGE_SIGNATURES.items():
+		if header.startswith(signatures):
+			return extension
 
 def store_user_image(filestore_path: str, user: User, file_name: str, upload_file: UploadFile, file_extension: str):
-	file_name_uuid = uuid.uuid4()
+	return store_user_image_stream(filestore_path, user, file_name, upload_file.file, file_extension)
+
+# Uploads are stored byte for byte: copied to disk in chunks while hashing and counting
+# them, then checked by sniffing the header and opening the file lazily, which only
+# parses the headers and never decodes the raster.
+def store_user_image_stream(filestore_path: str, user: User, file_name: str, source: BinaryIO, file_extension: str, max_size: Union[None, int] = None):
+	if max_size is None:
+		max_size = current_settings.max_file_size
+
 	file_id = uuid.uuid4()
 
-	full_name = f"{file_name}-{file_name_uuid}.{file_extension}"
-	output_path = f"{filestore_path}/{user.id}"
-	validate_nested_subdirectory(output_path)
-	save_path = f"{output_path}/{full_name}"
+	save_path = sharded_path(filestore_path, "images", f"{file_id}", file_extension)
+	output_path = path.dirname(save_path)
 	
 	api_logger.debug(f"Saving new user image to: {output_path}")
-	
-	with Image.open(upload_file.file) as img:
-		img.save(save_path, format=file_extension)
-		date_string = datetime.now().strftime(DATE_FORMAT)
-		image = UserImage(user_id = user.id, id = f"{file_id}", path = save_path, name=file_name, extension=file_extension, size=upload_file.size, uploaded_at=date_string)
-		return image
+
+	digest = hashlib.sha256()
+	size = 0
+	fd, tmp_path = mkstemp_in(output_path)
+	try:
+		with time_stage("upload", "write"), os.fdopen(fd, "wb") as tmp_file:
+			header = source.read(current_settings.upload_chunk_size)
+			if sniff_image_format(header) != file_extension:
+				raise InvalidImageUpload()
+
+			chunk = header
+			while chunk:
+				size += len(chunk)
+				if size > max_size:
+					raise ImageTooLarge()
+				digest.update(chunk)
+				tmp_file.write(chunk)
+				chunk = source.read(current_settings.upload_chunk_size)
+
+		try:
+			with time_stage("upload", "open"), Image.open(tmp_path) as img:
+				if img.format != PIL_FORMATS[file_extension]:
+					raise InvalidImageUpload()
+				width, height = img.size
+		except Image.DecompressionBombError as e:
+			raise ImageTooLarge() from e
+		except (Image.UnidentifiedImageError, SyntaxError, OSError) as e:
+			raise InvalidImageUpload() from e
+
+		# the header is enough to refuse a decompression bomb, nothing was decoded
+		if current_settings.max_image_pixels is not None and width * height > current_settings.max_image_pixels:
+			raise ImageTooLarge()
+
+		with time_stage("upload", "rename"):
+			os.replace(tmp_path, save_path)
+	except BaseException:
+		Path(tmp_path).unlink(missing_ok=True)
+		raise
+
+	date_string = datetime.now().strftime(DATE_FORMAT)
+	return UserImage(user_id = user.id, id = f"{file_id}", path = save_path, name=file_name, extension=file_extension, size=size, width=width, height=height, uploaded_at=date_string, hash=digest.hexdigest())
+
+def hash_file(file_path: str) -> str:
+	digest = hashlib.sha256()
+	with open(file_path, "rb") as file:
+		for chunk in iter(lambda: file.read(1024 * 1024), b""):
+			digest.update(chunk)
+
+	return digest.hexdigest()
+
+# Compressions are content addressed: the same source bytes compressed with the same
+# parameters always map to the same blob, which is shared by every compression record
+# that asks for it. The encoder version is part of the key so blobs written by an
+# older encoder aren't served for the current settings (they age out as orphans).
+ENCODER_VERSION = 2
+
+def compression_cache_key(source_hash: str, quality: int, resize_width: Union[None, int], format: str, resample: Union[None, str] = None) -> str:
+	return hashlib.sha256(f"{source_hash}:{quality}:{resize_width}:{format}:{resample}:{ENCODER_VERSION}".encode()).hexdigest()
+
+# Compressions can be written in the source format or converted. Quality (1-100)
+# means something for every format: the lossy quality for JPEG, WebP and AVIF, and
+# the palette size for PNG and GIF (quality 100 keeps PNG lossless).
+# AVIF needs a Pillow built with libavif (11.2+), older versions don't know the
+# feature at all. The formats on offer are served by GET /image-output-formats.
+OUTPUT_FORMATS = { "jpeg": "JPEG", "png": "PNG", "gif": "GIF", "webp": "WEBP" }
+if "avif" in features.modules and features.check_module("avif"):
+	OUTPUT_FORMATS["avif"] = "AVIF"
+
+def resolve_output_format(user_image: UserImage, output_format: Union[None, str] = None) -> str:
+	return output_format or user_image.extension
+
+def palette_colors(quality: int) -> int:
+	# 2 colors at quality 0 up to the full 256 at 100, spaced evenly in bits per pixel
+	return max(2, min(256, round(2 ** (1 + quality / 100 * 7))))
+
+def _quantize(img: Image.Image, quality: int) -> Image.Image:
+	img = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P", "PA") else "RGB")
+	if features.check("libimagequant"):
+		method = Image.Quantize.LIBIMAGEQUANT
+	else:
+		method = Image.Quantize.FASTOCTREE if img.mode == "RGBA" else Image.Quantize.MEDIANCUT
+	return img.quantize(palette_colors(quality), method=method, dither=Image.Dither.FLOYDSTEINBERG)
+
+def _flatten(img: Image.Image) -> Image.Image:
+	# JPEG has no alpha, transparent pixels become white instead of black
+	if img.mode in ("RGBA", "LA", "P", "PA"):
+		img = img.convert("RGBA")
+		background = Image.new("RGB", img.size, "white")
+		background.paste(img, mask=img.getchannel("A"))
+		return background
+	return img.convert("RGB") if img.mode != "L" else img
+
+# modes PNG stores as they are, anything else (e.g. a CMYK JPEG) is converted first
+PNG_MODES = ("1", "L", "LA", "I", "I;16", "P", "RGB", "RGBA")
+
+def _lossless_png(img: Image.Image) -> Image.Image:
+	if img.mode in PNG_MODES:
+		return img
+	return img.convert("RGBA" if "A" in img.getbands() else "RGB")
+
+def encode_image(img: Image.Image, output_format: str, quality: int, save_path: Union[str, BinaryIO]):
+	if output_format == "jpeg":
+		_flatten(img).save(save_path, format="JPEG", quality=quality, optimize=True, progressive=True)
+	elif output_format == "png":
+		(_lossless_png(img) if quality >= 100 else _quantize(img, quality)).save(save_path, format="PNG", optimize=True)
+	elif output_format == "gif":
+		_quantize(img, quality).save(save_path, format="GIF", optimize=True)
+	elif output_format == "webp":
+		img = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P", "PA") else "RGB")
+		img.save(save_path, format="WEBP", quality=quality, lossless=quality >= 100, method=current_settings.compression_webp_method)
+	elif output_format == "avif":
+		img = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P", "PA") else "RGB")
+		img.save(save_path, format="AVIF", quality=quality, speed=current_settings.compression_avif_speed)
+	else:
+		raise ValueError(f"Unsupported output format {output_format}")
+
+RESAMPLE_FILTERS = {
+	"nearest": Image.Resampling.NEAREST,
+	"box": Image.Resampling.BOX,
+	"bilinear": Image.Resampling.BILINEAR,
+	"hamming": Image.Resampling.HAMMING,
+	"bicubic": Image.Resampling.BICUBIC,
+	"lanczos": Image.Resampling.LANCZOS,
+}
+
+# the filter only matters when resizing, so it is left out of the cache key otherwise
+def resolve_resample(resize_width: Union[None, int], resample: Union[None, str] = None) -> Union[None, str]:
+	if resize_width is None:
+		return None
+	return resample or current_settings.compression_resample
+
+def compression_blob_path(filestore_dir: str, key: str, extension: str) -> str:
+	return sharded_path(filestore_dir, "blobs", key, extension)
+
+def find_cached_user_image_compression(filestore_dir: str, db, user_image: UserImage, quality=85, resize_width: Union[None, int] = None, resample: Union[None, str] = None, output_format: Union[None, str] = None) -> Union[UserImageCompression, None]:
+	if user_image.hash is None:
+		return None
+
+	resample = resolve_resample(resize_width, resample)
+	output_format = resolve_output_format(user_image, output_format)
+	key = compression_cache_key(user_image.hash, quality, resize_width, output_format, resample)
+	blob = get_compression_blob_db(db, key)
+	if blob is not None:
+		try:
+			# touched like any other reuse, so eviction leaves it alone until the record is written
+			os.utime(blob["path"])
+		except FileNotFoundError:
+			blob = None
+	if blob is None:
+		CACHE_LOOKUPS.inc("miss")
+		return None
+
+	CACHE_LOOKUPS.inc("hit")
+
+	date_string = datetime.now().strftime(DATE_FORMAT)
+	return UserImageCompression(id = f"{uuid.uuid4()}", image_id = user_image.id, user_id = user_image.user_id, quality = quality, resize_width = resize_width, resample = resample, output_format = output_format, path = blob["path"], size = blob["size"], blob_key = key, created_at = date_string)
 
 def delete_user_image_fs(image: UserImage):
 	api_logger.debug(f"Deleting image at {image.path}")
@@ -47,40 +263,314 @@ def delete_user_image_fs(image: UserImage):
 		path.unlink()
 	except FileNotFoundError:
 		print(f"Warning: attemped to delete non-existent file: {image.id}, {image.path}")
+
+	delete_user_image_previews_fs(image)
+
+def preview_path(filestore_dir: str, user_image: UserImage, size: int) -> str:
+	# the id prefix puts previews in the same shard as the original
+	return sharded_path(filestore_dir, "images", f"{user_image.id}-{size}", "webp")
+
+# Previews are small WebP renditions for grids and galleries, bounded to `size` on
+# their longest side. The source is decoded once (in draft mode for JPEGs) and each
+# preview is reduced from the previous, larger one.
+def create_user_image_previews(filestore_dir: str, user_image: UserImage, sizes: Union[None, list] = None) -> dict:
+	if sizes is None:
+		sizes = current_settings.preview_sizes
+
+	sizes = sorted(sizes, reverse=True)
+	ensure_directory(path.dirname(preview_path(filestore_dir, user_image, sizes[0])))
+
+	previews = {}
+	with Image.open(user_image.path) as img:
+		width = sizes[0] if img.size[0] >= img.size[1] else math.ceil(sizes[0] * img.size[0] / img.size[1])
+		source = load_within_budget(img, width, current_settings.image_job_memory_budget_bytes, current_settings.compression_reducing_gap)
+		if source.format == "JPEG":
+			source.draft("RGB", (sizes[0], sizes[0]))
+		current = source.convert("RGBA" if source.mode in ("RGBA", "LA", "P", "PA") else "RGB")
+
+		for size in sizes:
+			current.thumbnail((size, size), reducing_gap=current_settings.compression_reducing_gap)
+			save_path = preview_path(filestore_dir, user_image, size)
+			current.save(save_path, format="WEBP", quality=current_settings.preview_quality)
+			previews[str(size)] = save_path
+
+	return previews
+
+def delete_user_image_previews_fs(image: UserImage):
+	for preview in (image.previews or {}).values():
+		Path(preview).unlink(missing_ok=True)
 	
-def create_and_store_user_image_compression(filestore_dir: str, user: User, user_image: UserImage, quality=85, resize_width: Union[None, int] = None):
-	file_name = user_image.name
-	file_name_uuid = uuid.uuid4()
-	compression_id = uuid.uuid4()
+# Downscaling a large JPEG is mostly spent decoding pixels that are thrown away.
+# draft() lets libjpeg decode at 1/2, 1/4 or 1/8 scale (never below the target
+# size), then reducing_gap shrinks by a whole factor with reduce() before the
+# final, more expensive resample filter runs on the already smaller image.
+def resize_image(img: Image.Image, resize_width: int, resample: Union[None, str] = None) -> Image.Image:
+	w_percent = (resize_width / float(img.size[0]))
+	h_size = max(1, int((float(img.size[1]) * float(w_percent))))
+	size = (resize_width, h_size)
+	if resize_width >= img.size[0]:
+		return img.resize(size, RESAMPLE_FILTERS[resolve_resample(resize_width, resample)])
+
+	if img.format == "JPEG":
+		img.draft(img.mode, size)
+
+	return img.resize(size, RESAMPLE_FILTERS[resolve_resample(resize_width, resample)], reducing_gap=current_settings.compression_reducing_gap)
+
+def create_and_store_user_image_compression(filestore_dir: str, user: User, user_image: UserImage, quality=85, resize_width: Union[None, int] = None, resample: Union[None, str] = None, output_format: Union[None, str] = None, target_ssim: Union[None, float] = None, target_psnr: Union[None, float] = None, max_bytes: Union[None, int] = None):
+	variant = CompressionVariant(quality = quality, resize_width = resize_width, resample = resample, output_format = output_format, target_ssim = target_ssim, target_psnr = target_psnr, max_bytes = max_bytes)
+	return create_and_store_user_image_compressions(filestore_dir, user, user_image, [variant])[0]
+
+def is_auto_quality(variant: Union[CompressionVariant, CompressionJob]) -> bool:
+	return variant.target_ssim is not None or variant.target_psnr is not None or variant.max_bytes is not None
+
+# Automatic quality: candidates are encoded into memory and compared with the
+# (resized) source on downsampled luma, binary searching between AUTO_QUALITY_MIN
+# and the requested quality. The result is the lowest quality that reaches every
+# score target, or without targets the highest one within max_bytes. If a target
+# can't be met within the budget, the budget wins, and if not even the lowest quality
+# fits it the compression fails with ByteBudgetUnreachable. Only the chosen encode is
+# written.
+class ByteBudgetUnreachable(Exception):
+	pass
+
+class QualityCandidate:
+	def __init__(self, quality: int, data: bytes):
+		self.quality = quality
+		self.data = data
+		self.ssim = None
+		self.psnr = None
+
+def _lowest_quality(low: int, high: int, accept) -> Union[None, int]:
+	# assumes accept(quality) only ever flips from False to True as quality grows
+	found = None
+	while low <= high:
+		middle = (low + high) // 2
+		if accept(middle):
+			found = middle
+			high = middle - 1
+		else:
+			low = middle + 1
+	return found
+
+def choose_quality(img: Image.Image, output_format: str, variant: CompressionVariant) -> QualityCandidate:
+	analysis_size = current_settings.auto_quality_analysis_size
+	reference = luma_array(_flatten(img), analysis_size)
+	candidates = {}
 
-	full_name = f"{file_name}-{file_name_uuid}.{user_image.extension}"
-	output_path = f"{filestore_dir}/{user.id}/compressions/"
-	validate_nested_subdirectory(output_path)
-	save_path = f"/{output_path}/{full_name}"
+	def encode(quality: int) -> QualityCandidate:
+		if quality not in candidates:
+			buffer = io.BytesIO()
+			encode_image(img, output_format, quality, buffer)
+			candidates[quality] = QualityCandidate(quality, buffer.getvalue())
+		return candidates[quality]
 
+	def score(candidate: QualityCandidate) -> QualityCandidate:
+		if candidate.ssim is None:
+			with Image.open(io.BytesIO(candidate.data)) as decoded:
+				encoded = luma_array(_flatten(decoded), analysis_size)
+			candidate.ssim = round(ssim(reference, encoded), 4)
+			candidate.psnr = round(psnr(reference, encoded), 2)
+		return candidate
+
+	def meets_targets(quality: int) -> bool:
+		candidate = score(encode(quality))
+		return (variant.target_ssim is None or candidate.ssim >= variant.target_ssim) and (variant.target_psnr is None or candidate.psnr >= variant.target_psnr)
+
+	low = min(current_settings.auto_quality_min, variant.quality)
+	high = variant.quality
+	if variant.max_bytes is not None:
+		too_large = _lowest_quality(low, high, lambda quality: len(encode(quality).data) > variant.max_bytes)
+		if too_large == low:
+			raise ByteBudgetUnreachable(f"Quality {low} is {len(encode(low).data)} bytes, over the {variant.max_bytes} byte budget")
+		if too_large is not None:
+			high = too_large - 1
+
+	quality = None
+	if variant.target_ssim is not None or variant.target_psnr is not None:
+		quality = _lowest_quality(low, high, meets_targets)
+	if quality is None:
+		quality = high
+
+	return score(encode(quality))
+
+# Several variants of one image share a single decode. They are encoded largest
+# first and each resize starts from the previous, already smaller output of the same
+# filter, so the full-size source is resampled at most once per filter (and a JPEG
+# source is drafted for the largest width). Variants whose blob already exists are
+# not encoded again, and the source isn't opened at all if none are left.
+def create_and_store_user_image_compressions(filestore_dir: str, user: User, user_image: UserImage, variants: list[CompressionVariant]) -> list[UserImageCompression]:
+	source_hash = user_image.hash or hash_file(user_image.path)
 	date_string = datetime.now().strftime(DATE_FORMAT)
-	image_compression = UserImageCompression(id = f"{compression_id}", image_id =user_image.id, quality = quality, resize_width=resize_width, path=save_path, created_at=date_string)
 
-	with Image.open(user_image.path) as img:
-		final_image = img
-		if resize_width is not None:
-			w_percent = (resize_width / float(img.size[0]))
-			h_size = int((float(img.size[1]) * float(w_percent)))
-			final_image = img.resize((resize_width, h_size))
+	compressions = []
+	pending = {}
+	for variant in variants:
+		resample = resolve_resample(variant.resize_width, variant.resample)
+		output_format = resolve_output_format(user_image, variant.output_format)
+		if is_auto_quality(variant):
+			# the blob is only known once the quality is picked, identical requests share the search
+			key = compression_cache_key(source_hash, f"auto-{variant.quality}-{variant.target_ssim}-{variant.target_psnr}-{variant.max_bytes}", variant.resize_width, output_format, resample)
+		else:
+			key = compression_cache_key(source_hash, variant.quality, variant.resize_width, output_format, resample)
+		blob_path = compression_blob_path(filestore_dir, key, output_format)
+		image_compression = UserImageCompression(id = f"{uuid.uuid4()}", image_id =user_image.id, user_id = user_image.user_id, quality = variant.quality, resize_width=variant.resize_width, resample=resample, output_format=output_format, path=blob_path, blob_key=key, created_at=date_string)
+		compressions.append(image_compression)
+
+		if key in pending:
+			continue
+		with time_stage("compression", "stat"):
+			exists = not is_auto_quality(variant) and path.exists(blob_path)
+			if exists:
+				# touch it so orphan eviction treats the blob as freshly used
+				os.utime(blob_path)
+				image_compression.size = os.stat(blob_path).st_size
+		if not exists:
+			pending[key] = (image_compression, variant)
+
+	if len(pending) > 0:
+		_encode_compressions(filestore_dir, source_hash, user_image.path, sorted(pending.values(), key=lambda item: item[0].resize_width or float("inf"), reverse=True))
+
+	for index, image_compression in enumerate(compressions):
+		if image_compression.blob_key in pending:
+			encoded = pending[image_compression.blob_key][0]
+			compressions[index] = encoded if encoded is image_compression else encoded.model_copy(update={ "id": image_compression.id })
+
+	return compressions
+
+def _use_quality(filestore_dir: str, source_hash: str, image_compression: UserImageCompression, candidate: QualityCandidate) -> bool:
+	# points an automatic-quality compression at the blob of the quality it settled on,
+	# True if that blob already exists
+	image_compression.quality = candidate.quality
+	image_compression.ssim = candidate.ssim
+	image_compression.psnr = candidate.psnr
+	image_compression.blob_key = compression_cache_key(source_hash, candidate.quality, image_compression.resize_width, image_compression.output_format, image_compression.resample)
+	image_compression.path = compression_blob_path(filestore_dir, image_compression.blob_key, image_compression.output_format)
+	if path.exists(image_compression.path):
+		os.utime(image_compression.path)
+		image_compression.size = os.stat(image_compression.path).st_size
+		return True
+	return False
+
+def _write_blob(image_compression: UserImageCompression, write):
+	fd, save_path = mkstemp_in(path.dirname(image_compression.path), suffix=f".{image_compression.output_format}")
+	try:
+		with time_stage("compression", "encode"), os.fdopen(fd, "wb") as save_file:
+			write(save_file)
+	except BaseException:
+		Path(save_path).unlink(missing_ok=True)
+		raise
+
+	# identical concurrent encodes produce the same bytes, so the last rename wins harmlessly
+	with time_stage("compression", "stat"):
+		os.replace(save_path, image_compression.path)
+		image_compression.size = os.stat(image_compression.path).st_size
+
+def _encode_compressions(filestore_dir: str, source_hash: str, source_path: str, pending: list):
+	with time_stage("compression", "open"):
+		img = Image.open(source_path)
+	with img:
+		if is_animated(img):
+			animations = [(image_compression, variant) for image_compression, variant in pending if image_compression.output_format in ANIMATED_FORMATS]
+			pending = [(image_compression, variant) for image_compression, variant in pending if image_compression.output_format not in ANIMATED_FORMATS]
+			for image_compression, variant in animations:
+				_encode_animation(filestore_dir, source_hash, source_path, image_compression, variant)
+			if len(pending) == 0:
+				return
+
+		# sized from the header before anything is decoded, see utils/image_memory.py
+		widths = [image_compression.resize_width for image_compression, _ in pending]
+		largest = None if any(width is None or width >= img.size[0] for width in widths) else max(widths)
+		with time_stage("compression", "decode"):
+			source = load_within_budget(img, largest, current_settings.image_job_memory_budget_bytes, current_settings.compression_reducing_gap)
+			if source is img and largest is not None and img.format == "JPEG":
+				# what the first resize would draft anyway, decoded here so it's timed apart
+				img.draft(img.mode, target_size(img.size, largest))
+			source.load()
+
+		resized = {}
+		for image_compression, variant in pending:
+			final_image = source
+			if image_compression.resize_width is not None:
+				previous = resized.get(image_compression.resample, source)
+				if previous is not source and previous.size[0] == image_compression.resize_width:
+					final_image = previous
+				else:
+					with time_stage("compression", "resize"):
+						final_image = resize_image(previous, image_compression.resize_width, image_compression.resample)
+				if image_compression.resize_width < source.size[0]:
+					resized[image_compression.resample] = final_image
+
+			if is_auto_quality(variant):
+				with time_stage("compression", "encode"):
+					candidate = choose_quality(final_image, image_compression.output_format, variant)
+				if not _use_quality(filestore_dir, source_hash, image_compression, candidate):
+					_write_blob(image_compression, lambda save_file: save_file.write(candidate.data))
+				continue
+
+			_write_blob(image_compression, lambda save_file: encode_image(final_image, image_compression.output_format, image_compression.quality, save_file))
+
+# Animated GIF sources keep their animation when written as GIF or WebP, streamed
+# one frame at a time (see utils/image_animation.py); other formats get the first
+# frame. Automatic quality is scored on the first frame, byte budgets don't apply.
+ANIMATED_FORMATS = ("gif", "webp")
+
+def _encode_animation(filestore_dir: str, source_hash: str, source_path: str, image_compression: UserImageCompression, variant: CompressionVariant):
+	with time_stage("compression", "open"):
+		animation = Image.open(source_path)
+	with animation:
+		# frames are composited into a full canvas, one at a time
+		budget = current_settings.image_job_memory_budget_bytes
+		if budget is not None and decoded_bytes("RGBA", animation.size) > budget:
+			raise ImageOverMemoryBudget(f"A {animation.size[0]}x{animation.size[1]} animation is over the {budget} byte budget per frame")
+
+		def transform(frame: Image.Image) -> Image.Image:
+			if image_compression.resize_width is None:
+				return frame
+			return resize_image(frame, image_compression.resize_width, image_compression.resample)
+
+		if is_auto_quality(variant):
+			with time_stage("compression", "encode"):
+				first = transform(animation.convert("RGBA" if has_alpha(animation) else "RGB"))
+				candidate = choose_quality(first, image_compression.output_format, variant.model_copy(update={ "max_bytes": None }))
+			if _use_quality(filestore_dir, source_hash, image_compression, candidate):
+				return
+			animation.seek(0)
+
+		if image_compression.output_format == "gif":
+			_write_blob(image_compression, lambda save_file: write_gif_animation(animation, transform, palette_colors(image_compression.quality), save_file))
+		else:
+			_write_blob(image_compression, lambda save_file: write_webp_animation(animation, transform, save_file, image_compression.quality, current_settings.compression_webp_method))
 
-		if user_image.extension == 'jpeg':
-			final_image.save(save_path, format='JPEG', quality=quality, optimize=True)
-		elif user_image.extension == 'png':
-			final_image.save(save_path, format='PNG', optimize=True)
-		elif user_image.extension == 'gif':
-			final_image.save(save_path, optimize=True)
+def _evict_orphaned_blobs():
+	evict_orphaned_compression_blobs(current_settings.db_file_path)
 
+def delete_user_images(user_id: str, image_ids: list) -> list:
+	# the records go in one transaction; the originals, previews and unshared
+	# compression files are unlinked in the background by the reaper, which then
+	# removes the blobs the delete left unreferenced (see evict_compression_blobs)
+	deleted = delete_user_images_db(current_settings.db_file_path, user_id, image_ids)
 
-		image_compression.size = os.stat(save_path).st_size
+	paths = []
+	blob_keys = set()
+	for image, compressions in deleted:
+		paths.append(image.path)
+		paths += (image.previews or {}).values()
+		paths += [compression.path for compression in compressions if compression.blob_key is None]
+		blob_keys.update(compression.blob_key for compression in compressions if compression.blob_key is not None)
 
-		return image_compression
+	after_batch = None
+	if len(blob_keys) > 0:
+		after_batch = lambda: evict_compression_blobs(current_settings.db_file_path, blob_keys)
+	get_file_reaper().queue_unlinks(paths, after_batch)
+	return [image for image, _ in deleted]
 
 def delete_user_image_compression_fs(compression: UserImageCompression):
+	if compression.blob_key is not None:
+		# shared blobs are only removed once unreferenced, and then only by eviction,
+		# which scans every blob so it runs on the reaper instead of the request
+		get_file_reaper().queue_unlinks([], _evict_orphaned_blobs)
+		return True
+
 	path = Path(compression.path, missing_ok=True)
 	try:
 		path.unlink()
@@ -89,4 +579,53 @@ def delete_user_image_compression_fs(compression: UserImageCompression):
 
 
 	return True
+
+def evict_orphaned_compression_blobs(db_file_path: str, max_bytes: Union[None, int] = None):
+	# unreferenced blobs stay around as a cache until they exceed the size budget, then
+	# the least recently used go first. Recently used blobs are skipped so a compression
+	# being created from (or re-encoding into) a blob can't lose it mid-request.
+	if max_bytes is None:
+		max_bytes = current_settings.compression_cache_max_bytes
+
+	orphans = [blob for blob in get_compression_blobs_db(open_db(db_file_path)).values() if len(blob.get("refs", {})) == 0]
+	orphan_bytes = sum(blob.get("size", 0) for blob in orphans)
+	cutoff = time.time() - current_settings.compression_cache_grace_seconds
+
+	evicted = []
+	for blob in sorted(orphans, key=lambda blob: blob.get("last_used", 0)):
+		if orphan_bytes <= max_bytes:
+			break
+		if blob.get("last_used", 0) > cutoff:
+			continue
+		if _evict_blob(db_file_path, blob, cutoff):
+			orphan_bytes -= blob.get("size", 0)
+			evicted.append(blob["key"])
+
+	return evicted
+
+def _evict_blob(db_file_path: str, blob: dict, cutoff: float) -> bool:
+	try:
+		if os.stat(blob["path"]).st_mtime > cutoff:
+			return False
+	except FileNotFoundError:
+		pass
+
+	if not delete_orphaned_compression_blob_db(db_file_path, blob["key"], cutoff):
+		return False
+	Path(blob["path"]).unlink(missing_ok=True)
+	return True
+
+def evict_compression_blobs(db_file_path: str, keys: Iterable[str]) -> list:
+	# blobs whose last reference went with a deleted image are removed right away
+	# instead of waiting for the cache budget. Ones used within the grace period (or
+	# referenced again since) stay, and are left to the budgeted eviction above
+	cutoff = time.time() - current_settings.compression_cache_grace_seconds
+	db = open_db(db_file_path)
+	evicted = []
+	for key in keys:
+		blob = get_compression_blob_db(db, key)
+		if blob is not None and len(blob.get("refs", {})) == 0 and _evict_blob(db_file_path, blob, cutoff):
+			evicted.append(key)
+
+	return evicted
  
\ No newline at end of file
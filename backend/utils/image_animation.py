@@ -0,0 +1,191 @@
+import io
+import math
+from typing import BinaryIO, Callable, Iterator, Union
+
+from PIL import Image, ImageChops, ImageSequence
+
+# Animated sources are streamed frame by frame with ImageSequence, so memory scales
+# with one frame (plus the previous one, for differencing) rather than the whole
+# animation. Pillow's own multi-frame writers collect every frame first, so both
+# containers are written here, with Pillow encoding one frame at a time:
+#   - GIF: one shared palette (sized by quality) built from a sample of frames spread
+#     over the animation, each frame cropped to the region that changed since the
+#     previous one and LZW-encoded with Image.tobytes("gif")
+#   - WebP: each frame is encoded as a WebP still, whose bitstream chunks go into an
+#     ANMF frame of an animated WebP (cropped the same way, drawn without blending)
+# Identical consecutive frames are merged into one longer frame in both.
+# `transform` turns a source frame (RGB or RGBA) into the output frame, e.g. a resize.
+
+# frames sampled for the shared GIF palette, reduced to fill about one frame together
+PALETTE_SAMPLE_FRAMES = 8
+
+def is_animated(img: Image.Image) -> bool:
+	return getattr(img, "is_animated", False) and getattr(img, "n_frames", 1) > 1
+
+def has_alpha(img: Image.Image) -> bool:
+	return img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+
+def iter_frames(source: Image.Image, transform: Callable[[Image.Image], Image.Image], alpha: bool) -> Iterator[tuple]:
+	# (frame, duration in ms), lazily; Pillow composites every frame onto the canvas
+	for frame in ImageSequence.Iterator(source):
+		yield transform(frame.convert("RGBA" if alpha else "RGB")), frame.info.get("duration", 0)
+
+def _color_table_bits(colors: int) -> int:
+	# GIF color tables hold 2 ** (bits + 1) entries
+	return max(0, math.ceil(math.log2(max(2, colors))) - 1)
+
+def _gif_header(size: tuple, palette: list, loop: Union[int, None]) -> bytes:
+	bits = _color_table_bits(len(palette) // 3)
+	table = bytes(palette) + bytes(3 * 2 ** (bits + 1) - len(palette))
+	header = b"GIF89a" + size[0].to_bytes(2, "little") + size[1].to_bytes(2, "little") + bytes([0x80 | bits, 0, 0]) + table
+	if loop is not None:
+		header += b"!\xff\x0bNETSCAPE2.0\x03\x01" + loop.to_bytes(2, "little") + b"\x00"
+	return header
+
+def _indexes(frame: Image.Image) -> Image.Image:
+	# a P image's raw indexes, for comparing frames without their palette
+	return Image.frombytes("L", frame.size, frame.tobytes())
+
+def _sample_palette(source: Image.Image, transform: Callable[[Image.Image], Image.Image], alpha: bool, colors: int) -> Image.Image:
+	# frames spread evenly over the animation, each squeezed into a strip of one
+	# output frame's size, so later frames' colors get a place in the palette too
+	samples = min(getattr(source, "n_frames", 1), PALETTE_SAMPLE_FRAMES)
+	picks = sorted({ round(index * (getattr(source, "n_frames", 1) - 1) / max(1, samples - 1)) for index in range(samples) })
+	strip = None
+	for index, frame in enumerate(ImageSequence.Iterator(source)):
+		if index > picks[-1]:
+			break
+		if index not in picks:
+			continue
+		sample = transform(frame.convert("RGBA" if alpha else "RGB")).convert("RGB")
+		if strip is None:
+			tile = (sample.width, max(1, sample.height // len(picks)))
+			strip = Image.new("RGB", (tile[0], tile[1] * len(picks)))
+		strip.paste(sample.resize(tile, Image.Resampling.BOX), (0, picks.index(index) * tile[1]))
+	source.seek(0)
+	return strip.quantize(colors, method=Image.Quantize.MEDIANCUT)
+
+def _gif_frame(frame: Image.Image, offset: tuple, duration: int, disposal: int, transparency: Union[int, None]) -> bytes:
+	# graphic control extension, image descriptor (no local color table) and the
+	# LZW-coded indexes as sub-blocks, after their minimum code size
+	flags = disposal << 2 | (0 if transparency is None else 1)
+	control = b"!\xf9\x04" + bytes([flags]) + min(duration // 10, 0xFFFF).to_bytes(2, "little") + bytes([transparency or 0, 0])
+	descriptor = b"," + b"".join(value.to_bytes(2, "little") for value in offset + frame.size) + b"\x00"
+	return control + descriptor + b"\x08" + frame.tobytes("gif", "P") + b"\x00"
+
+def write_gif_animation(source: Image.Image, transform: Callable[[Image.Image], Image.Image], colors: int, file: BinaryIO, dither: bool = True) -> int:
+	alpha = has_alpha(source)
+	# one palette for every frame, with an index left over for transparency
+	palette_image = _sample_palette(source, transform, alpha, colors - 1 if alpha else colors)
+	palette = palette_image.getpalette()[:3 * (colors - 1 if alpha else colors)]
+	transparency = None
+	if alpha:
+		transparency = len(palette) // 3
+		palette += [0, 0, 0]
+	previous = None
+	pending = None
+	written = 0
+
+	def write(frame: Image.Image, offset: tuple, duration: int):
+		file.write(_gif_frame(frame, offset, duration, 2 if alpha else 1, transparency))
+
+	for frame, duration in iter_frames(source, transform, alpha):
+		if previous is None:
+			file.write(_gif_header(frame.size, palette, source.info.get("loop")))
+
+		indexed = frame.convert("RGB").quantize(palette=palette_image, dither=Image.Dither.FLOYDSTEINBERG if dither else Image.Dither.NONE)
+		if alpha:
+			indexed.paste(transparency, mask=frame.getchannel("A").point(lambda value: 255 if value < 128 else 0))
+
+		if previous is None:
+			bbox = (0, 0) + indexed.size
+		else:
+			bbox = ImageChops.difference(_indexes(previous), _indexes(indexed)).getbbox()
+			if bbox is None:
+				# a duplicate, shown for longer instead of written again
+				pending[2] += duration
+				continue
+			if alpha:
+				# disposed to the background, so every frame is drawn in full
+				bbox = (0, 0) + indexed.size
+
+		if pending is not None:
+			write(*pending)
+			written += 1
+		pending = [indexed.crop(bbox), bbox[:2], duration]
+		previous = indexed
+
+	if pending is not None:
+		write(*pending)
+		written += 1
+	file.write(b";")
+	return written
+
+def _riff_chunk(fourcc: bytes, payload: bytes) -> bytes:
+	return fourcc + len(payload).to_bytes(4, "little") + payload + bytes(len(payload) % 2)
+
+def _webp_header(size: tuple, alpha: bool, loop: int) -> bytes:
+	# RIFF (its length is filled in once every frame is written), VP8X with the
+	# animation flag, and ANIM: a transparent background and the loop count
+	flags = 0x02 | (0x10 if alpha else 0)
+	canvas = bytes([flags, 0, 0, 0]) + (size[0] - 1).to_bytes(3, "little") + (size[1] - 1).to_bytes(3, "little")
+	return b"RIFF" + bytes(4) + b"WEBP" + _riff_chunk(b"VP8X", canvas) + _riff_chunk(b"ANIM", bytes(4) + loop.to_bytes(2, "little"))
+
+def _webp_frame(frame: Image.Image, offset: tuple, duration: int, quality: int, method: int) -> bytes:
+	# the frame encoded as a WebP still, keeping only its bitstream chunks (ALPH and
+	# VP8, or VP8L). Offsets are stored halved, and frames aren't blended, so their
+	# pixels (transparent ones too) replace the canvas under them
+	still = io.BytesIO()
+	frame.save(still, format="WEBP", quality=quality, lossless=quality >= 100, method=method)
+	data = still.getvalue()
+	chunks = []
+	position = 12
+	while position < len(data):
+		size = int.from_bytes(data[position + 4:position + 8], "little")
+		end = position + 8 + size + size % 2
+		if data[position:position + 4] in (b"ALPH", b"VP8 ", b"VP8L"):
+			chunks.append(data[position:end])
+		position = end
+	header = b"".join(value.to_bytes(3, "little") for value in (offset[0] // 2, offset[1] // 2, frame.width - 1, frame.height - 1, min(duration, 0xFFFFFF)))
+	return _riff_chunk(b"ANMF", header + b"\x02" + b"".join(chunks))
+
+def write_webp_animation(source: Image.Image, transform: Callable[[Image.Image], Image.Image], file: BinaryIO, quality: int, method: int) -> int:
+	alpha = has_alpha(source)
+	start = file.tell()
+	previous = None
+	pending = None
+	written = 0
+
+	def write(frame: Image.Image, offset: tuple, duration: int):
+		if written == 0:
+			file.write(_webp_header(previous.size, alpha, source.info.get("loop", 0)))
+		file.write(_webp_frame(frame, offset, duration, quality, method))
+
+	for frame, duration in iter_frames(source, transform, alpha):
+		if previous is None:
+			bbox = (0, 0) + frame.size
+		else:
+			bbox = ImageChops.difference(previous, frame).getbbox(alpha_only=False)
+			if bbox is None:
+				# a duplicate, shown for longer instead of written again
+				pending[2] += duration
+				continue
+			bbox = (bbox[0] - bbox[0] % 2, bbox[1] - bbox[1] % 2) + bbox[2:]
+
+		if pending is not None:
+			write(*pending)
+			written += 1
+		pending = [frame.crop(bbox), bbox[:2], duration]
+		previous = frame
+
+	if written == 0:
+		# every frame was the same, so it's a still
+		pending[0].save(file, format="WEBP", quality=quality, lossless=quality >= 100, method=method)
+		return 1
+
+	write(*pending)
+	end = file.tell()
+	file.seek(start + 4)
+	file.write((end - start - 8).to_bytes(4, "little"))
+	file.seek(end)
+	return written + 1
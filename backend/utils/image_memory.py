@@ -0,0 +1,174 @@
+import io
+import math
+import struct
+import zlib
+from typing import BinaryIO, Iterator, Union
+
+from PIL import Image
+
+# Memory budgeting for decodes. A raster's decoded size is known from its header
+# (width x height x Pillow's bytes per pixel) before any pixel is decoded, so a job
+# can decide up front whether the source fits its budget:
+#   - it fits: decode as usual (JPEGs still draft for the target size)
+#   - a JPEG that fits once drafted for the target width: decode as usual
+#   - a non-interlaced 8-bit PNG: decode and box-reduce it strip by strip, so only
+#     a strip of the source and the reduced result are ever in memory
+#   - anything else, or a full-size output of an oversized source: rejected
+# The strip decoder inflates the IDAT stream itself and hands each strip to Pillow
+# as a small PNG whose first row is the previous raw row (filter "none"), so the
+# strip's own row filters, which refer to the row above, unfilter correctly.
+
+class ImageOverMemoryBudget(Exception):
+	pass
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# bytes per pixel of the raw 8-bit scanlines, by PNG color type
+PNG_CHANNELS = { 0: 1, 2: 3, 3: 1, 4: 2, 6: 4 }
+# raw scanline bytes per strip, a strip's decode needs a few times this
+STRIP_BYTES = 1024 * 1024
+
+def pixel_bytes(mode: str) -> int:
+	# Pillow keeps every multi-band pixel in 4 bytes (RGB is stored as RGBX)
+	if Image.getmodebands(mode) > 1 or mode in ("I", "F"):
+		return 4
+	return 2 if mode.startswith("I;16") else 1
+
+def decoded_bytes(mode: str, size: tuple) -> int:
+	return size[0] * size[1] * pixel_bytes(mode)
+
+def target_size(size: tuple, width: int) -> tuple:
+	return (width, max(1, int(size[1] * width / size[0])))
+
+def jpeg_draft_scale(size: tuple, width: int) -> int:
+	# the largest 1/scale that draft() would pick without going below the target
+	target = target_size(size, width)
+	for scale in (8, 4, 2):
+		if math.ceil(size[0] / scale) >= target[0] and math.ceil(size[1] / scale) >= target[1]:
+			return scale
+	return 1
+
+def estimate_decoded_bytes(img: Image.Image, width: Union[int, None] = None) -> int:
+	size = img.size
+	if img.format == "JPEG" and width is not None and width < size[0]:
+		scale = jpeg_draft_scale(size, width)
+		size = (math.ceil(size[0] / scale), math.ceil(size[1] / scale))
+	return decoded_bytes(img.mode, size)
+
+def _read_chunk(file: BinaryIO) -> tuple:
+	header = file.read(8)
+	if len(header) < 8:
+		raise SyntaxError("Truncated PNG")
+	length, chunk_type = struct.unpack(">I4s", header)
+	data = file.read(length)
+	file.read(4)
+	return chunk_type, data
+
+def _chunk(chunk_type: bytes, data: bytes) -> bytes:
+	return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+def _idat_chunks(file: BinaryIO, data: bytes) -> Iterator[bytes]:
+	# the first IDAT chunk has already been read, the rest follow it back to back
+	yield data
+	chunk_type, data = _read_chunk(file)
+	while chunk_type == b"IDAT":
+		yield data
+		chunk_type, data = _read_chunk(file)
+
+def supports_png_strips(file_path: str) -> bool:
+	with open(file_path, "rb") as file:
+		if file.read(8) != PNG_SIGNATURE:
+			return False
+		chunk_type, data = _read_chunk(file)
+	_, _, depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", data)
+	return chunk_type == b"IHDR" and depth == 8 and interlace == 0 and color_type in PNG_CHANNELS
+
+def iter_png_strips(file_path: str, strip_rows: Union[int, None] = None) -> Iterator[Image.Image]:
+	with open(file_path, "rb") as file:
+		if file.read(8) != PNG_SIGNATURE:
+			raise SyntaxError("Not a PNG")
+
+		chunk_type, ihdr = _read_chunk(file)
+		width, height, depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", ihdr)
+		if chunk_type != b"IHDR" or depth != 8 or interlace != 0 or color_type not in PNG_CHANNELS:
+			raise ImageOverMemoryBudget("Only non-interlaced 8-bit PNGs can be decoded in strips")
+
+		# palette and transparency have to travel with every strip
+		extra = b""
+		chunk_type, data = _read_chunk(file)
+		while chunk_type != b"IDAT":
+			if chunk_type in (b"PLTE", b"tRNS"):
+				extra += _chunk(chunk_type, data)
+			if chunk_type == b"IEND":
+				raise SyntaxError("PNG without image data")
+			chunk_type, data = _read_chunk(file)
+
+		stride = 1 + width * PNG_CHANNELS[color_type]
+		if strip_rows is None:
+			strip_rows = strip_rows_for(stride)
+		idat = _idat_chunks(file, data)
+		inflater = zlib.decompressobj()
+		compressed = b""
+		pending = bytearray()
+		previous = None
+		row = 0
+		while row < height:
+			rows = min(strip_rows, height - row)
+			while len(pending) < rows * stride:
+				if not compressed:
+					compressed = next(idat, b"")
+					if not compressed:
+						raise SyntaxError("Truncated PNG image data")
+				pending += inflater.decompress(compressed, rows * stride - len(pending))
+				compressed = inflater.unconsumed_tail
+
+			scanlines = bytes(pending[:rows * stride])
+			del pending[:rows * stride]
+			prefix = b"" if previous is None else b"\x00" + previous
+			strip_height = rows + (0 if previous is None else 1)
+			strip_ihdr = struct.pack(">IIBBBBB", width, strip_height, depth, color_type, 0, 0, 0)
+			png = PNG_SIGNATURE + _chunk(b"IHDR", strip_ihdr) + extra + _chunk(b"IDAT", zlib.compress(prefix + scanlines, 0)) + _chunk(b"IEND", b"")
+
+			with Image.open(io.BytesIO(png)) as strip:
+				strip.load()
+				if previous is not None:
+					strip = strip.crop((0, 1, width, strip_height))
+				previous = strip.crop((0, rows - 1, width, rows)).tobytes()
+				yield strip
+			row += rows
+
+def strip_rows_for(stride: int, multiple: int = 1) -> int:
+	return multiple * max(1, STRIP_BYTES // stride // multiple)
+
+def reduce_png_in_strips(file_path: str, size: tuple, factor: int) -> Image.Image:
+	# box-reduces by a whole factor, strips are a multiple of it so boxes never straddle two
+	strip_rows = strip_rows_for(1 + size[0] * 4, factor)
+	reduced = None
+	top = 0
+	for strip in iter_png_strips(file_path, strip_rows):
+		if strip.mode in ("P", "PA", "LA"):
+			strip = strip.convert("RGBA" if strip.mode != "P" or "transparency" in strip.info else "RGB")
+		part = strip.reduce(factor) if factor > 1 else strip
+		if reduced is None:
+			reduced = Image.new(part.mode, (math.ceil(size[0] / factor), math.ceil(size[1] / factor)))
+		reduced.paste(part, (0, top))
+		top += part.size[1]
+	return reduced
+
+def load_within_budget(img: Image.Image, width: Union[int, None], budget: Union[int, None], reducing_gap: Union[float, None] = None) -> Image.Image:
+	# `width` is the largest output width needed (None for full size). Returns img
+	# itself when it can be decoded normally, or a smaller, already decoded copy
+	if budget is None or estimate_decoded_bytes(img, width) <= budget:
+		return img
+
+	if width is None or width >= img.size[0] or img.format != "PNG" or not supports_png_strips(img.filename):
+		raise ImageOverMemoryBudget(f"A {img.size[0]}x{img.size[1]} {img.format} needs {estimate_decoded_bytes(img, width)} bytes decoded, over the {budget} byte budget")
+
+	# reduce just enough to fit the budget (and by the reducing gap), never below the target
+	largest = img.size[0] // width
+	factor = math.ceil(math.sqrt(decoded_bytes("RGBA", img.size) / budget))
+	if reducing_gap is not None:
+		factor = max(factor, int(img.size[0] // (width * reducing_gap)))
+	if factor > largest:
+		raise ImageOverMemoryBudget(f"A {img.size[0]}x{img.size[1]} PNG can't be reduced to {width}px wide within {budget} bytes")
+
+	return reduce_png_in_strips(img.filename, img.size, factor)
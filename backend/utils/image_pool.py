@@ -0,0 +1,191 @@
+import asyncio
+from concurrent.futures import Future, ProcessPoolExecutor
+import multiprocessing
+import resource
+import sys
+import threading
+import time
+from typing import Callable, Union
+
+from utils.settings import current_settings
+from utils.log_config import api_logger
+from utils.metrics import finish_job_stages, metrics_enabled, observe_stages, start_job_stages
+
+# Pillow work (decode, resize, encode) runs in a process pool so it never blocks the
+# event loop. At most `image_pool_workers + image_pool_queue_size` jobs are accepted
+# at once, anything beyond that is rejected up front with ImagePoolBusy.
+
+# Each job also reports its worker's peak RSS, to size workers and their memory
+# budget (IMAGE_JOB_MEMORY_BUDGET_BYTES) against real inputs. On linux the worker's
+# high-water mark is reset before every job, so the peak is that job's own.
+# Elsewhere it is the worker's peak so far, an upper bound. Stage timings (see
+# utils/metrics.py) come back the same way.
+
+def peak_rss_bytes() -> int:
+    try:
+        with open("/proc/self/status", "r") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+def run_measured(fn: Callable, args: tuple, kwargs: dict, record_stages: bool = False) -> tuple:
+    reset_peak_rss()
+    start_job_stages(record_stages)
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        stages = finish_job_stages()
+    return result, peak_rss_bytes(), stages
+
+class ImagePoolBusy(Exception):
+    pass
+
+class ImageJobTimeout(Exception):
+    pass
+
+class ImagePool:
+    def __init__(self, workers: int, queue_size: int, timeout_seconds: float):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout_seconds = timeout_seconds
+        self._executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.failed = 0
+        self.completed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.peak_rss_total = 0
+        self.peak_rss_max = 0
+        self.peak_rss_last = 0
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        with self._lock:
+            if self.in_flight >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise ImagePoolBusy()
+            self.in_flight += 1
+            self.submitted += 1
+
+        started = time.perf_counter()
+        try:
+            measured = self._executor.submit(run_measured, fn, args, kwargs, metrics_enabled())
+        except BaseException:
+            with self._lock:
+                self.in_flight -= 1
+            raise
+
+        # callers get the job's own result, the peak RSS only goes into the stats
+        future = Future()
+        future.add_done_callback(lambda done: measured.cancel() if done.cancelled() else None)
+
+        def on_done(done: Future):
+            # a job keeps its slot until the worker actually finishes it, even if the
+            # request that submitted it already gave up waiting
+            latency = time.perf_counter() - started
+            error = None if done.cancelled() else done.exception()
+            with self._lock:
+                self.in_flight -= 1
+                if done.cancelled() or error is not None:
+                    self.failed += 1
+                else:
+                    result, peak_rss, stages = done.result()
+                    self.completed += 1
+                    self.latency_total += latency
+                    self.latency_max = max(self.latency_max, latency)
+                    self.peak_rss_total += peak_rss
+                    self.peak_rss_max = max(self.peak_rss_max, peak_rss)
+                    self.peak_rss_last = peak_rss
+            if error is None and not done.cancelled():
+                observe_stages(stages)
+
+            if future.cancelled():
+                return
+            if done.cancelled():
+                future.cancel()
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                api_logger.debug(f"Image job {getattr(fn, '__name__', fn)} took {latency:.3f}s with a peak RSS of {peak_rss} bytes")
+                future.set_result(result)
+
+        measured.add_done_callback(on_done)
+        return future
+
+    def available(self) -> int:
+        with self._lock:
+            return max(0, self.workers + self.queue_size - self.in_flight)
+
+    async def wait(self, future: Future, timeout_seconds: Union[float, None] = None):
+        # jobs doing several units of work (e.g. a batch of variants) pass a longer timeout
+        timeout_seconds = self.timeout_seconds if timeout_seconds is None else timeout_seconds
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout_seconds)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timed_out += 1
+            api_logger.info(f"Image job timed out after {timeout_seconds}s")
+            raise ImageJobTimeout()
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        return await self.wait(self.submit(fn, *args, **kwargs))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "in_flight": self.in_flight,
+                "queue_depth": max(0, self.in_flight - self.workers),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "latency_avg_seconds": self.latency_total / self.completed if self.completed else 0.0,
+                "latency_max_seconds": self.latency_max,
+                "peak_rss_avg_bytes": self.peak_rss_total // self.completed if self.completed else 0,
+                "peak_rss_max_bytes": self.peak_rss_max,
+                "peak_rss_last_bytes": self.peak_rss_last,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+_pool: Union[ImagePool, None] = None
+_pool_lock = threading.Lock()
+
+def get_image_pool() -> ImagePool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ImagePool(current_settings.image_pool_workers, current_settings.image_pool_queue_size, current_settings.image_job_timeout_seconds)
+        return _pool
+
+async def run_image_job(fn: Callable, *args, **kwargs):
+    return await get_image_pool().run(fn, *args, **kwargs)
+
+def get_image_pool_stats() -> dict:
+    return get_image_pool().stats()
+
+def shutdown_image_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
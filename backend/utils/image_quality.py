@@ -0,0 +1,47 @@
+import math
+
+import numpy as np
+from PIL import Image
+
+# Perceptual scores for picking a compression quality automatically. Both compare
+# luma only (where compression artifacts are most visible) on arrays reduced to at
+# most `max_size` px on their longest side, which keeps a score to a few
+# milliseconds even for large images.
+
+SSIM_WINDOW = 8
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+# identical images, instead of an infinite ratio that wouldn't serialize
+PSNR_MAX = 100.0
+
+def luma_array(img: Image.Image, max_size: int) -> np.ndarray:
+	img = img.convert("L")
+	factor = max(img.size) // max_size
+	if factor > 1:
+		# box averaging by a whole factor, the same for the source and every candidate
+		img = img.reduce(factor)
+	return np.asarray(img, dtype=np.float64)
+
+def _window_means(values: np.ndarray, size: int) -> np.ndarray:
+	# the mean of every size x size window, from a summed-area table
+	table = np.pad(values, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+	return (table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size]) / (size * size)
+
+def ssim(reference: np.ndarray, candidate: np.ndarray) -> float:
+	# mean structural similarity over sliding windows with uniform weights
+	size = max(1, min(SSIM_WINDOW, *reference.shape))
+	mean_x = _window_means(reference, size)
+	mean_y = _window_means(candidate, size)
+	var_x = _window_means(reference * reference, size) - mean_x * mean_x
+	var_y = _window_means(candidate * candidate, size) - mean_y * mean_y
+	covariance = _window_means(reference * candidate, size) - mean_x * mean_y
+
+	numerator = (2 * mean_x * mean_y + SSIM_C1) * (2 * covariance + SSIM_C2)
+	denominator = (mean_x * mean_x + mean_y * mean_y + SSIM_C1) * (var_x + var_y + SSIM_C2)
+	return float(np.mean(numerator / denominator))
+
+def psnr(reference: np.ndarray, candidate: np.ndarray) -> float:
+	mse = float(np.mean((reference - candidate) ** 2))
+	if mse == 0:
+		return PSNR_MAX
+	return min(PSNR_MAX, 10 * math.log10(255 ** 2 / mse))
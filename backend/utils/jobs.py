@@ -0,0 +1,231 @@
+import asyncio
+from concurrent.futures import Future
+from datetime import datetime
+import time
+from typing import Union
+import uuid
+
+from utils.settings import current_settings
+from utils.auth import forget_negotiated_downloads
+from utils.db import QuotaExceeded, complete_compression_job_db, compression_quota_exceeded_db, delete_compression_jobs_db, get_user_image_db, set_user_image_previews_db, get_compression_job_db, get_compression_jobs_db, get_user_image_compression_db, get_user_image_compressions_db, open_db, set_compression_job_db, store_compression_jobs_db
+from utils.image import ByteBudgetUnreachable, create_and_store_user_image_compressions, create_user_image_previews, delete_user_image_previews_fs, find_cached_user_image_compression, is_auto_quality, resolve_output_format, resolve_resample
+from utils.image_memory import ImageOverMemoryBudget
+from utils.image_pool import ImageJobTimeout, ImagePoolBusy, get_image_pool
+from utils.types import DATE_FORMAT, JOB_DONE, JOB_FAILED, JOB_PENDING, CompressionJob, CompressionVariant, User, UserImage
+from utils.log_config import api_logger
+
+# Compression jobs are stored in db.jobs[imageId] so any worker can answer a status
+# poll, while the job itself is awaited by the worker that accepted it. If that
+# worker goes away the job would stay pending forever, so pending jobs carry a lease
+# (their batch's processing timeout plus COMPRESSION_JOB_LEASE_GRACE_SECONDS) and
+# read as failed once it has run out: they no longer count against the quota and
+# the variant can be submitted again.
+
+ABANDONED_JOB_ERROR = "Image processing was interrupted"
+QUOTA_JOB_ERROR = "User has used their storage quota"
+
+class CompressionQuotaExceeded(Exception):
+    pass
+
+_running_tasks: set = set()
+
+def job_lease_expired(job: CompressionJob, now: Union[float, None] = None) -> bool:
+    # jobs stored before leases existed have none and count as abandoned
+    return job.status == JOB_PENDING and (job.lease_expires_at is None or (now or time.time()) >= job.lease_expires_at)
+
+def with_expired_lease(job: CompressionJob, now: Union[float, None] = None) -> CompressionJob:
+    if not job_lease_expired(job, now):
+        return job
+    return job.model_copy(update={ "status": JOB_FAILED, "error": ABANDONED_JOB_ERROR })
+
+def find_matching_job(db, user_id: str, image_id: str, quality: int, resize_width: Union[int, None], resample: Union[str, None] = None, output_format: Union[str, None] = None, source_format: Union[str, None] = None, target_ssim: Union[float, None] = None, target_psnr: Union[float, None] = None, max_bytes: Union[int, None] = None) -> Union[CompressionJob, None]:
+    # records from before output formats were stored were written in the source format.
+    # A compression made through the synchronous route is returned as a new done job,
+    # which the caller stores
+    now = time.time()
+    for record in get_compression_jobs_db(db, image_id).values():
+        job = with_expired_lease(CompressionJob(**record), now)
+        if job.quality != quality or job.resize_width != resize_width or job.resample != resample or (job.output_format or source_format) != output_format:
+            continue
+        if job.target_ssim != target_ssim or job.target_psnr != target_psnr or job.max_bytes != max_bytes:
+            continue
+        if job.status == JOB_PENDING:
+            return job
+        if job.status == JOB_DONE and get_user_image_compression_db(db, image_id, job.compression_id) is not None:
+            return job
+
+    # compressions made through the synchronous route count as finished jobs too,
+    # except for automatic quality where the stored quality is the one that was picked
+    if target_ssim is not None or target_psnr is not None or max_bytes is not None:
+        return None
+    for record in get_user_image_compressions_db(db, image_id).values():
+        if record["quality"] == quality and record.get("resize_width") == resize_width and record.get("resample") == resample and (record.get("output_format") or source_format) == output_format:
+            date_string = datetime.now().strftime(DATE_FORMAT)
+            return CompressionJob(id = f"{uuid.uuid4()}", image_id = image_id, user_id = user_id, quality = quality, resize_width = resize_width, resample = resample, output_format = output_format, status = JOB_DONE, compression_id = record["id"], created_at = date_string)
+
+def count_pending_jobs(db, image_id: str) -> int:
+    now = time.time()
+    return len([record for record in get_compression_jobs_db(db, image_id).values() if record["status"] == JOB_PENDING and not job_lease_expired(CompressionJob(**record), now)])
+
+def batch_timeout_seconds(variant_count: int) -> float:
+    return get_image_pool().timeout_seconds * max(1, variant_count)
+
+def submit_compression_jobs(user: User, image: UserImage, variants: list[CompressionVariant]) -> list[CompressionJob]:
+    jobs = []
+    new_jobs = []
+
+    def build_jobs(reader) -> list:
+        # the lookups, quota check and inserts share one transaction
+        jobs.clear()
+        new_jobs.clear()
+        stored_jobs = get_compression_jobs_db(reader, image.id)
+        found_jobs = []
+        seen = {}
+        for variant in variants:
+            resample = resolve_resample(variant.resize_width, variant.resample)
+            output_format = resolve_output_format(image, variant.output_format)
+            key = (variant.quality, variant.resize_width, resample, output_format, variant.target_ssim, variant.target_psnr, variant.max_bytes)
+            if key not in seen:
+                job = find_matching_job(reader, user.id, image.id, variant.quality, variant.resize_width, resample, output_format, image.extension, variant.target_ssim, variant.target_psnr, variant.max_bytes)
+                if job is None:
+                    date_string = datetime.now().strftime(DATE_FORMAT)
+                    job = CompressionJob(id = f"{uuid.uuid4()}", image_id = image.id, user_id = user.id, quality = variant.quality, resize_width = variant.resize_width, resample = resample, output_format = output_format, target_ssim = variant.target_ssim, target_psnr = variant.target_psnr, max_bytes = variant.max_bytes, status = JOB_PENDING, created_at = date_string)
+                    new_jobs.append(job)
+                elif job.id not in stored_jobs:
+                    found_jobs.append(job)
+                seen[key] = job
+            jobs.append(seen[key])
+
+        if compression_quota_exceeded_db(reader, image.id, current_settings.max_compressions_per_image, count_pending_jobs(reader, image.id) + len(new_jobs)):
+            raise CompressionQuotaExceeded()
+
+        # new jobs are leased for the batch they're encoded in, at most all of them
+        lease_expires_at = time.time() + batch_timeout_seconds(len(new_jobs)) + current_settings.compression_job_lease_grace_seconds
+        for job in new_jobs:
+            job.lease_expires_at = lease_expires_at
+        return found_jobs + new_jobs
+
+    store_compression_jobs_db(current_settings.db_file_path, build_jobs)
+
+    db = open_db(current_settings.db_file_path)
+    encode_jobs = []
+    for job in new_jobs:
+        compression = None
+        if not is_auto_quality(job):
+            compression = find_cached_user_image_compression(current_settings.filestore_file_path, db, image, job.quality, job.resize_width, job.resample, job.output_format)
+        if compression is None:
+            encode_jobs.append(job)
+        else:
+            complete_job(job, compression)
+
+    if len(encode_jobs) > 0:
+        # the whole batch is one pool job, so the source is decoded once for all of it,
+        # and it gets IMAGE_JOB_TIMEOUT_SECONDS per variant
+        variants = [CompressionVariant(quality = job.quality, resize_width = job.resize_width, resample = job.resample, output_format = job.output_format, target_ssim = job.target_ssim, target_psnr = job.target_psnr, max_bytes = job.max_bytes) for job in encode_jobs]
+        try:
+            future = get_image_pool().submit(create_and_store_user_image_compressions, current_settings.filestore_file_path, user, image, variants)
+        except ImagePoolBusy:
+            # nothing will run them, so they're dropped rather than left to their lease
+            delete_compression_jobs_db(current_settings.db_file_path, image.id, [job.id for job in encode_jobs])
+            raise
+        task = asyncio.get_running_loop().create_task(finish_compression_jobs([job.model_copy() for job in encode_jobs], future, batch_timeout_seconds(len(encode_jobs))))
+        _running_tasks.add(task)
+        task.add_done_callback(_running_tasks.discard)
+
+    return [job.model_copy() for job in jobs]
+
+def complete_job(job: CompressionJob, compression):
+    try:
+        complete_compression_job_db(current_settings.db_file_path, job.model_copy(update={ "status": JOB_DONE, "compression_id": compression.id }), compression, current_settings.max_user_bytes)
+        job.status = JOB_DONE
+        job.compression_id = compression.id
+        forget_negotiated_downloads(job.image_id)
+    except QuotaExceeded:
+        # the encoded blob has no record, filestore_gc reclaims it
+        job.status = JOB_FAILED
+        job.error = QUOTA_JOB_ERROR
+        set_compression_job_db(current_settings.db_file_path, job)
+
+def job_error(e: Exception) -> str:
+    if isinstance(e, ImageJobTimeout):
+        return "Image processing timed out"
+    if isinstance(e, ImageOverMemoryBudget):
+        return "The image is too large to process at this size"
+    if isinstance(e, ByteBudgetUnreachable):
+        return "The image can't be compressed within max_bytes"
+    return "Image processing failed"
+
+async def finish_compression_jobs(jobs: list[CompressionJob], future: Future, timeout_seconds: Union[float, None] = None):
+    try:
+        compressions = await get_image_pool().wait(future, timeout_seconds)
+    except Exception as e:
+        api_logger.info(f"Compression jobs {', '.join(job.id for job in jobs)} failed: {e!r}")
+        for job in jobs:
+            job.status = JOB_FAILED
+            job.error = job_error(e)
+            set_compression_job_db(current_settings.db_file_path, job)
+        return
+
+    for job, compression in zip(jobs, compressions):
+        complete_job(job, compression)
+
+async def wait_for_compression_job(image_id: str, job_id: str, wait_seconds: float) -> Union[CompressionJob, None]:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(max(wait_seconds, 0), current_settings.compression_job_max_wait_seconds)
+    while True:
+        job = get_compression_job_db(open_db(current_settings.db_file_path), image_id, job_id)
+        if job is not None:
+            job = with_expired_lease(job)
+        if job is None or job.status != JOB_PENDING or loop.time() >= deadline:
+            return job
+
+        await asyncio.sleep(current_settings.compression_job_poll_seconds)
+
+# Previews are best effort: when the pool is saturated or the job fails, the image
+# is listed with its original and backfill_previews resubmits it the next time it is
+# listed, at most once every PREVIEW_RETRY_SECONDS per process.
+_preview_jobs: set = set()
+_preview_retry_at: dict = {}
+
+def submit_preview_job(image: UserImage) -> bool:
+    # False if the pool was too busy to take it
+    try:
+        future = get_image_pool().submit(create_user_image_previews, current_settings.filestore_file_path, image)
+    except ImagePoolBusy:
+        api_logger.info(f"Skipped previews for image {image.id}, the image pool is busy")
+        _preview_retry_at[image.id] = time.time() + current_settings.preview_retry_seconds
+        return False
+
+    _preview_jobs.add(image.id)
+    task = asyncio.get_running_loop().create_task(finish_preview_job(image.model_copy(), future))
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
+    return True
+
+def backfill_previews(images: list[UserImage]):
+    if len(current_settings.preview_sizes) == 0:
+        return
+
+    now = time.time()
+    for image in images:
+        if image.previews or image.id in _preview_jobs or _preview_retry_at.get(image.id, 0) > now:
+            continue
+        if not submit_preview_job(image):
+            return
+
+async def finish_preview_job(image: UserImage, future: Future):
+    try:
+        try:
+            image.previews = await get_image_pool().wait(future)
+        except Exception as e:
+            api_logger.info(f"Preview job for image {image.id} failed: {e!r}")
+            _preview_retry_at[image.id] = time.time() + current_settings.preview_retry_seconds
+            return
+
+        _preview_retry_at.pop(image.id, None)
+        set_user_image_previews_db(current_settings.db_file_path, image.user_id, image.id, image.previews)
+        if get_user_image_db(open_db(current_settings.db_file_path), image.user_id, image.id) is None:
+            delete_user_image_previews_fs(image)
+    finally:
+        # only once the previews are recorded, so a listing in between doesn't resubmit
+        _preview_jobs.discard(image.id)
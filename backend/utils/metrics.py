@@ -0,0 +1,193 @@
+from bisect import bisect_left
+import math
+import threading
+import time
+from typing import Callable, Iterable, Union
+
+from utils.settings import current_settings
+
+# Prometheus-style metrics, served by GET /metrics in the text exposition format.
+# Nothing is recorded unless METRICS_ENABLED is set: timers are a shared no-op and
+# counters return before taking their lock, so instrumented code pays one settings
+# lookup per call. Stats that already exist elsewhere (cache hits, pool queue depth,
+# db size) aren't duplicated here but read by collectors when /metrics is scraped.
+#
+# Image pool workers are separate processes that /metrics never sees, so stage
+# timings taken during a pool job are collected in the worker and sent back with
+# the job's result (see run_measured in utils/image_pool.py), then observed here.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def metrics_enabled() -> bool:
+    return current_settings.metrics_enabled
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, help: str, label_names: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        if not current_settings.metrics_enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{format_labels(self.label_names, labels)} {_format_value(value)}" for labels, value in values]
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+class _Timer:
+    __slots__ = ("_observe", "_started")
+
+    def __init__(self, observe: Callable[[float], None]):
+        self._observe = observe
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._observe(time.perf_counter() - self._started)
+        return False
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+class Histogram:
+    def __init__(self, name: str, help: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        # per label values: a count per bucket (the last one is +Inf), then sum and count
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 3)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, *labels):
+        # times a with block, or does nothing while metrics are disabled
+        if not current_settings.metrics_enabled:
+            return _NO_TIMER
+        return _Timer(lambda seconds: self.observe(seconds, *labels))
+
+    def count(self, *labels) -> int:
+        with self._lock:
+            series = self._series.get(labels)
+            return 0 if series is None else series[-1]
+
+    def render(self) -> list:
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        label_names = self.label_names + ("le",)
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(label_names, labels + (_format_value(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {_format_value(values[-2])}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {values[-1]}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "HTTP request latency by route", ("method", "route", "status"))
+STAGE_SECONDS = Histogram("image_stage_duration_seconds", "Time spent in each stage of storing or compressing an image", ("operation", "stage"))
+DB_SECONDS = Histogram("db_operation_duration_seconds", "Time spent reading, parsing and writing the db", ("operation",))
+CACHE_LOOKUPS = Counter("compression_cache_lookups_total", "Compression requests answered from an existing blob, or not", ("result",))
+
+_metrics = [REQUEST_SECONDS, STAGE_SECONDS, DB_SECONDS, CACHE_LOOKUPS]
+
+# A collector returns [(name, type, help, [(labels dict, value), ...]), ...], read
+# at scrape time
+_collectors: list = []
+
+def register_collector(collector: Callable[[], list]):
+    _collectors.append(collector)
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    for collector in _collectors:
+        for name, metric_type, help, samples in collector():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {metric_type}"]
+            lines += [f"{name}{format_labels(labels.keys(), labels.values())} {_format_value(value)}" for labels, value in samples]
+    return "\n".join(lines) + "\n"
+
+def reset_metrics():
+    for metric in _metrics:
+        metric.clear()
+
+# Stage timings taken inside an image pool job, None outside of one (False while the
+# job runs with metrics disabled)
+_job_stages: Union[list, bool, None] = None
+
+def start_job_stages(enabled: bool):
+    global _job_stages
+    _job_stages = [] if enabled else False
+
+def finish_job_stages() -> list:
+    global _job_stages
+    stages = _job_stages or []
+    _job_stages = None
+    return stages
+
+def observe_stages(stages: list):
+    for operation, stage, seconds in stages:
+        STAGE_SECONDS.observe(seconds, operation, stage)
+
+def time_stage(operation: str, stage: str):
+    if _job_stages is None:
+        return STAGE_SECONDS.time(operation, stage)
+    if _job_stages is False:
+        return _NO_TIMER
+    stages = _job_stages
+    return _Timer(lambda seconds: stages.append((operation, stage, seconds)))
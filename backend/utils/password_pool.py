@@ -0,0 +1,108 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import math
+import threading
+import time
+from typing import Callable, Union
+
+from utils.cache import LRUCache
+from utils.settings import current_settings
+
+# bcrypt costs a few hundred ms of CPU per check, so password verification runs in
+# its own small thread pool (bcrypt releases the GIL) instead of on the event loop.
+# Logins are admitted per username and per client address by a sliding window
+# limiter first, then shed with PasswordPoolBusy once the pool and its queue are
+# full, both before any hashing work is done.
+
+class PasswordPoolBusy(Exception):
+    pass
+
+class LoginRateLimited(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+class LoginLimiter:
+    def __init__(self, max_attempts: int, window_seconds: float, max_keys: int = 10000):
+        self.max_attempts = max_attempts
+        self.window_seconds = window_seconds
+        # bounded so a flood of distinct usernames can't grow it without limit
+        self._attempts = LRUCache(max_keys)
+        self._lock = threading.Lock()
+
+    def admit(self, key: str):
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._attempts.get(key)
+            if attempts is None:
+                attempts = deque()
+                self._attempts.put(key, attempts)
+
+            while attempts and attempts[0] <= now - self.window_seconds:
+                attempts.popleft()
+
+            if len(attempts) >= self.max_attempts:
+                raise LoginRateLimited(max(1, math.ceil(attempts[0] + self.window_seconds - now)))
+
+            attempts.append(now)
+
+    def reset(self, key: str):
+        self._attempts.pop(key)
+
+class PasswordPool:
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="password")
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    async def run(self, fn: Callable, *args):
+        with self._lock:
+            if self.in_flight >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise PasswordPoolBusy()
+            self.in_flight += 1
+
+        try:
+            return await asyncio.wrap_future(self._executor.submit(fn, *args))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return { "workers": self.workers, "queue_size": self.queue_size, "in_flight": self.in_flight, "rejected": self.rejected }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+_pool: Union[PasswordPool, None] = None
+_limiters: Union[dict, None] = None
+_pool_lock = threading.Lock()
+
+def get_password_pool() -> PasswordPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PasswordPool(current_settings.password_pool_workers, current_settings.password_pool_queue_size)
+        return _pool
+
+def get_login_limiters() -> dict:
+    global _limiters
+    with _pool_lock:
+        if _limiters is None:
+            _limiters = {
+                "username": LoginLimiter(current_settings.login_attempts_per_username, current_settings.login_attempt_window_seconds),
+                "client": LoginLimiter(current_settings.login_attempts_per_client, current_settings.login_attempt_window_seconds),
+            }
+        return _limiters
+
+def shutdown_password_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
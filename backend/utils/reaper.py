@@ -0,0 +1,111 @@
+import queue
+import threading
+from pathlib import Path
+from typing import Callable, Iterable, Union
+
+from utils.log_config import api_logger
+from utils.settings import current_settings
+
+# Deleting an image (or many) only has to commit the db transaction on the request
+# path. Its files are queued here and unlinked by one background thread, which
+# drains the queue in batches of up to `reaper_batch_size` paths and then runs the
+# after-batch callbacks once per batch (e.g. a single blob eviction pass instead of
+# one per deleted compression). The queue is drained on shutdown.
+
+_STOP = object()
+
+class FileReaper:
+    def __init__(self, batch_size: int, batch_interval_seconds: float):
+        self.batch_size = batch_size
+        self.batch_interval_seconds = batch_interval_seconds
+        self._queue = queue.Queue()
+        self._after_batch = []
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.unlinked = 0
+        self.missing = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._run, name="file-reaper", daemon=True)
+        self._thread.start()
+
+    def queue_unlinks(self, paths: Iterable[str], after_batch: Union[Callable[[], None], None] = None):
+        paths = list(paths)
+        with self._lock:
+            self.queued += len(paths)
+            if after_batch is not None and after_batch not in self._after_batch:
+                self._after_batch.append(after_batch)
+        for file_path in paths:
+            self._queue.put(file_path)
+        if len(paths) == 0 and after_batch is not None:
+            self._queue.put(None)
+
+    def _next_batch(self) -> tuple:
+        batch = [self._queue.get()]
+        stop = batch[0] is _STOP
+        while not stop and len(batch) < self.batch_size:
+            try:
+                item = self._queue.get(timeout=self.batch_interval_seconds)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                stop = True
+                break
+            batch.append(item)
+        return [item for item in batch if item is not None and item is not _STOP], stop
+
+    def _run(self):
+        while True:
+            batch, stop = self._next_batch()
+            self._reap(batch)
+            if stop:
+                return
+
+    def _reap(self, batch: list):
+        unlinked = 0
+        missing = 0
+        for file_path in batch:
+            try:
+                Path(file_path).unlink()
+                unlinked += 1
+            except FileNotFoundError:
+                missing += 1
+            except OSError as e:
+                api_logger.info(f"Error deleting {file_path}: {e}")
+
+        with self._lock:
+            self.unlinked += unlinked
+            self.missing += missing
+            self.batches += 1
+            after_batch, self._after_batch = self._after_batch, []
+
+        for callback in after_batch:
+            try:
+                callback()
+            except Exception as e:
+                api_logger.info(f"Error after deleting files: {e!r}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return { "queued": self.queued, "pending": self._queue.qsize(), "unlinked": self.unlinked, "missing": self.missing, "batches": self.batches }
+
+    def shutdown(self, wait: bool = True):
+        self._queue.put(_STOP)
+        if wait:
+            self._thread.join()
+
+_reaper: Union[FileReaper, None] = None
+_reaper_lock = threading.Lock()
+
+def get_file_reaper() -> FileReaper:
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = FileReaper(current_settings.reaper_batch_size, current_settings.reaper_batch_interval_seconds)
+        return _reaper
+
+def shutdown_file_reaper():
+    global _reaper
+    with _reaper_lock:
+        if _reaper is not None:
+            _reaper.shutdown()
+            _reaper = None
@@ -1,4 +1,5 @@
 import logging
+from typing import Union
 from pathlib import Path
 from pydantic_settings import BaseSettings
 from dotenv import load_dotenv
@@ -10,15 +11,66 @@ backend_root = f"{Path(__file__).parent.parent.absolute()}"
 class Settings(BaseSettings):
     log_level: int = logging.DEBUG
     max_file_size: int = 50 * 1000 * 1000
+    upload_chunk_size: int = 1024 * 1024
     max_user_images: int = 10
     max_compressions_per_image: int = 10
+    # originals plus compressions, None for no limit
+    max_user_bytes: Union[int, None] = None
+    max_page_size: int = 100
     auth_secret_key: str = "shhhh"
     signed_url_secret_key: str = "url_shhhh"
     algorithm: str = "HS256"
     access_token_expire_minutes: int = 30
+    user_cache_size: int = 1024
+    user_cache_ttl_seconds: int = 60
+    password_pool_workers: int = 2
+    password_pool_queue_size: int = 8
+    password_pool_retry_after_seconds: int = 2
+    password_bcrypt_rounds: Union[int, None] = None
+    login_attempts_per_username: int = 5
+    login_attempts_per_client: int = 20
+    login_attempt_window_seconds: float = 60
     signed_image_expiry_minutes: int = 2
+    signed_url_cache_size: int = 4096
     base_path: str = backend_root
+    db_backend: str = "json"
     db_file_path: str =  f"{base_path}/db.json"
     filestore_file_path: str =  f"{base_path}/filestore"
+    db_compact_threshold: int = 1000
+    db_fsync: bool = True
+    image_pool_workers: int = 2
+    image_pool_queue_size: int = 8
+    image_job_timeout_seconds: float = 60
+    image_pool_retry_after_seconds: int = 5
+    # Pillow's decompression bomb limit, also the most pixels an upload may have
+    max_image_pixels: Union[int, None] = 89478485
+    # decoded source raster per image job; bigger sources are reduced in strips or rejected
+    image_job_memory_budget_bytes: Union[int, None] = 512 * 1000 * 1000
+    compression_job_max_wait_seconds: float = 30
+    compression_job_poll_seconds: float = 0.25
+    # added to a job's processing timeout before a pending job counts as abandoned
+    compression_job_lease_grace_seconds: float = 60
+    compression_cache_max_bytes: int = 500 * 1000 * 1000
+    compression_cache_grace_seconds: int = 300
+    reaper_batch_size: int = 256
+    reaper_batch_interval_seconds: float = 0.2
+    filestore_gc_checkpoint_path: str = f"{base_path}/filestore-gc.json"
+    filestore_gc_interval_seconds: Union[float, None] = None
+    filestore_gc_max_entries: Union[int, None] = 10000
+    filestore_gc_rate: Union[float, None] = 500
+    filestore_gc_grace_seconds: float = 3600
+    filestore_gc_reclaim: bool = False
+    compression_resample: str = "bicubic"
+    compression_reducing_gap: float = 3.0
+    compression_webp_method: int = 4
+    compression_avif_speed: int = 6
+    auto_quality_min: int = 30
+    auto_quality_analysis_size: int = 1024
+    preview_sizes: list[int] = [128, 512, 1024]
+    preview_quality: int = 80
+    # how soon an image whose previews were skipped or failed is retried when listed
+    preview_retry_seconds: float = 300
+    # serves GET /metrics and records timings, off it costs a settings lookup per timer
+    metrics_enabled: bool = False
 
 current_settings = Settings()
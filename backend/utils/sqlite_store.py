@@ -0,0 +1,374 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from typing import Callable, Union
+
+from utils.log_config import api_logger
+from utils.metrics import DB_SECONDS
+from utils.store import INDEXED_FIELDS, _assign, fresh_db, load_document
+
+# Each section of the JSON layout maps to a table keyed by its nesting levels:
+#   users[username], images[userId][imageId], compressions[imageId][compressionId],
+#   jobs[imageId][jobId], blobs[key], user_counters[userId], image_counters[imageId]
+# The composite primary keys double as the (user_id, image_id) and
+# (image_id, compression_id) lookup indexes. Records are stored as JSON so the
+# db.py API behaves the same as with the JSON backend. Any other top-level key
+# of the document is kept in `extra`.
+SECTIONS = {
+    "users": ("username",),
+    "images": ("user_id", "image_id"),
+    "compressions": ("image_id", "compression_id"),
+    "jobs": ("image_id", "job_id"),
+    "blobs": ("key",),
+    "user_counters": ("user_id",),
+    "image_counters": ("image_id",),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT NOT NULL PRIMARY KEY,
+    data TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS images (
+    user_id TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, image_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS compressions (
+    image_id TEXT NOT NULL,
+    compression_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (image_id, compression_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS jobs (
+    image_id TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (image_id, job_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS blobs (
+    key TEXT NOT NULL PRIMARY KEY,
+    data TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_counters (
+    user_id TEXT NOT NULL PRIMARY KEY,
+    data TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS image_counters (
+    image_id TEXT NOT NULL PRIMARY KEY,
+    data TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS extra (
+    key TEXT NOT NULL PRIMARY KEY,
+    data TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT NOT NULL PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+"""
+
+# listing sort orders, e.g. images by (user_id, uploaded_at, image_id)
+for _section, _fields in INDEXED_FIELDS.items():
+    _parent, _key = SECTIONS[_section]
+    for _field in _fields:
+        SCHEMA += f"CREATE INDEX IF NOT EXISTS {_section}_by_{_field} ON {_section} ({_parent}, json_extract(data, '$.{_field}'), {_key});\n"
+
+def _where(columns: tuple) -> str:
+    return " AND ".join(f"{column} = ?" for column in columns)
+
+# statement text is fixed per section so sqlite3's per-connection statement cache
+# hands back the prepared statement instead of re-compiling it
+STATEMENTS = {}
+for _section, _columns in SECTIONS.items():
+    STATEMENTS[_section] = {
+        "select_all": f"SELECT {', '.join(_columns)}, data FROM {_section}",
+        "select": f"SELECT data FROM {_section} WHERE {_where(_columns)}",
+        "upsert": f"INSERT OR REPLACE INTO {_section} ({', '.join(_columns)}, data) VALUES ({', '.join('?' for _ in _columns)}, ?)",
+        "delete": f"DELETE FROM {_section} WHERE {_where(_columns)}",
+        "delete_all": f"DELETE FROM {_section}",
+    }
+    if len(_columns) > 1:
+        STATEMENTS[_section].update({
+            "select_children": f"SELECT {_columns[-1]}, data FROM {_section} WHERE {_where(_columns[:-1])}",
+            "count_children": f"SELECT COUNT(*) FROM {_section} WHERE {_where(_columns[:-1])}",
+            "delete_children": f"DELETE FROM {_section} WHERE {_where(_columns[:-1])}",
+        })
+    # pages read the records with the field and those without it (NULL) separately, see
+    # get_page; each part walks the expression index in order
+    for _field in INDEXED_FIELDS.get(_section, ()):
+        _value = f"json_extract(data, '$.{_field}')"
+        for _descending in (False, True):
+            _order = f"ORDER BY {_value} {'DESC' if _descending else 'ASC'}, {_columns[-1]} {'DESC' if _descending else 'ASC'} LIMIT ?"
+            _select = f"SELECT {_columns[-1]}, data FROM {_section} WHERE {_columns[0]} = ?"
+            _compare = '<' if _descending else '>'
+            STATEMENTS[_section][("page", _field, _descending, "value", False)] = f"{_select} AND {_value} IS NOT NULL {_order}"
+            # spelled out instead of a row value so the expression index bounds the scan
+            STATEMENTS[_section][("page", _field, _descending, "value", True)] = f"{_select} AND {_value} {_compare}= ? AND ({_value} {_compare} ? OR {_columns[-1]} {_compare} ?) {_order}"
+            # the value is the same NULL throughout, ordering by key alone avoids a sort
+            _key_order = f"ORDER BY {_columns[-1]} {'DESC' if _descending else 'ASC'} LIMIT ?"
+            STATEMENTS[_section][("page", _field, _descending, "null", False)] = f"{_select} AND {_value} IS NULL {_key_order}"
+            STATEMENTS[_section][("page", _field, _descending, "null", True)] = f"{_select} AND {_value} IS NULL AND {_columns[-1]} {_compare} ? {_key_order}"
+
+class SQLiteStore:
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._document = None
+        self._document_generation = None
+        self.hits = 0
+        self.misses = 0
+
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        # one pooled connection per worker thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.file_path, isolation_level=None, check_same_thread=False, cached_statements=256)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+
+        return connection
+
+    @property
+    def generation(self) -> int:
+        return self._connection().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+    def reader(self) -> "SQLiteStore":
+        return self
+
+    def get_user(self, username: str) -> Union[dict, None]:
+        return self.get_record("users", None, username)
+
+    def get_section(self, section: str) -> dict:
+        rows = self._connection().execute(STATEMENTS[section]["select_all"])
+        return { key: json.loads(data) for key, data in rows }
+
+    def get_records(self, section: str, parent_key: str) -> dict:
+        rows = self._connection().execute(STATEMENTS[section]["select_children"], (parent_key,))
+        return { key: json.loads(data) for key, data in rows }
+
+    def iter_nested_records(self, section: str):
+        for parent_key, key, data in self._connection().execute(STATEMENTS[section]["select_all"]):
+            yield parent_key, key, json.loads(data)
+
+    def get_record(self, section: str, parent_key: str, key: str) -> Union[dict, None]:
+        keys = (key,) if parent_key is None else (parent_key, key)
+        row = self._connection().execute(STATEMENTS[section]["select"], keys).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+
+    def count_records(self, section: str, parent_key: str) -> int:
+        return self._connection().execute(STATEMENTS[section]["count_children"], (parent_key,)).fetchone()[0]
+
+    def get_page(self, section: str, parent_key: str, field: str, descending: bool = False, after: Union[tuple, None] = None, limit: Union[int, None] = None) -> list:
+        # records without the field sort after the rest (before them, descending), as
+        # with sort_key in the JSON store, where SQLite would put NULL first. A page reads
+        # the part the cursor is in from the cursor on, then the part after it
+        parts = ("null", "value") if descending else ("value", "null")
+        if after is not None:
+            parts = parts[parts.index("null" if after[0] is None else "value"):]
+
+        page = []
+        for part in parts:
+            remaining = -1 if limit is None else limit - len(page)
+            if remaining == 0:
+                break
+            if after is None or part != ("null" if after[0] is None else "value"):
+                rows = self._connection().execute(STATEMENTS[section][("page", field, descending, part, False)], (parent_key, remaining))
+            elif part == "null":
+                rows = self._connection().execute(STATEMENTS[section][("page", field, descending, part, True)], (parent_key, after[1], remaining))
+            else:
+                rows = self._connection().execute(STATEMENTS[section][("page", field, descending, part, True)], (parent_key, after[0], after[0], after[1], remaining))
+            page += [(key, json.loads(data)) for key, data in rows]
+        return page
+
+    def refresh(self) -> dict:
+        # materializes the whole document for get_db; cached until the next write
+        connection = self._connection()
+        generation = self.generation
+        if self._document is not None and generation == self._document_generation:
+            self.hits += 1
+            return self._document
+
+        with DB_SECONDS.time("parse"):
+            document = fresh_db()
+            for section, columns in SECTIONS.items():
+                for row in connection.execute(STATEMENTS[section]["select_all"]):
+                    node = document[section]
+                    for key in row[:len(columns) - 1]:
+                        node = node.setdefault(key, {})
+                    node[row[len(columns) - 1]] = json.loads(row[-1])
+
+            for key, data in connection.execute("SELECT key, data FROM extra"):
+                document[key] = json.loads(data)
+
+        self._document = document
+        self._document_generation = generation
+        self.misses += 1
+        return document
+
+    def _transaction(self, apply: Callable[[sqlite3.Connection], None]):
+        connection = self._connection()
+        with DB_SECONDS.time("transaction"):
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                apply(connection)
+                connection.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def _put_section(self, connection: sqlite3.Connection, section: str, keys: tuple, value):
+        # writes a (partial) subtree of a section, e.g. the whole images[userId] dict
+        columns = SECTIONS[section]
+        if len(keys) == len(columns):
+            connection.execute(STATEMENTS[section]["upsert"], (*keys, json.dumps(value)))
+            return
+
+        for key, child in value.items():
+            self._put_section(connection, section, (*keys, key), child)
+
+    def _delete_section(self, connection: sqlite3.Connection, section: str, keys: tuple):
+        columns = SECTIONS[section]
+        if len(keys) == 0:
+            connection.execute(STATEMENTS[section]["delete_all"])
+        elif len(keys) == len(columns):
+            connection.execute(STATEMENTS[section]["delete"], keys)
+        else:
+            connection.execute(STATEMENTS[section]["delete_children"], keys)
+
+    def _apply_op(self, connection: sqlite3.Connection, op: dict):
+        section, path = op["path"][0], op["path"][1:]
+
+        if section not in SECTIONS:
+            if len(path) == 0:
+                if op["op"] == "del":
+                    connection.execute("DELETE FROM extra WHERE key = ?", (section,))
+                else:
+                    connection.execute("INSERT OR REPLACE INTO extra (key, data) VALUES (?, ?)", (section, json.dumps(op["value"])))
+                return
+
+            row = connection.execute("SELECT data FROM extra WHERE key = ?", (section,)).fetchone()
+            current = json.loads(row[0]) if row is not None else None
+            if not isinstance(current, dict):
+                if op["op"] == "del" or not op.get("create", True):
+                    return
+                current = {}
+            connection.execute("INSERT OR REPLACE INTO extra (key, data) VALUES (?, ?)", (section, json.dumps(_assign(current, path, op))))
+            return
+
+        columns = SECTIONS[section]
+        if len(path) > len(columns):
+            # a field inside a record, e.g. ["images", userId, imageId, "previews"]
+            keys = tuple(path[:len(columns)])
+            row = connection.execute(STATEMENTS[section]["select"], keys).fetchone()
+            if row is None and (op["op"] == "del" or not op.get("create", True)):
+                return
+            record = json.loads(row[0]) if row is not None else {}
+            connection.execute(STATEMENTS[section]["upsert"], (*keys, json.dumps(_assign(record, path[len(columns):], op))))
+            return
+
+        keys = tuple(path)
+        if op["op"] == "del":
+            self._delete_section(connection, section, keys)
+        else:
+            if len(keys) < len(columns):
+                self._delete_section(connection, section, keys)
+            self._put_section(connection, section, keys, op["value"])
+
+    def commit(self, ops: list):
+        def apply(connection):
+            for op in ops:
+                self._apply_op(connection, op)
+
+        self._transaction(apply)
+
+    def transact(self, build_ops: Callable[["SQLiteStore"], list]):
+        # reads made by build_ops share the BEGIN IMMEDIATE transaction of the writes
+        def apply(connection):
+            for op in build_ops(self):
+                self._apply_op(connection, op)
+
+        self._transaction(apply)
+
+    def replace(self, update_function: Callable[[dict], Union[dict, None]]) -> Union[dict, None]:
+        working = json.loads(json.dumps(self.refresh()))
+        result = update_function(working)
+        if result is None:
+            return None
+
+        self._transaction(lambda connection: self._write_document(connection, result))
+        return result
+
+    def _write_document(self, connection: sqlite3.Connection, document: dict):
+        for section in SECTIONS:
+            connection.execute(STATEMENTS[section]["delete_all"])
+            self._put_section(connection, section, (), document.get(section, {}))
+
+        connection.execute("DELETE FROM extra")
+        for key, value in document.items():
+            if key not in SECTIONS:
+                connection.execute("INSERT OR REPLACE INTO extra (key, data) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+_stores: dict = {}
+_stores_lock = threading.Lock()
+
+def open_sqlite_store(file_path: str) -> SQLiteStore:
+    store = _stores.get(file_path)
+    if store is not None:
+        return store
+
+    with _stores_lock:
+        if file_path not in _stores:
+            _stores[file_path] = SQLiteStore(file_path)
+        return _stores[file_path]
+
+def close_sqlite_store(file_path: str):
+    with _stores_lock:
+        store = _stores.pop(file_path, None)
+    if store is not None:
+        store.close()
+
+def reset_sqlite_store(file_path: str, document: dict):
+    close_sqlite_store(file_path)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(f"{file_path}{suffix}"):
+            os.unlink(f"{file_path}{suffix}")
+
+    store = open_sqlite_store(file_path)
+    store._transaction(lambda connection: store._write_document(connection, document))
+
+def migrate_json_to_sqlite(json_path: str, sqlite_path: str):
+    document = load_document(json_path)
+    reset_sqlite_store(sqlite_path, document)
+    close_sqlite_store(sqlite_path)
+
+    api_logger.info(f"Migrated {json_path} to {sqlite_path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="One-shot migration of a JSON db (e.g. db.json or db-backup.json) to the SQLite backend")
+    parser.add_argument("json_path")
+    parser.add_argument("sqlite_path")
+    args = parser.parse_args()
+
+    migrate_json_to_sqlite(args.json_path, args.sqlite_path)
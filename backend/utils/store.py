@@ -0,0 +1,508 @@
+import bisect
+from collections.abc import Mapping
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import tempfile
+import threading
+from typing import Callable, Union
+
+from utils.settings import current_settings
+from utils.log_config import api_logger
+from utils.metrics import DB_SECONDS
+
+# The JSON document is held in memory and treated as immutable: every write builds
+# a new document by copying only the dicts along the written path, so readers and
+# the compactor can hold on to a document without locking.
+#
+# Writes are appended to `{file_path}.log` as one JSON line per transaction. A line
+# is a list of path assignments, e.g.
+#   [{"op": "put", "path": ["images", userId, imageId], "value": {...}}]
+# Assignments are idempotent, so replaying log lines already folded into the
+# snapshot (a crash between writing the snapshot and rotating the log) is harmless.
+#
+# Several worker processes can share the files. An flock on `{file_path}.lock`
+# is held exclusively to append, rewrite the snapshot or rotate the log, and
+# shared while (re)loading, so a reader never pairs a snapshot with the wrong log.
+
+def fresh_db():
+    return { "users": {}, "images": {}, "compressions": {}, "jobs": {}, "blobs": {}, "user_counters": {}, "image_counters": {} }
+
+def put_op(path: list, value, create: bool = True) -> dict:
+    # with create=False the put is dropped if the parent record no longer exists
+    if create:
+        return { "op": "put", "path": path, "value": value }
+    return { "op": "put", "path": path, "value": value, "create": False }
+
+def del_op(path: list) -> dict:
+    return { "op": "del", "path": path }
+
+def _assign(node: dict, path: list, op: dict) -> dict:
+    key = path[0]
+    if len(path) == 1:
+        if op["op"] == "del":
+            if key not in node:
+                return node
+            updated = dict(node)
+            del updated[key]
+            return updated
+
+        updated = dict(node)
+        updated[key] = op["value"]
+        return updated
+
+    child = node.get(key)
+    if not isinstance(child, dict):
+        if op["op"] == "del" or not op.get("create", True):
+            return node
+        child = {}
+
+    updated = dict(node)
+    updated[key] = _assign(child, path[1:], op)
+    return updated
+
+def apply_ops(document: dict, ops: list) -> dict:
+    for op in ops:
+        document = _assign(document, op["path"], op)
+    return document
+
+def load_document(file_path: str) -> dict:
+    # read-only load of a snapshot plus any log next to it, e.g. for migrations
+    with open(file_path, "r") as read_file:
+        db_text = read_file.read()
+    document = json.loads(db_text) if len(db_text) != 0 else {}
+
+    if os.path.exists(f"{file_path}.log"):
+        with open(f"{file_path}.log", "rb") as log_file:
+            for line in log_file:
+                if not line.endswith(b"\n"):
+                    break
+                document = apply_ops(document, json.loads(line))
+
+    return document
+
+# Listings sort on these record fields. The SQLite backend keeps an expression
+# index per field; the JSON backend keeps SortedIndexes in memory.
+INDEXED_FIELDS = {
+    "images": ("uploaded_at", "size", "name"),
+    "compressions": ("created_at", "size", "quality"),
+}
+
+def sort_key(record: dict, field: str, key: str) -> tuple:
+    value = record.get(field)
+    return (value is None, value, key)
+
+def page_from_sorted(entries: list, records: dict, descending: bool, after: Union[tuple, None], limit: Union[int, None]) -> list:
+    # entries are sort_key tuples in ascending order; `after` is (value, key) of the
+    # last item of the previous page
+    if after is None:
+        start, stop = (len(entries), 0) if descending else (0, len(entries))
+    else:
+        position = (after[0] is None, after[0], after[1])
+        if descending:
+            start, stop = bisect.bisect_left(entries, position), 0
+        else:
+            start, stop = bisect.bisect_right(entries, position), len(entries)
+
+    if descending:
+        end = stop if limit is None else max(stop, start - limit)
+        selected = entries[end:start][::-1]
+    else:
+        end = stop if limit is None else min(stop, start + limit)
+        selected = entries[start:end]
+
+    return [(entry[2], records[entry[2]]) for entry in selected]
+
+class SortedIndexes:
+    # (section, parent_key, field) -> ascending list of sort_key tuples. Built on first
+    # use and then kept up to date from the ops of every transaction, so a page costs
+    # a bisect plus the page itself.
+    def __init__(self):
+        self._indexes = {}
+
+    def clear(self):
+        self._indexes = {}
+
+    def get(self, document: dict, section: str, parent_key: str, field: str) -> list:
+        index = self._indexes.get((section, parent_key, field))
+        if index is None:
+            records = document.get(section, {}).get(parent_key, {})
+            index = sorted(sort_key(record, field, key) for key, record in records.items())
+            self._indexes[(section, parent_key, field)] = index
+        return index
+
+    def apply(self, before: dict, after: dict, ops: list):
+        if len(self._indexes) == 0:
+            return
+
+        touched = set()
+        for op in ops:
+            path = op["path"]
+            if path[0] not in INDEXED_FIELDS:
+                continue
+            if len(path) < 3:
+                # a whole section or collection was rewritten
+                self._indexes = { index: entries for index, entries in self._indexes.items() if index[0] != path[0] or (len(path) == 2 and index[1] != path[1]) }
+                continue
+            touched.add((path[0], path[1], path[2]))
+
+        for section, parent_key, key in touched:
+            old = before.get(section, {}).get(parent_key, {}).get(key)
+            new = after.get(section, {}).get(parent_key, {}).get(key)
+            for field in INDEXED_FIELDS[section]:
+                index = self._indexes.get((section, parent_key, field))
+                if index is None:
+                    continue
+                if isinstance(old, dict):
+                    entry = sort_key(old, field, key)
+                    position = bisect.bisect_left(index, entry)
+                    if position < len(index) and index[position] == entry:
+                        del index[position]
+                if isinstance(new, dict):
+                    bisect.insort(index, sort_key(new, field, key))
+
+class FrozenDocument(Mapping):
+    # a read-only view of a document (or part of one) shared between readers; nested
+    # dicts and lists are wrapped as they're read, so nothing is copied up front
+    __slots__ = ("_data",)
+
+    def __init__(self, data: dict):
+        self._data = data
+
+    def __getitem__(self, key):
+        return frozen(self._data[key])
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __repr__(self) -> str:
+        return f"FrozenDocument({self._data!r})"
+
+def frozen(value):
+    if isinstance(value, dict):
+        return FrozenDocument(value)
+    if isinstance(value, list):
+        return tuple(frozen(item) for item in value)
+    return value
+
+class DocumentReader:
+    def __init__(self, document: dict, store: Union["JSONStore", None] = None):
+        self.document = document
+        self.store = store
+
+    def reader(self) -> "DocumentReader":
+        return self
+
+    def get_user(self, username: str) -> Union[dict, None]:
+        return self.document["users"].get(username)
+
+    def get_section(self, section: str) -> dict:
+        return self.document.get(section, {})
+
+    def get_records(self, section: str, parent_key: str) -> dict:
+        return self.document.get(section, {}).get(parent_key, {})
+
+    def iter_nested_records(self, section: str):
+        # (parent_key, key, record) for every record of a two-level section, e.g. images
+        for parent_key, records in self.get_section(section).items():
+            for key, record in records.items():
+                yield parent_key, key, record
+
+    def get_record(self, section: str, parent_key: str, key: str) -> Union[dict, None]:
+        records = self.get_section(section) if parent_key is None else self.get_records(section, parent_key)
+        return records.get(key)
+
+    def count_records(self, section: str, parent_key: str) -> int:
+        return len(self.get_records(section, parent_key))
+
+    def get_page(self, section: str, parent_key: str, field: str, descending: bool = False, after: Union[tuple, None] = None, limit: Union[int, None] = None) -> list:
+        if self.store is not None:
+            page = self.store.get_page(self.document, section, parent_key, field, descending, after, limit)
+            if page is not None:
+                return page
+
+        records = self.get_records(section, parent_key)
+        entries = sorted(sort_key(record, field, key) for key, record in records.items())
+        return page_from_sorted(entries, records, descending, after, limit)
+
+def _write_tmp(file_path: str, data: bytes) -> str:
+    dir_name = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            if current_settings.db_fsync:
+                os.fsync(tmp_file.fileno())
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return tmp_path
+
+def write_json_atomic(file_path: str, value):
+    os.replace(_write_tmp(file_path, json.dumps(value).encode()), file_path)
+
+class JSONStore:
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.log_path = f"{file_path}.log"
+        self.lock_path = f"{file_path}.lock"
+        self._lock = threading.RLock()
+        self._lock_file = open(self.lock_path, "a")
+        self._flock_held = False
+        self._compacting = False
+        self._compaction_thread = None
+        self._log_records = 0
+        self._log_offset = 0
+        self._signature = None
+        self._log_file = None
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._indexes = SortedIndexes()
+        with self._locked(exclusive=False):
+            self._load()
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        # the thread lock serializes this process, the flock serializes worker processes
+        with self._lock:
+            if self._flock_held:
+                yield
+                return
+
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._flock_held = True
+            try:
+                yield
+            finally:
+                self._flock_held = False
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _stat_signature(self):
+        # identifies the on-disk state this process has loaded, so changes made by
+        # other processes (or a copied-in db.json) are picked up on the next read
+        snapshot = os.stat(self.file_path)
+        try:
+            log = os.stat(self.log_path)
+            log_signature = (log.st_ino, log.st_size)
+        except FileNotFoundError:
+            log_signature = None
+
+        return (snapshot.st_ino, snapshot.st_mtime_ns, snapshot.st_size, log_signature)
+
+    def _load(self):
+        with open(self.file_path, "r") as read_file:
+            db_text = read_file.read()
+        with DB_SECONDS.time("parse"):
+            self.document = json.loads(db_text) if len(db_text) != 0 else {}
+        self._indexes.clear()
+        self._log_records = 0
+        self._log_offset = 0
+
+        if self._log_file is not None:
+            self._log_file.close()
+        self._log_file = open(self.log_path, "a")
+
+        self._replay_log()
+
+    def _replay_log(self):
+        document = self.document
+        good_offset = self._log_offset
+        with DB_SECONDS.time("replay"), open(self.log_path, "rb") as log_file:
+            log_file.seek(good_offset)
+            for line in log_file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    ops = json.loads(line)
+                except ValueError:
+                    break
+                updated = apply_ops(document, ops)
+                self._indexes.apply(document, updated, ops)
+                document = updated
+                good_offset += len(line)
+                self._log_records += 1
+
+        if good_offset != os.path.getsize(self.log_path):
+            api_logger.info(f"Discarding torn tail of db log: {self.log_path}")
+            os.truncate(self.log_path, good_offset)
+
+        self.document = document
+        self._log_offset = good_offset
+        self._signature = self._stat_signature()
+        self.generation += 1
+        self.misses += 1
+
+    def refresh(self) -> dict:
+        signature = self._stat_signature()
+        if signature == self._signature:
+            self.hits += 1
+            return self.document
+
+        with self._locked(exclusive=False):
+            self._catch_up()
+            return self.document
+
+    def reader(self) -> DocumentReader:
+        return DocumentReader(self.refresh(), self)
+
+    def get_page(self, document: dict, section: str, parent_key: str, field: str, descending: bool, after: Union[tuple, None], limit: Union[int, None]) -> Union[list, None]:
+        # the indexes follow self.document; a reader holding an older document sorts itself
+        with self._lock:
+            if document is not self.document:
+                return None
+            entries = self._indexes.get(document, section, parent_key, field)
+            return page_from_sorted(entries, document.get(section, {}).get(parent_key, {}), descending, after, limit)
+
+    def _catch_up(self):
+        signature = self._stat_signature()
+        if signature == self._signature:
+            return
+
+        snapshot_changed = signature[:3] != self._signature[:3]
+        log_replaced = signature[3] is None or self._signature[3] is None or signature[3][0] != self._signature[3][0]
+        if snapshot_changed or log_replaced:
+            self._load()
+        else:
+            self._replay_log()
+
+    def _append(self, record: str):
+        data = record + "\n"
+        with DB_SECONDS.time("append"):
+            self._log_file.write(data)
+            self._log_file.flush()
+            if current_settings.db_fsync:
+                os.fsync(self._log_file.fileno())
+        self._log_offset += len(data.encode())
+        self._signature = self._stat_signature()
+
+    def commit(self, ops: list) -> dict:
+        record = json.dumps(ops)
+        with self._locked(exclusive=True):
+            self._catch_up()
+            document = apply_ops(self.document, ops)
+            self._append(record)
+            self._indexes.apply(self.document, document, ops)
+            self.document = document
+            self.generation += 1
+            self._log_records += 1
+            should_compact = self._log_records >= current_settings.db_compact_threshold and not self._compacting
+            if should_compact:
+                self._compacting = True
+                self._compaction_thread = threading.Thread(target=self._compact, daemon=True)
+                self._compaction_thread.start()
+
+        return document
+
+    def transact(self, build_ops: Callable[[DocumentReader], list]) -> dict:
+        # build_ops reads the latest document under the write lock, so ops derived
+        # from it (e.g. counters) can't interleave with another writer
+        with self._locked(exclusive=True):
+            self._catch_up()
+            ops = build_ops(DocumentReader(self.document))
+            if len(ops) == 0:
+                return self.document
+            return self.commit(ops)
+
+    def replace(self, update_function: Callable[[dict], Union[dict, None]]) -> Union[dict, None]:
+        with self._locked(exclusive=True):
+            self._catch_up()
+            working = json.loads(json.dumps(self.document))
+            result = update_function(working)
+            if result is None:
+                return None
+
+            with DB_SECONDS.time("snapshot"):
+                write_json_atomic(self.file_path, result)
+            self._rotate_log(self._log_offset)
+            self._indexes.clear()
+            self.document = result
+            self.generation += 1
+            return result
+
+    def compact(self):
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+        self._compact()
+
+    def _compact(self):
+        try:
+            with self._locked(exclusive=True):
+                self._catch_up()
+                document = self.document
+                offset = self._log_offset
+                signature = self._signature
+
+            with DB_SECONDS.time("snapshot"):
+                tmp_path = _write_tmp(self.file_path, json.dumps(document).encode())
+
+            with self._locked(exclusive=True):
+                current = self._stat_signature()
+                if current[:3] != signature[:3] or current[3] is None or current[3][0] != signature[3][0]:
+                    # another writer replaced the snapshot or log in the meantime
+                    os.unlink(tmp_path)
+                    return
+                self._catch_up()
+                os.replace(tmp_path, self.file_path)
+                self._rotate_log(offset)
+        except Exception as e:
+            api_logger.info(f"Error compacting db log: {e}")
+        finally:
+            self._compacting = False
+
+    def _rotate_log(self, offset: int):
+        # keep only the records appended after `offset`
+        self._log_file.flush()
+        with open(self.log_path, "rb") as log_file:
+            log_file.seek(offset)
+            tail = log_file.read()
+
+        os.replace(_write_tmp(self.log_path, tail), self.log_path)
+
+        self._log_file.close()
+        self._log_file = open(self.log_path, "a")
+        self._log_records = tail.count(b"\n")
+        self._log_offset = len(tail)
+        self._signature = self._stat_signature()
+
+    def close(self):
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+        with self._lock:
+            self._log_file.close()
+            self._lock_file.close()
+
+_stores: dict = {}
+_stores_lock = threading.Lock()
+
+def open_store(file_path: str) -> JSONStore:
+    store = _stores.get(file_path)
+    if store is not None:
+        return store
+
+    with _stores_lock:
+        if file_path not in _stores:
+            _stores[file_path] = JSONStore(file_path)
+        return _stores[file_path]
+
+def close_store(file_path: str):
+    with _stores_lock:
+        store = _stores.pop(file_path, None)
+    if store is not None:
+        store.close()
+
+def reset_store(file_path: str, document: dict):
+    close_store(file_path)
+    with open(f"{file_path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        write_json_atomic(file_path, document)
+        if os.path.exists(f"{file_path}.log"):
+            os.unlink(f"{file_path}.log")
@@ -22,18 +22,74 @@ class UserImage(BaseModel):
   extension: str
   size: int
   uploaded_at: str
+  width: Optional[int] = None
+  height: Optional[int] = None
+  hash: Optional[str] = None
+  previews: Optional[dict[str, str]] = None
   num_compressions: Optional[int] = 0
   signed_url: Optional[str] = "" 
+  preview_url: Optional[str] = None
 
 class UserImageCompression(BaseModel):
   id: str
   image_id: str
+  user_id: Optional[str] = None
   path: str
   quality: int
   resize_width: Optional[int] = 0
+  resample: Optional[str] = None
+  output_format: Optional[str] = None
   size: Optional[int] = 0
+  ssim: Optional[float] = None
+  psnr: Optional[float] = None
   created_at: str
+  blob_key: Optional[str] = None
   signed_url: Optional[str] = "" 
 
+class SignedDownload(BaseModel):
+  image_id: str
+  path: str
+  expires_at: int
+  user_id: Optional[str] = None
+  compression_id: Optional[str] = None
+  etag: Optional[str] = None
+
+class CompressionVariant(BaseModel):
+  quality: int
+  resize_width: Optional[int] = None
+  resample: Optional[str] = None
+  output_format: Optional[str] = None
+  target_ssim: Optional[float] = None
+  target_psnr: Optional[float] = None
+  max_bytes: Optional[int] = None
+
+class CompressionJobRequest(BaseModel):
+  variants: list[CompressionVariant]
+
+class DeleteImagesRequest(BaseModel):
+  image_ids: list[str]
+
+class CompressionJob(BaseModel):
+  id: str
+  image_id: str
+  user_id: str
+  quality: int
+  resize_width: Optional[int] = None
+  resample: Optional[str] = None
+  output_format: Optional[str] = None
+  target_ssim: Optional[float] = None
+  target_psnr: Optional[float] = None
+  max_bytes: Optional[int] = None
+  status: str
+  compression_id: Optional[str] = None
+  error: Optional[str] = None
+  created_at: str
+  # epoch seconds after which a pending job is considered abandoned (failed)
+  lease_expires_at: Optional[float] = None
+  compression: Optional[UserImageCompression] = None
+
+JOB_PENDING = "pending"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
 
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S%z'
\ No newline at end of file
@@ -55,7 +55,7 @@ export const fetchTokenFromAPI = async (username: string, password: string) => {
 };
 
 export const fetchImagesFromAPI = async (token: string) => {
-  const imagesFetch = () => authenticatedFetch(`${API_URL}/images`, token);
+  const imagesFetch = () => authenticatedFetch(`${API_URL}/images?preview_size=512`, token);
   return runStandardizedFetch(imagesFetch);
 };
 
@@ -101,14 +101,21 @@ export const fetchImageCompressionsFromAPI = async (
   return runStandardizedFetch(imageCompressionsFetch);
 };
 
+export const fetchOutputFormatsFromAPI = async (token: string) => {
+  const outputFormatsFetch = () =>
+    authenticatedFetch(`${API_URL}/image-output-formats`, token);
+  return runStandardizedFetch(outputFormatsFetch);
+};
+
 export const addCompressionToAPI = async (
-  { imageId, quality, resizeWidth }: NewCompressionInput,
+  { imageId, quality, resizeWidth, outputFormat }: NewCompressionInput,
   token: string
 ) => {
   const formData = new FormData();
   formData.append("image_id", imageId);
   formData.append("quality", `${quality}`);
   formData.append("resize_width", `${resizeWidth}`);
+  if (outputFormat) formData.append("output_format", outputFormat);
 
   const addCompressionFetch = () =>
     authenticatedFetch(`${API_URL}/image/${imageId}/image-compression`, token, {
@@ -12,6 +12,7 @@ export type UserImage = {
   uploaded_at: Date;
   num_compressions?: number;
   signed_url?: string;
+  preview_url?: string;
 };
 
 export type ImageCompression = {
@@ -20,6 +21,7 @@ export type ImageCompression = {
   path: string;
   quality: number;
   resize_width: number;
+  output_format?: string;
   size: number;
   created_at: Date;
   signed_url?: string;
@@ -34,4 +36,5 @@ export type NewCompressionInput = {
   imageId: string;
   quality: number;
   resizeWidth: number;
+  outputFormat: string;
 };
@@ -166,7 +166,7 @@ function App() {
               </div>
             </CardHeader>
             <CardContent>
-              <img src={`${API_URL}${o.signed_url}`} />
+              <img src={`${API_URL}${o.preview_url ?? o.signed_url}`} />
             </CardContent>
             <CardFooter>
               <div className="flex justify-between items-center w-full">
@@ -18,6 +18,7 @@ import {
   deleteImageCompressionFromAPI,
   fetchImageCompressionsFromAPI,
   fetchImageFromAPI,
+  fetchOutputFormatsFromAPI,
 } from "@/lib/api";
 import { API_URL, TOKEN_STORAGE_KEY } from "@/lib/constants";
 import { AppContext } from "@/hooks/context";
@@ -30,6 +31,7 @@ import { Label } from "@/components/ui/label";
 const EMPTY_COMPRESSION_FORM = {
   quality: 60,
   resizeWidth: 0,
+  outputFormat: "",
 };
 
 export default () => {
@@ -87,9 +89,29 @@ export default () => {
     if (imageId) fetchImageCompressions(imageId);
   }, [imageId]);
 
+  // the formats this server can write (avif depends on its Pillow build)
+  const [outputFormats, setOutputFormats] = useState<string[]>([]);
+  useEffect(() => {
+    const fetchOutputFormats = async () => {
+      const token = localStorage.getItem(TOKEN_STORAGE_KEY);
+      if (!token) return;
+
+      const { data, error } = await fetchOutputFormatsFromAPI(token);
+      if (error) {
+        setToast({ type: "error", message: error });
+        return;
+      }
+
+      setOutputFormats(data);
+    };
+
+    fetchOutputFormats();
+  }, []);
+
   const [form, setForm] = useState(EMPTY_COMPRESSION_FORM);
   const handleFormChange =
-    (key: string) => (e: React.ChangeEvent<HTMLInputElement>) => {
+    (key: string) =>
+    (e: React.ChangeEvent<HTMLInputElement | HTMLSelectElement>) => {
       setForm((o) => ({ ...o, [key]: e.target.value }));
     };
 
@@ -171,29 +193,37 @@ export default () => {
                 method="post"
                 className="flex items-center flex-wrap gap-4 mt-2"
               >
-                {image?.extension === "jpeg" ? (
-                  <div className="flex gap-1 items-center">
-                    <Label htmlFor="quality" className="font-semibold">
-                      Quality
-                    </Label>
-                    <Input
-                      name="quality"
-                      onChange={handleFormChange("quality")}
-                      value={form["quality"]}
-                      type="number"
-                      min={1}
-                      max={100}
-                    />
-                  </div>
-                ) : (
-                  <Alert variant="default">
-                    <ExclamationTriangleIcon className="h-4 w-4" />
-                    <AlertTitle>Image compression settings </AlertTitle>
-                    <AlertDescription>
-                      PNG and GIF files can only be resized
-                    </AlertDescription>
-                  </Alert>
-                )}
+                <div className="flex gap-1 items-center">
+                  <Label htmlFor="quality" className="font-semibold">
+                    Quality
+                  </Label>
+                  <Input
+                    name="quality"
+                    onChange={handleFormChange("quality")}
+                    value={form["quality"]}
+                    type="number"
+                    min={1}
+                    max={100}
+                  />
+                </div>
+                <div className="flex gap-1 items-center">
+                  <Label htmlFor="outputFormat" className="font-semibold">
+                    Format
+                  </Label>
+                  <select
+                    name="outputFormat"
+                    onChange={handleFormChange("outputFormat")}
+                    value={form["outputFormat"]}
+                    className="h-9 rounded-md border border-input bg-transparent px-3 py-1 text-sm shadow-sm"
+                  >
+                    <option value="">Same as original</option>
+                    {outputFormats.map((format) => (
+                      <option key={format} value={format}>
+                        {format.toUpperCase()}
+                      </option>
+                    ))}
+                  </select>
+                </div>
                 {imageWidth && (
                   <div className="flex gap-1 items-center">
                     <Label htmlFor="resizeWidth" className="font-semibold">
@@ -249,7 +279,7 @@ export default () => {
                     <br />
                     {o.resize_width}px wide
                     <br />
-                    {image?.extension === "jpeg" ? `${o.quality} quality` : ""}
+                    {o.quality} quality, {o.output_format || image?.extension}
                   </CardTitle>
                   <CardDescription>
                     Created at {o.created_at.toLocaleString()}